@@ -0,0 +1,106 @@
+"""
+Paridade da deduplicação do Pix: PixDedupIndex e finance_fingerprints contra a varredura antiga.
+
+Gera corpora aleatórios com colisões de propósito (mesmo valor em minutos vizinhos, descrições
+repetidas, E2E IDs reaproveitados, registros sem data) e processa os e-mails em ordem, como o
+pipeline: um e-mail não duplicado entra no Financeiro e passa a valer para os seguintes. As três
+implementações precisam tomar a mesma decisão para cada e-mail; qualquer divergência sai com código 1.
+Uso: python benchmarks/pix_dedup_parity.py [--trials 200] [--size 300] [--seed 1]
+"""
+import argparse
+import random
+import sys
+from datetime import datetime, timedelta, timezone
+
+from pix_replay import MemoryFirestore, BASE_TIME
+from firestore_writer import BufferedWriter
+from pix_sync import PixDedupIndex
+from finance_fingerprints import add_fingerprints, is_duplicate as fingerprint_duplicate
+
+KINDS = ('finance_income', 'finance_transactions')
+
+
+def legacy_is_duplicate(cache, description, amount, dt, pix_id):
+    """A varredura O(n·m) que o main.py fazia antes do PixDedupIndex (mesmas três regras, mesma ordem)"""
+    for item in cache:
+        # 1. Por ID do Pix (E2E ID)
+        if pix_id and item.get('pix_id') == pix_id: return True
+        # 2. Por Valor e Proximidade Temporal (janela de 5 minutos)
+        if item.get('amount') == amount and item.get('date'):
+            if abs((item['date'] - dt).total_seconds()) < 300: return True
+        # 3. Legado/Exata (Descrição e Valor)
+        if item.get('description') == description and item.get('amount') == amount: return True
+    return False
+
+
+def random_record(rng, pix_ids):
+    """Um registro (ou e-mail) com poucos valores, datas próximas e descrições repetidas"""
+    amount = rng.choice([10.0, 25.5, 42.0, 99.99, 150.0, round(rng.uniform(1, 500), 2)])
+    dt = datetime.fromtimestamp(BASE_TIME + rng.randrange(0, 6 * 3600, rng.choice([1, 30, 299, 300, 301])), tz=timezone.utc)
+    pix_id = rng.choice(pix_ids) if rng.random() < 0.3 else None
+    description = f"Pix: {rng.choice(['Pix recebido', 'Pix enviado', 'Transferência'])} {rng.randrange(8)}"
+    return {'kind': rng.choice(KINDS), 'description': description, 'amount': amount, 'date': dt, 'pix_id': pix_id}
+
+
+def run_trial(rng, size):
+    pix_ids = [f"E{rng.randrange(10 ** 8):08d}{'X' * 23}" for _ in range(12)]
+    legacy = {kind: [] for kind in KINDS}
+    index = {kind: PixDedupIndex() for kind in KINDS}
+    db = MemoryFirestore()
+    writer = BufferedWriter(db, log=lambda msg: None)
+
+    def add(record, doc_id):
+        kind, date = record['kind'], record['date']
+        iso = date.isoformat() if date else None
+        legacy[kind].append({'description': record['description'], 'amount': record['amount'], 'date': date, 'pix_id': record['pix_id']})
+        index[kind].add(record['description'], record['amount'], iso, record['pix_id'])
+        add_fingerprints(writer, db, kind, doc_id, {'description': record['description'], 'amount': record['amount'], 'date': iso, 'pix_id': record['pix_id']})
+        writer.flush()
+
+    # Financeiro já existente, inclusive registros sem data (só as regras 1 e 3 valem para eles)
+    for i in range(size // 2):
+        record = random_record(rng, pix_ids)
+        if rng.random() < 0.05: record['date'] = None
+        add(record, f"seed{i}")
+
+    mismatches, duplicates = [], 0
+    for i in range(size):
+        email = random_record(rng, pix_ids)
+        if rng.random() < 0.2:
+            # Mesmo Pix notificado por outra instituição: mesmo valor alguns segundos/minutos depois
+            base = rng.choice(legacy[email['kind']] or [email])
+            email.update(amount=base['amount'], date=(base['date'] or email['date']) + timedelta(seconds=rng.choice([-301, -299, -1, 0, 120, 299, 300])))
+        args = (email['description'], email['amount'])
+        decisions = (
+            legacy_is_duplicate(legacy[email['kind']], *args, email['date'], email['pix_id']),
+            index[email['kind']].is_duplicate(*args, email['date'].isoformat(), email['pix_id']),
+            fingerprint_duplicate(db, email['kind'], *args, email['date'].isoformat(), email['pix_id']),
+        )
+        if len(set(decisions)) > 1: mismatches.append((email, decisions))
+        elif decisions[0]: duplicates += 1
+        else: add(email, f"msg{i}")
+    return mismatches, duplicates
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Paridade da deduplicação do Pix')
+    parser.add_argument('--trials', type=int, default=200)
+    parser.add_argument('--size', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    mismatches, duplicates = [], 0
+    for _ in range(args.trials):
+        trial_mismatches, trial_duplicates = run_trial(rng, args.size)
+        mismatches.extend(trial_mismatches)
+        duplicates += trial_duplicates
+    checked = args.trials * args.size
+    print(f"{checked} decisões comparadas (varredura antiga x PixDedupIndex x finance_fingerprints), "
+          f"{duplicates} duplicata(s): {len(mismatches)} divergência(s)")
+    for email, (legacy, index, fingerprints) in mismatches[:10]:
+        print(f"  {email} -> varredura {legacy}, índice {index}, fingerprints {fingerprints}")
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
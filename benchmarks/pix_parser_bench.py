@@ -0,0 +1,73 @@
+"""
+Benchmark do parser de Pix (functions/pix_parser.py) sobre o corpus anonimizado em fixtures/.
+
+Mede a vazão (e-mails/s) e a acurácia por campo, comparando com a regex genérica antiga.
+Uso: python benchmarks/pix_parser_bench.py [--iterations 2000]
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'functions'))
+from pix_parser import parse_pix
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'pix_emails.json')
+FIELDS = ('amount', 'is_income', 'counterparty', 'pix_id')
+
+
+def legacy_parse(subject, snippet, sender=''):
+    """Regra anterior (Cloud Function), para comparação"""
+    content = f"{subject} {snippet}"
+    value_match = re.search(r'R\$\s*(\d+(?:[\.,]\d+)?)', content)
+    if not value_match: return None
+    pix_id_match = re.search(r'\b(E[A-Z0-9]{31})\b', content)
+    return {
+        'amount': float(value_match.group(1).replace('.', '').replace(',', '.')),
+        'is_income': any(word in content.lower() for word in ['recebido', 'recebeu', 'recebida', 'recebimento', 'creditado', 'entrada']),
+        'counterparty': None,
+        'pix_id': pix_id_match.group(1) if pix_id_match else None
+    }
+
+
+def accuracy(parse, corpus):
+    hits, misses = {field: 0 for field in FIELDS}, []
+    for email in corpus:
+        parsed = parse(email['subject'], email['snippet'], email['sender']) or {}
+        for field in FIELDS:
+            if parsed.get(field) == email['expected'][field]: hits[field] += 1
+            else: misses.append((field, email['subject'], parsed.get(field), email['expected'][field]))
+    return {field: hits[field] / len(corpus) for field in FIELDS}, misses
+
+
+def throughput(parse, corpus, iterations):
+    t0 = time.perf_counter()
+    for _ in range(iterations):
+        for email in corpus:
+            parse(email['subject'], email['snippet'], email['sender'])
+    return iterations * len(corpus) / (time.perf_counter() - t0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark do parser de Pix')
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--verbose', action='store_true', help='Lista os campos extraídos incorretamente')
+    args = parser.parse_args()
+    with open(FIXTURES, encoding='utf-8') as f:
+        corpus = json.load(f)
+
+    print(f"Corpus: {len(corpus)} e-mails, {args.iterations} iterações")
+    for name, parse in (('registry', parse_pix), ('legacy', legacy_parse)):
+        scores, misses = accuracy(parse, corpus)
+        rate = throughput(parse, corpus, args.iterations)
+        print(f"{name:>9}: {rate:,.0f} e-mails/s | " + " | ".join(f"{field} {score:.0%}" for field, score in scores.items()))
+        if args.verbose:
+            for field, subject, got, expected in misses:
+                print(f"           {field}: {subject!r} -> {got!r} (esperado {expected!r})")
+
+
+if __name__ == '__main__':
+    main()
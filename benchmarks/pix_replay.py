@@ -0,0 +1,367 @@
+"""
+Replay offline do pipeline do Pix (pix_sync.ingest_pix_messages) sem Gmail nem Firestore reais.
+
+Alimenta o pipeline completo (descoberta, leitura em lote, parsing, deduplicação e gravação) com
+respostas gravadas de messages.list/messages.get, ou com uma caixa sintética gerada a partir de
+fixtures/pix_emails.json, sobre um Firestore em memória. Mede e-mails/s, as decisões de
+deduplicação e as leituras/escritas por execução, para comparar antes/depois de uma mudança.
+
+Uso:
+  python benchmarks/pix_replay.py --sizes 10000,30000,100000         # caixas sintéticas
+  python benchmarks/pix_replay.py --fixture caixa.json               # respostas gravadas
+  python benchmarks/pix_replay.py --record caixa.json --limit 500    # grava da conta real (hermes_cli)
+Opções: --duplicates (fração de Pix notificados por dois bancos), --seed-finance (registros já
+existentes no Financeiro), --fingerprints (usa finance_fingerprints), --incremental (segunda execução
+com mensagens novas via history.list), --profile (cProfile das funções mais caras).
+"""
+import argparse
+import copy
+import json
+import os
+import random
+import re
+import sys
+import time
+import uuid
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(ROOT), 'functions'))
+from firestore_writer import BufferedWriter
+from sync_metrics import SyncMetrics
+from pix_sync import ingest_pix_messages, list_pix_messages, GMAIL_BATCH_SIZE, GMAIL_RATE_LIMIT_REASONS
+from pix_parser import AMOUNT_PATTERN, E2E_PATTERN
+
+TEMPLATES = os.path.join(ROOT, 'fixtures', 'pix_emails.json')
+BASE_TIME = 1769904000  # 01/02/2026 00:00 UTC
+
+
+# --- Firestore em memória (só o que o pipeline usa) ---
+
+def _merge(target, data):
+    for key, value in data.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict): _merge(target[key], value)
+        else: target[key] = copy.deepcopy(value)
+
+
+class MemorySnapshot:
+    def __init__(self, ref, data):
+        self.reference, self.id, self._data = ref, ref.id, data
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+
+class MemoryDocument:
+    def __init__(self, db, collection, doc_id):
+        self.db, self.collection, self.id = db, collection, doc_id
+        self.path = f"{collection}/{doc_id}"
+
+    def get(self):
+        self.db.reads += 1
+        return MemorySnapshot(self, self.db.data.get(self.collection, {}).get(self.id))
+
+    def set(self, data, merge=False):
+        self.db.writes += 1
+        docs = self.db.data.setdefault(self.collection, {})
+        if merge and self.id in docs: _merge(docs[self.id], data)
+        else: docs[self.id] = copy.deepcopy(data)
+
+    def update(self, data):
+        if self.id not in self.db.data.get(self.collection, {}): raise KeyError(f"Documento inexistente: {self.path}")
+        self.set(data, merge=True)
+
+    def delete(self):
+        self.db.writes += 1
+        self.db.data.get(self.collection, {}).pop(self.id, None)
+
+
+class MemoryCollection:
+    def __init__(self, db, name, fields=None):
+        self.db, self.name, self.fields = db, name, fields
+
+    def document(self, doc_id=None):
+        return MemoryDocument(self.db, self.name, doc_id or uuid.uuid4().hex[:20])
+
+    def select(self, fields):
+        return MemoryCollection(self.db, self.name, fields)
+
+    def stream(self):
+        for doc_id, data in list(self.db.data.get(self.name, {}).items()):
+            self.db.reads += 1
+            if self.fields is not None: data = {k: data[k] for k in self.fields if k in data}
+            yield MemorySnapshot(self.document(doc_id), data)
+
+
+class MemoryBatch:
+    def __init__(self):
+        self.ops = []
+
+    def set(self, ref, data, merge=False): self.ops.append(lambda: ref.set(data, merge=merge))
+    def update(self, ref, data): self.ops.append(lambda: ref.update(data))
+    def delete(self, ref): self.ops.append(ref.delete)
+
+    def commit(self):
+        for op in self.ops: op()
+
+
+class MemoryFirestore:
+    """Stand-in do firestore.Client: collection/document/get_all/batch, contando leituras e escritas"""
+
+    def __init__(self):
+        self.data, self.reads, self.writes = {}, 0, 0
+
+    def collection(self, name):
+        return MemoryCollection(self, name)
+
+    def get_all(self, refs):
+        return [ref.get() for ref in refs]
+
+    def batch(self):
+        return MemoryBatch()
+
+
+# --- Gmail a partir de respostas gravadas ---
+
+class ReplayRequest:
+    def __init__(self, service, response):
+        self.service, self.response = service, response
+
+    def execute(self):
+        self.service.calls += 1
+        return self.response
+
+
+class ReplayBatch:
+    """Um BatchHttpRequest conta como uma única chamada HTTP"""
+
+    def __init__(self, service, callback):
+        self.service, self.callback, self.requests = service, callback, []
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        self.service.calls += 1
+        for request_id, request in self.requests:
+            self.callback(request_id, request.response, None)
+
+
+class ReplayGmail:
+    """
+    Responde messages.list/get, history.list e getProfile a partir de `messages` (respostas de
+    messages.get em formato metadata). Cada mensagem recebe um historyId crescente; `deliver`
+    acrescenta mensagens novas, que aparecem no history.list da execução seguinte.
+    """
+
+    def __init__(self, messages):
+        self.by_id, self.order, self.calls = {}, [], 0
+        self._cached_search = (None, [])
+        self.deliver(messages)
+
+    def deliver(self, messages):
+        for message in messages:
+            self.by_id[message['id']] = message
+            self.order.append(message['id'])
+
+    # users() / messages() / history() devolvem o próprio serviço: os métodos têm nomes distintos
+    def users(self): return self
+    def messages(self): return self
+    def history(self): return self
+
+    def new_batch_http_request(self, callback):
+        return ReplayBatch(self, callback)
+
+    def getProfile(self, userId):
+        return ReplayRequest(self, {'historyId': str(len(self.order))})
+
+    def list(self, userId, q=None, maxResults=500, pageToken=None, startHistoryId=None, historyTypes=None):
+        start = int(pageToken or 0)
+        if startHistoryId is not None:
+            ids = self.order[int(startHistoryId):]
+            page = ids[start:start + maxResults]
+            res = {'history': [{'messagesAdded': [{'message': {'id': i}} for i in page]}], 'historyId': str(len(self.order))}
+        else:
+            # A busca já vem filtrada na gravação; só o after:<epoch> da busca incremental é aplicado
+            ids = self._search(q)
+            page = ids[start:start + maxResults]
+            res = {'messages': [{'id': i} for i in page]}
+        if start + maxResults < len(ids): res['nextPageToken'] = str(start + maxResults)
+        return ReplayRequest(self, res)
+
+    def _search(self, q):
+        # Resultado da busca calculado uma vez por consulta (as páginas seguintes reaproveitam)
+        if self._cached_search[0] != (q, len(self.order)):
+            since = re.search(r'after:(\d{9,})', q or '')
+            ids = [i for i in self.order if not since or int(self.by_id[i]['internalDate']) // 1000 > int(since.group(1))]
+            self._cached_search = ((q, len(self.order)), ids)
+        return self._cached_search[1]
+
+    def get(self, userId, id, format=None, metadataHeaders=None):
+        return ReplayRequest(self, self.by_id[id])
+
+
+# --- Caixa sintética ---
+
+def _br_amount(value):
+    whole, cents = f"{value:,.2f}".split('.')
+    return f"{whole.replace(',', '.')},{cents}"
+
+
+def _render(template, amount, pix_id):
+    text = lambda s: re.sub(E2E_PATTERN, pix_id, re.sub(AMOUNT_PATTERN, f"R$ {_br_amount(amount)}", s))
+    return template['sender'], text(template['subject']), text(template['snippet'])
+
+
+def synthetic_mailbox(size, duplicates=0.1, unparsed=0.02, seed=42):
+    """
+    `size` respostas de messages.get: Pix com valores e E2E IDs aleatórios, uma fração `duplicates`
+    notificada de novo por outro banco (até 2 min depois) e uma fração `unparsed` sem valor.
+    """
+    rng = random.Random(seed)
+    with open(TEMPLATES, encoding='utf-8') as f:
+        templates = json.load(f)
+    by_direction = {d: [t for t in templates if t['expected']['is_income'] == d] for d in (True, False)}
+    messages, ts = [], BASE_TIME
+    # Datas espalhadas entre BASE_TIME e agora (nada no futuro, senão a busca incremental as pegaria)
+    step = max(2, int((time.time() - BASE_TIME) / size))
+
+    def message(sender, subject, snippet, at):
+        headers = [{'name': 'Subject', 'value': subject}, {'name': 'From', 'value': sender}]
+        return {'id': f"{len(messages):016x}", 'internalDate': str(at * 1000), 'snippet': snippet, 'payload': {'headers': headers}}
+
+    while len(messages) < size:
+        ts += rng.randint(1, step)
+        template = rng.choice(templates)
+        if rng.random() < unparsed:
+            messages.append(message(template['sender'], template['subject'], 'Confira os detalhes no aplicativo.', ts))
+            continue
+        amount = round(rng.uniform(1, 5000), 2)
+        pix_id = f"E{rng.randrange(10**8):08d}{time.strftime('%Y%m%d%H%M', time.gmtime(ts))}{uuid.UUID(int=rng.getrandbits(128)).hex[:11].upper()}"
+        messages.append(message(*_render(template, amount, pix_id), ts))
+        if rng.random() < duplicates and len(messages) < size:
+            other = rng.choice(by_direction[template['expected']['is_income']])
+            messages.append(message(*_render(other, amount, pix_id), ts + rng.randint(0, 120)))
+    return messages
+
+
+def seed_finance(db, count, seed=7):
+    """Registros pré-existentes no Financeiro (o que a deduplicação precisa consultar)"""
+    rng = random.Random(seed)
+    for i in range(count):
+        collection = 'finance_income' if i % 3 == 0 else 'finance_transactions'
+        ts = BASE_TIME - rng.randint(0, 365 * 86400)
+        db.collection(collection).document().set({
+            'description': f"Registro {i}", 'amount': round(rng.uniform(1, 5000), 2),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S+00:00', time.gmtime(ts)), 'status': 'active'
+        })
+
+
+# --- Execução ---
+
+def replay(messages, seed_records=0, fingerprints=False, incremental=0, profile=False, verbose=False):
+    """Roda o pipeline sobre a caixa; com `incremental`, entrega mais N mensagens e roda de novo"""
+    db, initial = MemoryFirestore(), messages[:len(messages) - incremental]
+    seed_finance(db, seed_records)
+    if fingerprints:
+        from finance_fingerprints import backfill_fingerprints
+        backfill_fingerprints(db, BufferedWriter(db, print), log=lambda msg: None)
+    db.reads = db.writes = 0
+    gmail = ReplayGmail(initial)
+    log = print if verbose else (lambda msg: None)
+    results = []
+    for label, delivered in (('completa', None), ('incremental', messages[len(initial):])):
+        if delivered is not None:
+            if not incremental: break
+            # Mensagens novas chegam "agora": a busca incremental filtra por after:<epoch>
+            now_ms = str(int(time.time() * 1000))
+            gmail.deliver([{**message, 'internalDate': now_ms} for message in delivered])
+        decisions = {}
+        metrics = SyncMetrics('replay').activate()
+        reads, writes, calls = db.reads, db.writes, gmail.calls
+        profiler = None
+        if profile:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+        t0 = time.perf_counter()
+        with metrics.stage('pix'):
+            stats = ingest_pix_messages(db, gmail, BufferedWriter(db, log), log,
+                                        on_decision=lambda msg_id, decision: decisions.__setitem__(msg_id, decision))
+        elapsed = time.perf_counter() - t0
+        if profiler:
+            import pstats
+            profiler.disable()
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(15)
+        results.append({
+            'run': label, 'messages': len(gmail.order), 'seconds': elapsed,
+            'rate': stats['candidates'] / elapsed if elapsed else 0, **stats,
+            'gmail_calls': gmail.calls - calls, 'reads': db.reads - reads, 'writes': db.writes - writes
+        })
+    return results
+
+
+def record_mailbox(path, limit):
+    """Grava as respostas reais de messages.list/messages.get (formato metadata) em `path`"""
+    sys.path.insert(0, os.path.dirname(ROOT))
+    from hermes_cli import get_gmail_service
+    from google_batch import execute_batch
+    service = get_gmail_service()
+    ids = list_pix_messages(service)[:limit]
+    messages = {}
+
+    def on_result(msg_id, response, error):
+        if error: print(f"Erro ao ler mensagem {msg_id}: {error}")
+        else: messages[msg_id] = response
+
+    execute_batch(service, [
+        (msg_id, lambda msg_id=msg_id: service.users().messages().get(
+            userId='me', id=msg_id, format='metadata', metadataHeaders=['Subject', 'From']))
+        for msg_id in ids
+    ], on_result, GMAIL_BATCH_SIZE, retry_reasons=GMAIL_RATE_LIMIT_REASONS)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'list': ids, 'messages': messages}, f, ensure_ascii=False)
+    print(f"{len(messages)} mensagem(ns) gravada(s) em {path}")
+
+
+def load_mailbox(path):
+    with open(path, encoding='utf-8') as f:
+        recorded = json.load(f)
+    # messages.list devolve do mais recente ao mais antigo; o replay entrega em ordem cronológica
+    return [recorded['messages'][msg_id] for msg_id in reversed(recorded['list']) if msg_id in recorded['messages']]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay offline do pipeline do Pix')
+    parser.add_argument('--sizes', default='10000', help='Tamanhos das caixas sintéticas, separados por vírgula')
+    parser.add_argument('--fixture', help='Arquivo com respostas gravadas (--record)')
+    parser.add_argument('--record', help='Grava a caixa real neste arquivo e sai')
+    parser.add_argument('--limit', type=int, default=1000, help='Máximo de mensagens gravadas com --record')
+    parser.add_argument('--duplicates', type=float, default=0.1)
+    parser.add_argument('--seed-finance', type=int, default=0)
+    parser.add_argument('--fingerprints', action='store_true')
+    parser.add_argument('--incremental', type=int, default=0, help='Mensagens novas entregues antes da segunda execução')
+    parser.add_argument('--profile', action='store_true')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    if args.record:
+        record_mailbox(args.record, args.limit)
+        return
+    mailboxes = [(args.fixture, load_mailbox(args.fixture))] if args.fixture else [
+        (f"sintética {size}", synthetic_mailbox(size, args.duplicates)) for size in map(int, args.sizes.split(','))
+    ]
+
+    print(f"{'caixa':>18} {'execução':>11} {'e-mails/s':>10} {'seg':>7} {'lidas':>7} {'criados':>8} "
+          f"{'dupl.':>7} {'s/valor':>7} {'gmail':>6} {'reads':>8} {'writes':>8}")
+    for name, messages in mailboxes:
+        for r in replay(messages, args.seed_finance, args.fingerprints, args.incremental, args.profile, args.verbose):
+            print(f"{name:>18} {r['run']:>11} {r['rate']:>10,.0f} {r['seconds']:>7.2f} {r['fetched']:>7} {r['created']:>8} "
+                  f"{r['duplicates']:>7} {r['unparsed']:>7} {r['gmail_calls']:>6} {r['reads']:>8} {r['writes']:>8}")
+
+
+if __name__ == '__main__':
+    main()
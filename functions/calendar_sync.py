@@ -0,0 +1,169 @@
+"""
+Sincronização incremental do Google Calendar com 'google_calendar_events'.
+
+A primeira execução (e uma a cada CALENDAR_FULL_RESYNC_HOURS) lista a janela inteira,
+paginando; as demais usam o `nextSyncToken` salvo em system/sync_state e aplicam só os
+eventos alterados ou cancelados, filtrados pela mesma janela. Um 410 Gone (token expirado) cai de volta na listagem completa.
+O índice compacto em system/calendar_index (id -> etag, início) evita regravar eventos cujo etag
+não mudou e permite calcular exclusões sem consultar a coleção.
+"""
+from sync_state import get_sync_state, set_sync_state
+from sync_metrics import record
+
+CALENDAR_PAST_DAYS = 7
+CALENDAR_FUTURE_DAYS = 30
+# A janela é fixada na listagem completa; refazê-la periodicamente a desloca para frente
+CALENDAR_FULL_RESYNC_HOURS = 24
+
+
+def calendar_window():
+    from datetime import datetime, timedelta, timezone
+    now = datetime.now(timezone.utc)
+    time_min = (now - timedelta(days=CALENDAR_PAST_DAYS)).isoformat().replace('+00:00', 'Z')
+    time_max = (now + timedelta(days=CALENDAR_FUTURE_DAYS)).isoformat().replace('+00:00', 'Z')
+    return time_min, time_max
+
+
+def list_calendar_events(service, sync_token=None, time_min=None, time_max=None):
+    """
+    Percorre todas as páginas de events().list e devolve (eventos, nextSyncToken).
+    Com `sync_token` o Google devolve só o que mudou (inclusive cancelados); sem ele, a janela
+    [time_min, time_max]. orderBy não é usado: é incompatível com o syncToken.
+    """
+    events, page_token = [], None
+    while True:
+        params = {'calendarId': 'primary', 'singleEvents': True, 'maxResults': 250, 'pageToken': page_token}
+        if sync_token: params['syncToken'] = sync_token
+        else: params.update({'timeMin': time_min, 'timeMax': time_max})
+        res = service.events().list(**params).execute()
+        record('google_pages')
+        events.extend(res.get('items', []))
+        page_token = res.get('nextPageToken')
+        if not page_token:
+            return events, res.get('nextSyncToken')
+
+
+CALENDAR_INDEX_DOC = 'calendar_index'
+
+
+def load_calendar_index(db):
+    """Índice id -> {'etag', 'inicio'} dos eventos da janela; None se ainda não existe"""
+    doc = db.collection('system').document(CALENDAR_INDEX_DOC).get()
+    record('firestore_reads')
+    return (doc.to_dict() or {}).get('events', {}) if doc.exists else None
+
+
+def event_doc(event):
+    from datetime import datetime
+    return {
+        'google_id': event['id'],
+        'etag': event.get('etag'),
+        'titulo': event.get('summary', '(Sem título)'),
+        'data_inicio': event['start'].get('dateTime', event['start'].get('date')),
+        'data_fim': event['end'].get('dateTime', event['end'].get('date')),
+        'last_sync': datetime.now().isoformat()
+    }
+
+
+def full_resync_due(last_full):
+    from datetime import datetime, timedelta
+    if not last_full: return True
+    try:
+        return datetime.now() - datetime.fromisoformat(last_full) > timedelta(hours=CALENDAR_FULL_RESYNC_HOURS)
+    except ValueError:
+        return True
+
+
+def sync_calendar_events(db, service, writer, log, full_resync=False):
+    """
+    Aplica as mudanças do Calendar via `writer` (BufferedWriter) e retorna (gravados, removidos).
+    O novo token só é salvo se todas as escritas forem confirmadas.
+    """
+    from datetime import datetime
+    from googleapiclient.errors import HttpError
+    collection = db.collection('google_calendar_events')
+    sync_token = None
+    if not full_resync and not full_resync_due(get_sync_state(db, 'calendar_full_sync_at')):
+        sync_token = get_sync_state(db, 'calendar_sync_token')
+
+    events = None
+    if sync_token:
+        try:
+            events, next_token = list_calendar_events(service, sync_token=sync_token)
+            log(f"[CAL] Incremental: {len(events)} evento(s) alterado(s).")
+        except HttpError as e:
+            if e.resp.status != 410: raise
+            log("[CAL] Token de sincronização expirado (410): refazendo listagem completa.")
+
+    index = load_calendar_index(db)
+    new_index = dict(index or {})
+    written = deleted = 0
+
+    def apply(event):
+        # Só grava eventos novos ou com etag diferente do índice
+        nonlocal written
+        entry = {'etag': event.get('etag'), 'inicio': event['start'].get('dateTime', event['start'].get('date'))}
+        if (index or {}).get(event['id'], {}).get('etag') != entry['etag'] or not entry['etag']:
+            writer.set(collection.document(event['id']), event_doc(event), merge=True)
+            written += 1
+        new_index[event['id']] = entry
+
+    full_listing = events is None
+    time_min, time_max = calendar_window()
+    if not full_listing:
+        for event in events:
+            if event.get('status') == 'cancelled':
+                writer.delete(collection.document(event['id']))
+                new_index.pop(event['id'], None)
+                deleted += 1
+                continue
+            inicio = event['start'].get('dateTime', event['start'].get('date'))
+            if inicio and time_min <= inicio <= time_max:
+                apply(event)
+                continue
+            # O syncToken não respeita a janela: fora dela, o evento não é gravado e sai do índice como
+            # na listagem completa (apagado se estava na janela; se já tinha saído dela, fica como histórico)
+            previous = (new_index.pop(event['id'], None) or {}).get('inicio')
+            if previous and time_min <= previous <= time_max:
+                writer.delete(collection.document(event['id']))
+                deleted += 1
+    else:
+        events, next_token = list_calendar_events(service, time_min=time_min, time_max=time_max)
+        log(f"[CAL] Listagem completa: {len(events)} evento(s) na janela.")
+        seen_ids = set()
+        for event in events:
+            if event.get('status') == 'cancelled': continue
+            seen_ids.add(event['id'])
+            apply(event)
+
+        # Limpeza de eventos deletados no Google Calendar, calculada a partir do índice.
+        # Sem índice (primeira execução), consulta só o período sincronizado na coleção.
+        if index is not None:
+            stale = {event_id: entry.get('inicio') for event_id, entry in index.items() if event_id not in seen_ids}
+        else:
+            docs = collection.where('data_inicio', '>=', time_min).where('data_inicio', '<=', time_max).stream()
+            stale = {}
+            for doc in docs:
+                record('firestore_reads')
+                if doc.id not in seen_ids: stale[doc.id] = doc.to_dict().get('data_inicio')
+        for event_id, inicio in stale.items():
+            new_index.pop(event_id, None)
+            # Eventos que apenas saíram da janela ficam como histórico
+            if inicio and time_min <= inicio <= time_max:
+                writer.delete(collection.document(event_id))
+                deleted += 1
+
+    record('updated', written)
+    record('deleted', deleted)
+    failures = writer.flush()
+    # Eventos com escrita falha saem do índice para serem regravados na próxima execução
+    for _, path, _ in failures:
+        new_index.pop(path.rsplit('/', 1)[-1], None)
+    if new_index != index:
+        db.collection('system').document(CALENDAR_INDEX_DOC).set({'events': new_index})
+        record('firestore_writes')
+    if not failures and next_token:
+        set_sync_state(db, 'calendar_sync_token', next_token)
+        if full_listing:
+            set_sync_state(db, 'calendar_full_sync_at', datetime.now().isoformat())
+    return written, deleted
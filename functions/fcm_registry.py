@@ -0,0 +1,89 @@
+"""Tokens FCM espelhados em system/fcm_registry (uma leitura por notificação) e envio de push em blocos."""
+from sync_metrics import record
+
+FCM_REGISTRY_DOC = 'fcm_registry'
+# Limite de tokens por MulticastMessage
+FCM_MULTICAST_LIMIT = 500
+FCM_MAX_WORKERS = 4
+
+
+def get_registry_ref(db):
+    return db.collection('system').document(FCM_REGISTRY_DOC)
+
+
+def register_token(db, token, last_updated=None):
+    get_registry_ref(db).set({'tokens': {token: last_updated}}, merge=True)
+    record('firestore_writes')
+
+
+def unregister_tokens(db, tokens):
+    from google.cloud.firestore import DELETE_FIELD
+    if not tokens: return
+    get_registry_ref(db).set({'tokens': {token: DELETE_FIELD for token in tokens}}, merge=True)
+    record('firestore_writes')
+
+
+def rebuild_registry(db):
+    """
+    Reconstrói o registro a partir de 'fcm_tokens' (primeira execução ou registro perdido).
+    `bootstrapped` marca que o mapa já contém os tokens anteriores ao registro; sem ele, o documento
+    criado por um register_token/unregister_tokens isolado ainda não vale como lista completa.
+    """
+    tokens = {}
+    for doc in db.collection('fcm_tokens').stream():
+        record('firestore_reads')
+        if doc.id: tokens[doc.id] = (doc.to_dict() or {}).get('last_updated')
+    get_registry_ref(db).set({'tokens': tokens, 'bootstrapped': True})
+    record('firestore_writes')
+    return list(tokens)
+
+
+def load_tokens(db):
+    """Tokens registrados: uma leitura do registro (varre a coleção só se o registro ainda não foi montado)"""
+    doc = get_registry_ref(db).get()
+    record('firestore_reads')
+    data = doc.to_dict() if doc.exists else None
+    if not data or not data.get('bootstrapped'):
+        return rebuild_registry(db)
+    return [token for token in data.get('tokens', {}) if token]
+
+
+def is_dead_token(exception):
+    from firebase_admin import messaging
+    return isinstance(exception, messaging.UnregisteredError) or (
+        exception is not None and "registration-token-not-registered" in str(exception).lower())
+
+
+def send_push(tokens, data, max_workers=FCM_MAX_WORKERS):
+    """
+    Envia `data` a todos os `tokens` em blocos de FCM_MULTICAST_LIMIT, em paralelo.
+    Retorna (sucessos, falhas, tokens mortos).
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from firebase_admin import messaging
+    chunks = [tokens[i:i + FCM_MULTICAST_LIMIT] for i in range(0, len(tokens), FCM_MULTICAST_LIMIT)]
+
+    def send(chunk):
+        response = messaging.send_each_for_multicast(messaging.MulticastMessage(data=data, tokens=chunk))
+        dead = [chunk[idx] for idx, resp in enumerate(response.responses) if not resp.success and is_dead_token(resp.exception)]
+        return response.success_count, response.failure_count, dead
+
+    success = failure = 0
+    dead_tokens = []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(chunks)) or 1) as pool:
+        for ok, failed, dead in pool.map(send, chunks):
+            success, failure = success + ok, failure + failed
+            dead_tokens.extend(dead)
+    return success, failure, dead_tokens
+
+
+def prune_tokens(db, tokens, log=print):
+    """Remove os tokens mortos de 'fcm_tokens' (em lote) e do registro (uma escrita)"""
+    from firestore_writer import BufferedWriter
+    if not tokens: return
+    writer = BufferedWriter(db, log)
+    for token in tokens:
+        writer.delete(db.collection('fcm_tokens').document(token))
+    writer.flush()
+    unregister_tokens(db, tokens)
+    log(f"{len(tokens)} token(s) FCM inválido(s) removido(s).")
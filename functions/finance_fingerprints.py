@@ -0,0 +1,116 @@
+"""
+Impressões digitais persistentes dos registros do Financeiro, usadas na deduplicação do Pix.
+
+Cada registro de 'finance_income'/'finance_transactions' gera documentos em 'finance_fingerprints':
+  pix_{tipo}_{pix_id}                   -> mesmo E2E ID
+  desc_{tipo}_{hash(descrição|valor)}   -> mesma descrição e valor
+  amt_{tipo}_{valor}_{minuto}           -> mesmo valor no mesmo minuto (a janela de 5 min consulta os vizinhos)
+  msg_{google_message_id}               -> e-mail já importado
+Todos têm a forma {'entries': {doc_id: timestamp}}. Assim um e-mail novo é verificado com
+um único get_all das chaves com que pode colidir, sem ler as coleções financeiras.
+"""
+from sync_metrics import record
+from pix_sync import to_epoch, DUPLICATE_WINDOW_SECONDS, GET_ALL_CHUNK
+
+FINGERPRINTS_COLLECTION = 'finance_fingerprints'
+FINANCE_KINDS = {'finance_income': 'income', 'finance_transactions': 'expense'}
+FINGERPRINT_FIELDS = ['description', 'amount', 'date', 'pix_id', 'google_message_id']
+
+
+def _amount_key(amount):
+    return f"{float(amount):.2f}"
+
+
+def _description_key(kind, description, amount):
+    import hashlib
+    digest = hashlib.sha1(f"{description}|{_amount_key(amount)}".encode('utf-8')).hexdigest()[:24]
+    return f"desc_{kind}_{digest}"
+
+
+def fingerprint_keys(collection_name, data):
+    """Chaves (ids em finance_fingerprints) de um registro, com o timestamp guardado em cada uma"""
+    kind, amount = FINANCE_KINDS[collection_name], data.get('amount')
+    ts = to_epoch(data.get('date'))
+    keys = {}
+    if isinstance(amount, (int, float)): keys[_description_key(kind, data.get('description'), amount)] = ts
+    else: amount = None
+    if data.get('pix_id'): keys[f"pix_{kind}_{data['pix_id']}"] = ts
+    if ts is not None and amount is not None: keys[f"amt_{kind}_{_amount_key(amount)}_{int(ts // 60)}"] = ts
+    if data.get('google_message_id'): keys[f"msg_{data['google_message_id']}"] = ts
+    return keys
+
+
+def add_fingerprints(writer, db, collection_name, doc_id, data):
+    """Enfileira no `writer` (mesmo lote do registro) as impressões digitais do registro"""
+    collection = db.collection(FINGERPRINTS_COLLECTION)
+    for key, ts in fingerprint_keys(collection_name, data).items():
+        writer.set(collection.document(key), {'entries': {doc_id: ts}}, merge=True)
+
+
+def remove_fingerprints(writer, db, collection_name, doc_id, data):
+    from google.cloud.firestore import DELETE_FIELD
+    collection = db.collection(FINGERPRINTS_COLLECTION)
+    for key in fingerprint_keys(collection_name, data):
+        writer.set(collection.document(key), {'entries': {doc_id: DELETE_FIELD}}, merge=True)
+
+
+def candidate_keys(collection_name, description, amount, date, pix_id=None):
+    """Chaves com que um registro novo pode colidir: pix_id, descrição+valor e os minutos da janela"""
+    kind = FINANCE_KINDS[collection_name]
+    keys = [_description_key(kind, description, amount)]
+    if pix_id: keys.append(f"pix_{kind}_{pix_id}")
+    ts = to_epoch(date)
+    if ts is not None:
+        first, last = int((ts - DUPLICATE_WINDOW_SECONDS) // 60), int((ts + DUPLICATE_WINDOW_SECONDS) // 60)
+        keys.extend(f"amt_{kind}_{_amount_key(amount)}_{minute}" for minute in range(first, last + 1))
+    return keys
+
+
+def is_duplicate(db, collection_name, description, amount, date, pix_id=None):
+    """Consulta só as chaves candidatas (um get_all) com as mesmas três regras da varredura completa"""
+    collection = db.collection(FINGERPRINTS_COLLECTION)
+    ts = to_epoch(date)
+    keys = candidate_keys(collection_name, description, amount, date, pix_id)
+    for doc in db.get_all([collection.document(key) for key in keys]):
+        record('firestore_reads')
+        if not doc.exists: continue
+        entries = (doc.to_dict() or {}).get('entries') or {}
+        if not entries: continue
+        if not doc.id.startswith('amt_'): return True
+        # Bucket de minuto: confere a distância exata de cada registro
+        if ts is not None and any(t is not None and abs(t - ts) < DUPLICATE_WINDOW_SECONDS for t in entries.values()):
+            return True
+    return False
+
+
+def imported_message_ids(db, msg_ids):
+    """Dos `msg_ids`, os que já geraram registro no Financeiro (get_all em blocos, sem ler as coleções)"""
+    collection = db.collection(FINGERPRINTS_COLLECTION)
+    imported = set()
+    for i in range(0, len(msg_ids), GET_ALL_CHUNK):
+        for doc in db.get_all([collection.document(f"msg_{msg_id}") for msg_id in msg_ids[i:i + GET_ALL_CHUNK]]):
+            record('firestore_reads')
+            if doc.exists and (doc.to_dict() or {}).get('entries'): imported.add(doc.id[len('msg_'):])
+    return imported
+
+
+def fingerprints_ready(db):
+    from sync_state import get_sync_state
+    return bool(get_sync_state(db, 'finance_fingerprints_ready'))
+
+
+def backfill_fingerprints(db, writer, log=print):
+    """Reconstrói 'finance_fingerprints' a partir dos registros existentes (comando backfill-fingerprints)"""
+    from sync_state import set_sync_state
+    total = 0
+    for collection_name in FINANCE_KINDS:
+        for doc in db.collection(collection_name).select(FINGERPRINT_FIELDS).stream():
+            record('firestore_reads')
+            add_fingerprints(writer, db, collection_name, doc.id, doc.to_dict())
+            total += 1
+    failures = writer.flush()
+    if not failures:
+        # A sync do Pix só passa a confiar no índice persistente depois do backfill completo
+        set_sync_state(db, 'finance_fingerprints_ready', True)
+    log(f"[PIX] Impressões digitais geradas para {total} registro(s). {len(failures)} falha(s).")
+    return total
@@ -0,0 +1,78 @@
+"""Camada de escrita em lote do Firestore usada pelas etapas de sincronização."""
+from sync_metrics import record
+
+# Limite de operações por WriteBatch do Firestore
+MAX_BATCH_OPS = 500
+
+
+class BufferedWriter:
+    """
+    Acumula set/update/delete/create e os envia em WriteBatches de até 500 operações.
+    Se um lote falhar, as operações dele são reenviadas uma a uma para identificar
+    exatamente quais falharam (ficam em `failures` e são registradas via `log`).
+    """
+
+    def __init__(self, db, log=None, max_batch_ops=MAX_BATCH_OPS):
+        self.db = db
+        self.log = log or print
+        self.max_batch_ops = max_batch_ops
+        self.pending = []
+        self.failures = []
+        self.written = 0
+
+    def set(self, ref, data, merge=False):
+        self._append(('set', ref, data, merge))
+
+    def update(self, ref, data):
+        self._append(('update', ref, data, None))
+
+    def delete(self, ref):
+        self._append(('delete', ref, None, None))
+
+    def create(self, collection_ref, data):
+        """Equivalente ao .add(): gera o ID no cliente e devolve a referência do novo documento"""
+        ref = collection_ref.document()
+        self._append(('set', ref, data, False))
+        return ref
+
+    def _append(self, op):
+        self.pending.append(op)
+        if len(self.pending) >= self.max_batch_ops:
+            self.flush()
+
+    @staticmethod
+    def _apply(target, op):
+        kind, ref, data, merge = op
+        if kind == 'set': target.set(ref, data, merge=merge)
+        elif kind == 'update': target.update(ref, data)
+        else: target.delete(ref)
+
+    def _commit_one(self, op):
+        kind, ref, data, merge = op
+        try:
+            if kind == 'set': ref.set(data, merge=merge)
+            elif kind == 'update': ref.update(data)
+            else: ref.delete()
+            self.written += 1
+            record('firestore_writes')
+        except Exception as e:
+            self.failures.append((kind, ref.path, e))
+            self.log(f"ERRO ESCRITA ({kind} {ref.path}): {e}")
+
+    def flush(self):
+        """Envia tudo o que está pendente. Retorna a lista acumulada de falhas (tipo, caminho, erro)."""
+        while self.pending:
+            chunk, self.pending = self.pending[:self.max_batch_ops], self.pending[self.max_batch_ops:]
+            batch = self.db.batch()
+            for op in chunk:
+                self._apply(batch, op)
+            try:
+                batch.commit()
+                self.written += len(chunk)
+                record('firestore_writes', len(chunk))
+                record('firestore_batches')
+            except Exception:
+                # O lote é atômico: reenvia individualmente para isolar as operações com problema
+                for op in chunk:
+                    self._commit_one(op)
+        return self.failures
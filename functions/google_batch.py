@@ -0,0 +1,58 @@
+"""Requisições às APIs do Google em lotes HTTP (BatchHttpRequest), repetindo as falhas transitórias."""
+from sync_metrics import record
+
+BATCH_MAX_ATTEMPTS = 3
+# Limite de taxa e erros do servidor
+RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+
+
+def error_reasons(exception):
+    """Motivos (`reason`) do corpo JSON de um HttpError, ex.: {'userRateLimitExceeded'}"""
+    import json
+    try:
+        errors = json.loads(exception.content.decode('utf-8')).get('error', {}).get('errors', [])
+    except (AttributeError, UnicodeDecodeError, ValueError):
+        return set()
+    return {error.get('reason') for error in errors if isinstance(error, dict)}
+
+
+def is_retryable(exception, statuses=RETRYABLE_STATUS, reasons=()):
+    """Falha transitória: erro de rede, status em `statuses` ou um 403 com motivo em `reasons`"""
+    from googleapiclient.errors import HttpError
+    if not isinstance(exception, HttpError): return True
+    if exception.resp.status in statuses: return True
+    return exception.resp.status == 403 and bool(error_reasons(exception) & set(reasons))
+
+
+def execute_batch(service, requests, on_result, batch_size, max_attempts=BATCH_MAX_ATTEMPTS,
+                  retry_statuses=RETRYABLE_STATUS, retry_reasons=()):
+    """
+    Executa as requisições em lotes HTTP de até `batch_size`. `requests` é uma lista de (chave, fábrica)
+    onde fábrica() devolve o HttpRequest; on_result(chave, resposta, erro) é chamado uma vez por chave.
+    Falhas transitórias (is_retryable) são repetidas em um novo lote com backoff.
+    """
+    import time
+    factories = dict(requests)
+    pending = [key for key, _ in requests]
+    for attempt in range(1, max_attempts + 1):
+        retry = []
+
+        def callback(key, response, exception):
+            if exception is None:
+                on_result(key, response, None)
+            elif attempt < max_attempts and is_retryable(exception, retry_statuses, retry_reasons):
+                retry.append(key)
+            else:
+                on_result(key, None, exception)
+
+        for i in range(0, len(pending), batch_size):
+            batch = service.new_batch_http_request(callback=callback)
+            for key in pending[i:i + batch_size]:
+                batch.add(factories[key](), request_id=key)
+            batch.execute()
+            record('google_api_calls')
+            record('google_batched_requests', len(pending[i:i + batch_size]))
+
+        if not retry: return
+        pending = retry
+        time.sleep(2 ** attempt)
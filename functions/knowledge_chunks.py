@@ -0,0 +1,141 @@
+"""
+Vetorização em trechos (chunks) dos documentos dos processos em 'processos_conhecimento'.
+
+O texto extraído pelo Gemini de cada arquivo (PDFs longos do SEI/SIPAC) era enviado inteiro ao
+embed_content como um único vetor — truncado pelo modelo ou diluído demais para a busca. Agora o
+texto é dividido em trechos de até CHUNK_CHARS caracteres, com CHUNK_OVERLAP de sobreposição,
+quebrando de preferência em parágrafos, depois em frases e por fim em espaços. Os trechos são
+vetorizados em chamadas em lote (até EMBED_BATCH_SIZE por requisição) e cada um vira um documento
+`{file_id}_{índice}` com `start`/`end` (posições no texto original), o que torna o reprocessamento
+idempotente. Documentos antigos (um vetor por arquivo) são convertidos pelo `reembed-knowledge`.
+"""
+from sync_metrics import record
+
+KNOWLEDGE_COLLECTION = 'processos_conhecimento'
+EMBED_MODEL = 'models/text-embedding-004'
+# ~500 tokens por trecho (≈4 caracteres por token em português), bem abaixo do limite do modelo
+CHUNK_CHARS = 2000
+CHUNK_OVERLAP = 200
+# Limite de conteúdos por batchEmbedContents
+EMBED_BATCH_SIZE = 100
+# Separadores preferidos para o fim de um trecho, do mais forte ao mais fraco
+BREAKS = ('\n\n', '\n', '. ', ' ')
+
+
+def configure_gemini(db):
+    """Configura o google.generativeai com a chave de system/api_keys; False se não houver chave"""
+    import google.generativeai as genai
+    keys_doc = db.collection('system').document('api_keys').get()
+    record('firestore_reads')
+    api_key = keys_doc.to_dict().get('gemini_api_key') if keys_doc.exists else None
+    if not api_key: return False
+    genai.configure(api_key=api_key)
+    return True
+
+
+def chunk_text(text, size=CHUNK_CHARS, overlap=CHUNK_OVERLAP):
+    """
+    Divide `text` em trechos [(start, end, trecho)] de até `size` caracteres. O fim de cada trecho
+    cai no separador mais forte da segunda metade da janela; o seguinte recomeça `overlap`
+    caracteres antes, alinhado ao início de uma palavra.
+    """
+    chunks = []
+    start, length = 0, len(text or '')
+    while start < length:
+        end = min(start + size, length)
+        if end < length:
+            for separator in BREAKS:
+                cut = text.rfind(separator, start + size // 2, end)
+                if cut != -1:
+                    end = cut + len(separator)
+                    break
+        piece = text[start:end]
+        if piece.strip():
+            # Offsets apontam para o trecho sem os espaços das bordas
+            lead = len(piece) - len(piece.lstrip())
+            chunks.append((start + lead, start + len(piece.rstrip()), piece.strip()))
+        if end >= length: break
+        following = max(end - overlap, start + 1)
+        space = text.find(' ', following, end)
+        start = space + 1 if space != -1 else following
+    return chunks
+
+
+def embed_texts(texts, batch_size=EMBED_BATCH_SIZE):
+    """Vetores de `texts` (retrieval_document), uma chamada de API por bloco de `batch_size`"""
+    import google.generativeai as genai
+    vectors = []
+    for i in range(0, len(texts), batch_size):
+        response = genai.embed_content(model=EMBED_MODEL, content=texts[i:i + batch_size], task_type="retrieval_document")
+        record('gemini_embed_calls')
+        vectors.extend(response['embedding'])
+    return vectors
+
+
+def chunk_docs(base, text):
+    """Documentos de cada trecho do arquivo em `base` ({task_id, file_id, nome}), por id"""
+    from google.cloud import firestore
+    chunks = chunk_text(text)
+    return {
+        f"{base['file_id']}_{idx:04d}": {
+            **base, 'texto': piece, 'chunk_index': idx, 'chunk_count': len(chunks), 'start': start, 'end': end,
+            'data_vetorizacao': firestore.SERVER_TIMESTAMP
+        }
+        for idx, (start, end, piece) in enumerate(chunks)
+    }
+
+
+def store_chunked(db, writer, files):
+    """
+    Vetoriza e grava os trechos de vários arquivos [(base, texto)]: os trechos de todos os arquivos
+    compartilham as chamadas em lote do embed. Retorna o número de trechos gravados.
+    """
+    docs = {}
+    for base, text in files:
+        docs.update(chunk_docs(base, text))
+    ids = list(docs)
+    vectors = embed_texts([docs[doc_id]['texto'] for doc_id in ids])
+    collection = db.collection(KNOWLEDGE_COLLECTION)
+    for doc_id, vector in zip(ids, vectors):
+        writer.set(collection.document(doc_id), {**docs[doc_id], 'embedding': vector})
+    return len(ids)
+
+
+def is_vectorized(db, file_id):
+    """Se o arquivo já tem documentos em 'processos_conhecimento' (uma leitura)"""
+    docs = db.collection(KNOWLEDGE_COLLECTION).where('file_id', '==', file_id).limit(1).get()
+    record('firestore_reads')
+    return bool(docs)
+
+
+def reembed_knowledge(db, writer, log=print, files_per_round=20):
+    """
+    Converte os documentos antigos (um vetor por arquivo, sem `chunk_index`) para trechos: grava os
+    novos documentos e apaga o antigo. Os arquivos são processados em rodadas de `files_per_round`
+    para agrupar os embeds sem acumular a coleção inteira. Retorna (arquivos, trechos).
+    """
+    collection = db.collection(KNOWLEDGE_COLLECTION)
+    legacy = []
+    for doc in collection.stream():
+        record('firestore_reads')
+        data = doc.to_dict() or {}
+        if 'chunk_index' not in data and data.get('texto') and data.get('file_id'): legacy.append((doc.reference, data))
+
+    files = chunks = 0
+    for i in range(0, len(legacy), files_per_round):
+        batch = legacy[i:i + files_per_round]
+        try:
+            chunks += store_chunked(db, writer, [
+                ({'task_id': data.get('task_id'), 'file_id': data['file_id'], 'nome': data.get('nome')}, data['texto'])
+                for _, data in batch
+            ])
+        except Exception as e:
+            log(f"ERRO ao revetorizar {len(batch)} arquivo(s): {e}")
+            continue
+        for ref, _ in batch:
+            writer.delete(ref)
+        files += len(batch)
+        writer.flush()
+    failures = writer.flush()
+    log(f"Conhecimento: {files} arquivo(s) convertido(s) em {chunks} trecho(s). {len(failures)} falha(s).")
+    return files, chunks
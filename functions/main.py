@@ -1,6 +1,10 @@
 
+import threading
+from contextlib import contextmanager
 from firebase_functions import firestore_fn, scheduler_fn, options, https_fn, pubsub_fn
-from firebase_admin import initialize_app, firestore, messaging
+from firebase_admin import initialize_app, firestore
+from sync_metrics import tracked, record, counting_request_builder
+from task_merge import extract_time_from_notes, default_end
 
 # Inicializa o Firebase Admin apenas uma vez no escopo global
 initialize_app()
@@ -35,35 +39,25 @@ def get_google_creds():
 
 def get_tasks_service():
     from googleapiclient.discovery import build
-    return build('tasks', 'v1', credentials=get_google_creds())
+    return build('tasks', 'v1', credentials=get_google_creds(), requestBuilder=counting_request_builder)
 
 def get_gmail_service():
     from googleapiclient.discovery import build
-    return build('gmail', 'v1', credentials=get_google_creds())
+    return build('gmail', 'v1', credentials=get_google_creds(), requestBuilder=counting_request_builder)
 
 def get_calendar_service():
     from googleapiclient.discovery import build
-    return build('calendar', 'v3', credentials=get_google_creds())
+    return build('calendar', 'v3', credentials=get_google_creds(), requestBuilder=counting_request_builder)
 
 def get_drive_service():
     from googleapiclient.discovery import build
     return build('drive', 'v3', credentials=get_google_creds())
 
 def emit_notification_backend(title, message, n_type='info', link=None):
-    from datetime import datetime
-    import uuid
+    from notification_buffer import notification_doc
     db = get_db()
-    notif_id = str(uuid.uuid4())[:9]
-    db.collection('notificacoes').document(notif_id).set({
-        'id': notif_id,
-        'title': title,
-        'message': message,
-        'type': n_type,
-        'timestamp': datetime.now().isoformat(),
-        'isRead': False,
-        'link': link,
-        'sent_to_push': False
-    })
+    notif_id, data = notification_doc(title, message, n_type, link)
+    db.collection('notificacoes').document(notif_id).set(data)
 
 def log_to_firestore(sync_ref, logs, message, force_update=False):
     from datetime import datetime
@@ -72,12 +66,37 @@ def log_to_firestore(sync_ref, logs, message, force_update=False):
     logs.append(log_entry)
     print(log_entry)
     if force_update:
-        sync_ref.update({'logs': logs})
+        # Páginas append-only em sync_runs/{runId}/logs; system/sync não é reescrito por linha de log
+        from sync_runner import flush_logs
+        flush_logs(logs)
+
+    # Erros e Pix viram uma notificação-resumo por tipo no fim da execução ou da notification_window do
+    # handler; fora das duas, saem na hora
+    notifications = getattr(getattr(logs, 'run_logs', None), 'notifications', None) or getattr(_invocation, 'notifications', None)
+    if notifications is None:
+        from notification_buffer import NotificationAggregator
+        notifications = NotificationAggregator(emit_notification_backend)
+        notifications.add_log(message)
+        notifications.flush()
+    else:
+        notifications.add_log(message)
 
-    if "ERRO" in message.upper():
-        emit_notification_backend("Erro de Sincronização", message, 'error')
-    elif "[PIX]" in message.upper():
-        emit_notification_backend("Novo Pix Recebido", message, 'success', 'financeiro')
+# Agregador da invocação atual (cada requisição roda numa thread)
+_invocation = threading.local()
+
+@contextmanager
+def notification_window():
+    """
+    Resumos com debounce (NOTIFICATION_DEBOUNCE_SECONDS) para as linhas logadas fora de uma execução
+    de sync dentro do bloco; o que estiver pendente é emitido na saída, antes de o handler retornar.
+    """
+    from notification_buffer import NotificationAggregator, NOTIFICATION_DEBOUNCE_SECONDS
+    notifications = _invocation.notifications = NotificationAggregator(emit_notification_backend, NOTIFICATION_DEBOUNCE_SECONDS)
+    try:
+        yield notifications
+    finally:
+        _invocation.notifications = None
+        notifications.flush()
 
 def classify_task(title, notes):
     import re
@@ -105,377 +124,213 @@ def classify_task(title, notes):
 
     return categoria, None, contabilizar_meta
 
-def extract_time_from_notes(notes):
-    import re
-    if not notes: return None, None
-    match = re.search(r'\[Horário:\s*(\d{2}:\d{2})\s*-\s*(\d{2}:\d{2})\]', notes)
-    if match:
-        return match.group(1), match.group(2)
-    return None, None
-
-def update_notes_with_time(notes, start, end):
-    import re
-    if not notes: notes = ""
-    pattern = r'\[Horário:\s*\d{2}:\d{2}\s*-\s*\d{2}:\d{2}\]'
-    new_block = f"[Horário: {start} - {end}]" if start and end else ""
-    
-    if re.search(pattern, notes):
-        if new_block:
-            return re.sub(pattern, new_block, notes)
-        else:
-            return re.sub(pattern, '', notes).strip()
-    else:
-        if new_block:
-            return f"{notes}\n\n{new_block}".strip()
-        else:
-            return notes
-
-def sync_google_tasks_pull(service, sync_ref, logs):
+@tracked('tasks_pull')
+def sync_google_tasks_pull(service, sync_ref, logs, full_resync=False, session=None):
+    """
+    Importa do Google Tasks as tarefas alteradas desde o último watermark da lista.
+    Com `full_resync` (ou sem watermark) relista a lista inteira.
+    Tarefas já vinculadas passam pelo merge de três vias (task_merge): só os campos alterados
+    no Google são gravados e conflitos ficam em `sync_conflicts`.
+    Recebendo a `session` do push, reaproveita a lista, o snapshot do Google e o índice local.
+    """
     from datetime import datetime
+    from sync_state import set_tasks_watermark
+    from tasks_sync import TasksSyncSession
+    from task_merge import TaskMerge, synced_marks, google_view
+    from firestore_writer import BufferedWriter
     db = get_db()
+    writer = BufferedWriter(db, lambda msg: log_to_firestore(sync_ref, logs, msg))
+    session = session or TasksSyncSession(db, service, full_resync)
     try:
-        results = service.tasklists().list().execute()
-        tasklist_id = next((item['id'] for item in results.get('items', []) if 'tarefa' in item['title'].lower()), None)
+        tasklist_id = session.resolve_tasklist(lambda title: 'tarefa' in title.lower())
         if not tasklist_id: return
-        
-        g_tasks = []
-        next_page_token = None
-        while True:
-            res = service.tasks().list(tasklist=tasklist_id, showCompleted=True, showHidden=True, maxResults=100, pageToken=next_page_token).execute()
-            g_tasks.extend(res.get('items', []))
-            if not res.get('nextPageToken') or len(g_tasks) >= 200: break
-            next_page_token = res.get('nextPageToken')
-
-        local_tasks = {t.to_dict().get('google_id'): (t.id, t.to_dict()) for t in db.collection('tarefas').stream() if t.to_dict().get('google_id')}
-        
+
+        g_tasks = list(session.load_google_tasks().values())
+        watermark = session.watermark
+        log_to_firestore(sync_ref, logs, f"PULL {'incremental' if watermark else 'completo'}: {len(g_tasks)} tarefa(s) alterada(s) no Google.")
+
+        if watermark:
+            # Incremental: lê do Firestore apenas as tarefas vinculadas às alteradas ainda fora do índice
+            local_tasks = session.local_tasks_for([gt['id'] for gt in g_tasks])
+        else:
+            session.load_all_local()
+            local_tasks = session.local_by_google_id
+
         for gt in g_tasks:
             g_id, title = gt['id'], gt.get('title', '(Sem Título)')
-            g_updated = gt.get('updated', '')
-            status = 'concluído' if gt.get('status') == 'completed' else 'em andamento'
-            g_due = gt.get('due', '').split('T')[0] if gt.get('due') else None
-            
-            # Extração de horários das notas
-            g_notes = gt.get('notes', '')
-            h_inicio, h_fim = extract_time_from_notes(g_notes)
-            
-            # Duração padrão de 1h se houver início mas não fim
-            if h_inicio and not h_fim:
-                try:
-                    h, m = map(int, h_inicio.split(':'))
-                    h_fim = f"{(h+1)%24:02d}:{m:02d}"
-                except: pass
-
             if g_id in local_tasks:
                 doc_id, t_old = local_tasks[g_id]
-                if t_old.get('data_atualizacao', '') < g_updated:
-                    update_data = {
-                        'titulo': title, 'status': status, 'data_atualizacao': g_updated,
-                        'data_conclusao': gt.get('completed'), 'notas': g_notes,
-                        'horario_inicio': h_inicio, 'horario_fim': h_fim
-                    }
-                    if g_due: update_data['data_limite'] = g_due
-                    db.collection('tarefas').document(doc_id).update(update_data)
-                    log_to_firestore(sync_ref, logs, f"[-] ATUALIZADA: {title}")
+                # Merge campo a campo com a base: só grava o que mudou no Google (ou nada)
+                merge = TaskMerge(t_old, gt)
+                update_data = merge.local_changes()
+                if update_data:
+                    writer.update(db.collection('tarefas').document(doc_id), update_data)
+                    session.apply_local(doc_id, {**t_old, **update_data})
+                if merge.pull:
+                    record('updated')
+                    log_to_firestore(sync_ref, logs, f"[-] ATUALIZADA: {title} ({', '.join(merge.pull)})")
+                if merge.new_conflicts:
+                    record('conflicts')
+                    log_to_firestore(sync_ref, logs, f"[!] CONFLITO: {title} ({', '.join(merge.new_conflicts)}) - mantido sem sobrescrever.")
             else:
+                status = 'concluído' if gt.get('status') == 'completed' else 'em andamento'
+                g_due = gt.get('due', '').split('T')[0] if gt.get('due') else None
+                # Extração de horários das notas
+                g_notes = gt.get('notes', '')
+                h_inicio, h_fim = extract_time_from_notes(g_notes)
                 cat, sys, meta = classify_task(title, g_notes)
-                db.collection('tarefas').add({
+                new_task = {
                     'titulo': title, 'projeto': 'GOOGLE', 'google_id': g_id, 'status': status,
-                    'data_criacao': datetime.now().isoformat(), 'data_atualizacao': g_updated,
+                    'data_criacao': datetime.now().isoformat(), 'data_atualizacao': gt.get('updated', ''),
                     'categoria': cat, 'contabilizar_meta': meta, 'notas': g_notes,
                     'data_limite': g_due if g_due else '-',
-                    'horario_inicio': h_inicio, 'horario_fim': h_fim
-                })
+                    'horario_inicio': h_inicio, 'horario_fim': default_end(h_inicio, h_fim)
+                }
+                new_task.update(synced_marks(new_task, google_view(gt)))
+                writer.create(db.collection('tarefas'), new_task)
+                record('created')
                 log_to_firestore(sync_ref, logs, f"[+] IMPORTADA: {title}")
+
+        # Só avança o watermark depois de gravar todas as alterações com sucesso
+        failures = writer.flush()
+        if not failures and session.next_watermark and session.next_watermark != watermark:
+            set_tasks_watermark(db, tasklist_id, session.next_watermark)
     except Exception as e:
+        writer.flush()
         log_to_firestore(sync_ref, logs, f"ERRO PULL: {e}")
 
-from googleapiclient.errors import HttpError
-
-def sync_google_tasks_push(service, sync_ref, logs):
+@tracked('tasks_push')
+def sync_google_tasks_push(service, sync_ref, logs, full_resync=False, session=None):
+    """
+    Envia ao Google Tasks as tarefas marcadas com `needs_push` (ver on_tarefa_written).
+    Com `full_resync` percorre a coleção 'tarefas' inteira, como antes.
+    O envio (merge de três vias, lotes HTTP e marcas de sync) é o tasks_sync.push_local_tasks,
+    o mesmo do hermes_cli.py; tarefas de categoria SISTEMA ficam de fora.
+    """
+    from tasks_sync import TasksSyncSession, push_local_tasks, is_system_task
+    from firestore_writer import BufferedWriter
     db = get_db()
+    writer = BufferedWriter(db, lambda msg: log_to_firestore(sync_ref, logs, msg))
+    session = session or TasksSyncSession(db, service, full_resync)
     try:
-        results = service.tasklists().list().execute()
-        tasklist_id = next((item['id'] for item in results.get('items', []) if 'tarefa' in item['title'].lower()), None)
+        docs = session.load_all_local() if full_resync else session.load_dirty_local()
+        if not full_resync:
+            if not docs: return
+            log_to_firestore(sync_ref, logs, f"PUSH: {len(docs)} tarefa(s) com alterações locais.")
+
+        tasklist_id = session.resolve_tasklist(lambda title: 'tarefa' in title.lower())
         if not tasklist_id: return
-        
-        # Pega todas as tarefas do Google (com paginação) para o mapa
-        g_tasks_map = {}
-        next_page_token = None
-        while True:
-            g_results = service.tasks().list(tasklist=tasklist_id, showCompleted=True, showHidden=True, maxResults=100, pageToken=next_page_token).execute()
-            for item in g_results.get('items', []):
-                g_tasks_map[item['id']] = item
-            next_page_token = g_results.get('nextPageToken')
-            if not next_page_token or len(g_tasks_map) >= 500: break
-        
-        for doc in db.collection('tarefas').stream():
-            t = doc.to_dict()
-            cat = t.get('categoria', '')
-            if cat.startswith('SISTEMA:') or cat == 'SISTEMAS': continue
-
-            g_id, title = t.get('google_id'), t.get('titulo')
-            if t.get('status') == 'excluído':
-                if g_id:
-                    try: 
-                        service.tasks().delete(tasklist=tasklist_id, task=g_id).execute()
-                        log_to_firestore(sync_ref, logs, f"[X] REMOVIDA DO GOOGLE: {title}")
-                    except HttpError as e:
-                        if e.resp.status == 404:
-                            log_to_firestore(sync_ref, logs, f"[!] Task {g_id} já não existia no Google.")
-                doc.reference.delete()
-                continue
-            
-            g_status = 'completed' if t.get('status') == 'concluído' else 'needsAction'
-            g_due = f"{t.get('data_limite')}T00:00:00Z" if t.get('data_limite') and t.get('data_limite') != '-' else None
-            
-            # Se houver horário de início, tentamos enviar no due
-            if t.get('horario_inicio') and g_due:
-                g_due = f"{t.get('data_limite')}T{t['horario_inicio']}:00Z"
-
-            # Atualiza as notas com o horário para garantir a sincronia
-            h_inicio, h_fim = t.get('horario_inicio'), t.get('horario_fim')
-            # Se não houver fim mas houver início, assume-se 1h de duração
-            if h_inicio and not h_fim:
-                try:
-                    h, m = map(int, h_inicio.split(':'))
-                    h_fim = f"{(h+1)%24:02d}:{m:02d}"
-                except: pass
-            
-            updated_notes = update_notes_with_time(t.get('notas', ''), h_inicio, h_fim)
-
-            if not g_id:
-                body = {'title': title, 'notes': updated_notes, 'status': g_status}
-                if g_due: body['due'] = g_due
-                new_task = service.tasks().insert(tasklist=tasklist_id, body=body).execute()
-                doc.reference.update({'google_id': new_task['id'], 'data_atualizacao': new_task.get('updated'), 'notas': updated_notes, 'horario_fim': h_fim if not t.get('horario_fim') else t.get('horario_fim')})
-                log_to_firestore(sync_ref, logs, f"[+] ENVIADA: {title}")
-            elif g_id in g_tasks_map and t.get('data_atualizacao', '') > g_tasks_map[g_id].get('updated', ''):
-                body = {'id': g_id, 'title': title, 'notes': updated_notes, 'status': g_status}
-                if g_due: body['due'] = g_due
-                try:
-                    service.tasks().update(tasklist=tasklist_id, task=g_id, body=body).execute()
-                    log_to_firestore(sync_ref, logs, f"[^] ATUALIZADA NO GOOGLE: {title}")
-                    if updated_notes != t.get('notas', ''):
-                        doc.reference.update({'notas': updated_notes})
-                except HttpError as e:
-                    if e.resp.status == 404:
-                        log_to_firestore(sync_ref, logs, f"[!] Task {g_id} não encontrada no Google - Limpando ID local.")
-                        doc.reference.update({'google_id': None})
-                    else:
-                        raise e
+        session.load_google_tasks()
+        push_local_tasks(session, docs, writer, lambda msg: log_to_firestore(sync_ref, logs, msg), skip=is_system_task)
+        writer.flush()
     except Exception as e:
+        # Grava o que já foi confirmado pelo Google antes da falha (ex.: google_id de inserções)
+        writer.flush()
         log_to_firestore(sync_ref, logs, f"ERRO PUSH: {e}")
 
-def sync_google_calendar(service, sync_ref, logs):
-    from datetime import datetime, timedelta, timezone
+@tracked('calendar')
+def sync_google_calendar(service, sync_ref, logs, full_resync=False):
+    """
+    Sincroniza o Google Calendar via syncToken (calendar_sync): só eventos alterados ou
+    cancelados desde a última execução; listagem completa na primeira vez, a cada 24h,
+    com `full_resync` ou quando o token expira.
+    """
+    from calendar_sync import sync_calendar_events
+    from firestore_writer import BufferedWriter
     db = get_db()
+    writer = BufferedWriter(db, lambda msg: log_to_firestore(sync_ref, logs, msg))
     try:
         log_to_firestore(sync_ref, logs, "Sincronizando Google Calendar...", True)
-        time_min = (datetime.now(timezone.utc) - timedelta(days=7)).isoformat().replace('+00:00', 'Z')
-        time_max = (datetime.now(timezone.utc) + timedelta(days=30)).isoformat().replace('+00:00', 'Z')
-
-        events_result = service.events().list(
-            calendarId='primary', timeMin=time_min, timeMax=time_max,
-            singleEvents=True, orderBy='startTime'
-        ).execute()
-        events = events_result.get('items', [])
-
-        count = 0
-        seen_ids = set()
-        for event in events:
-            event_id = event['id']
-            seen_ids.add(event_id)
-            summary = event.get('summary', '(Sem título)')
-            start = event['start'].get('dateTime', event['start'].get('date'))
-            end = event['end'].get('dateTime', event['end'].get('date'))
-
-            db.collection('google_calendar_events').document(event_id).set({
-                'google_id': event_id,
-                'titulo': summary,
-                'data_inicio': start,
-                'data_fim': end,
-                'last_sync': datetime.now().isoformat()
-            }, merge=True)
-            count += 1
-
-        # Limpeza de eventos deletados no Google Calendar
-        # Buscamos apenas eventos no Firestore que estão dentro do período sincronizado para evitar stream total
-        docs = db.collection('google_calendar_events')\
-            .where('data_inicio', '>=', time_min)\
-            .where('data_inicio', '<=', time_max)\
-            .stream()
-        deleted_count = 0
-        for doc in docs:
-            if doc.id not in seen_ids:
-                doc.reference.delete()
-                deleted_count += 1
-
+        count, deleted_count = sync_calendar_events(db, service, writer, lambda msg: log_to_firestore(sync_ref, logs, msg), full_resync)
         log_to_firestore(sync_ref, logs, f"[CAL] {count} eventos sincronizados. {deleted_count} removidos.")
     except Exception as e:
+        writer.flush()
         log_to_firestore(sync_ref, logs, f"ERRO CAL: {e}")
 
-def sync_pix_emails(service, sync_ref, logs):
+@tracked('pix')
+def sync_pix_emails(service, sync_ref, logs, full_resync=False):
     """
     Busca emails de Pix e registra no Financeiro (Versão Cloud Function)
+    Só as mensagens novas desde o último historyId do Gmail (pix_sync); `full_resync` refaz a busca completa.
     """
-    import re
-    import time
-    from datetime import datetime, timezone
+    from firestore_writer import BufferedWriter
+    from pix_sync import ingest_pix_messages
     db = get_db()
-    
+    log = lambda msg: log_to_firestore(sync_ref, logs, msg)
     try:
-        log_to_firestore(sync_ref, logs, "Buscando emails de Pix a partir de 01/02/2026...")
-        # Query: Assuntos de Pix + Data limite
-        query = 'after:2026/02/01 subject:(Pix recebido OR Pix realizado OR "Pix enviado" OR "transferência Pix")'
-        
-        results = service.users().messages().list(userId='me', q=query, maxResults=50).execute()
-        messages = results.get('messages', [])
-        
-        if not messages:
-            log_to_firestore(sync_ref, logs, "Nenhum Pix encontrado para os critérios de busca.")
-            return
-        
-        log_to_firestore(sync_ref, logs, f"Encontrados {len(messages)} e-mails potenciais de Pix. Analisando...")
-
-        # Cache de transações existentes para evitar duplicatas (Bloqueio de duplicidade financeira)
-        # Cada item: {'amount': float, 'date': datetime, 'pix_id': str, 'description': str}
-        existing_transactions = []
-        existing_income = []
-        existing_google_ids = set()
-
-        def parse_iso_date(date_str):
-            if not date_str: return None
-            try: return datetime.fromisoformat(date_str.replace('Z', '+00:00'))
-            except: return None
-
-        for t in db.collection('finance_transactions').stream():
-            data = t.to_dict()
-            existing_transactions.append({
-                'description': data.get('description'),
-                'amount': data.get('amount'),
-                'date': parse_iso_date(data.get('date')),
-                'pix_id': data.get('pix_id')
-            })
-            if data.get('google_message_id'): existing_google_ids.add(data['google_message_id'])
-
-        for t in db.collection('finance_income').stream():
-            data = t.to_dict()
-            existing_income.append({
-                'description': data.get('description'),
-                'amount': data.get('amount'),
-                'date': parse_iso_date(data.get('date')),
-                'pix_id': data.get('pix_id')
-            })
-            if data.get('google_message_id'): existing_google_ids.add(data['google_message_id'])
-
-        processed_emails_doc = db.collection('system').document('processed_emails').get()
-        processed_ids = processed_emails_doc.to_dict().get('ids', []) if processed_emails_doc.exists else []
-        new_processed_ids = []
-
-        for msg in messages:
-            msg_id = msg['id']
-            if msg_id in processed_ids or msg_id in existing_google_ids: continue
-            
-            details = service.users().messages().get(userId='me', id=msg_id).execute()
-            internal_date_ms = int(details.get('internalDate', time.time() * 1000))
-            dt = datetime.fromtimestamp(internal_date_ms / 1000.0, tz=timezone.utc)
-            
-            snippet = details.get('snippet', '')
-            subject = ''
-            for header in details.get('payload', {}).get('headers', []):
-                if header['name'] == 'Subject': subject = header['value']; break
-            
-            # Regex para capturar valor R$ e ID do Pix (E2E ID)
-            content = f"{subject} {snippet}"
-            value_match = re.search(r'R\$\s*(\d+(?:[\.,]\d+)?)', content)
-            pix_id_match = re.search(r'\b(E[A-Z0-9]{31})\b', content)
-            pix_id = pix_id_match.group(1) if pix_id_match else None
-
-            if value_match:
-                val_str = value_match.group(1).replace('.', '').replace(',', '.')
-                amount = float(val_str)
-                # Classificação aprimorada de renda vs despesa
-                is_income = any(word in content.lower() for word in ['recebido', 'recebeu', 'recebida', 'recebimento', 'creditado', 'entrada'])
-                description = f"Pix: {subject}"
-                iso_date = dt.isoformat()
-                
-                # Verificação de redundância aprimorada para evitar duplicatas de diferentes instituições
-                is_duplicate = False
-                target_cache = existing_income if is_income else existing_transactions
-
-                for item in target_cache:
-                    # 1. Por ID do Pix (E2E ID)
-                    if pix_id and item.get('pix_id') == pix_id:
-                        is_duplicate = True; break
-
-                    # 2. Por Valor e Proximidade Temporal (janela de 5 minutos)
-                    if item.get('amount') == amount and item.get('date'):
-                        diff = abs((item['date'] - dt).total_seconds())
-                        if diff < 300: # 5 minutos
-                            is_duplicate = True; break
-
-                    # 3. Legado/Exata (Descrição e Valor)
-                    if item.get('description') == description and item.get('amount') == amount:
-                        is_duplicate = True; break
-
-                if is_duplicate:
-                    new_processed_ids.append(msg_id)
-                    continue
-
-                new_record = {
-                    'description': description, 'amount': amount, 'date': iso_date,
-                    'google_message_id': msg_id, 'pix_id': pix_id, 'status': 'active'
-                }
-
-                if is_income:
-                    new_record.update({
-                        'day': dt.day, 'month': dt.month - 1, 'year': dt.year,
-                        'category': 'Renda Extra', 'isReceived': True
-                    })
-                    db.collection('finance_income').add(new_record)
-                    existing_income.append({'amount': amount, 'date': dt, 'pix_id': pix_id, 'description': description})
-                else:
-                    sprint = 1 if dt.day < 8 else 2 if dt.day < 15 else 3 if dt.day < 22 else 4
-                    new_record.update({
-                        'sprint': sprint, 'category': 'Alimentação'
-                    })
-                    db.collection('finance_transactions').add(new_record)
-                    existing_transactions.append({'amount': amount, 'date': dt, 'pix_id': pix_id, 'description': description})
-                new_processed_ids.append(msg_id)
-                log_to_firestore(sync_ref, logs, f"[PIX] {subject} (R$ {amount:.2f})")
-
-        if new_processed_ids:
-            updated_ids = list(set(processed_ids + new_processed_ids))[-200:]
-            db.collection('system').document('processed_emails').set({'ids': updated_ids}, merge=True)
+        ingest_pix_messages(db, service, BufferedWriter(db, log), log, full_resync)
     except Exception as e:
         log_to_firestore(sync_ref, logs, f"ERRO PIX: {e}")
 
-def run_full_sync():
-    """Executa o processo completo de sincronização"""
+def run_full_sync(full_resync=False, trigger=None, request_id=None):
+    """
+    Executa o processo completo de sincronização sob a trava de execução única (system/sync_lock).
+    Se outra execução (Cloud Function ou hermes_cli.py) estiver em andamento, um pedido manual novo
+    fica marcado para uma nova rodada dela e esta chamada retorna sem sincronizar.
+    """
+    from sync_lock import run_single_flight
+    run_single_flight(get_db(), 'cloud', run_full_sync_once, full_resync, trigger, request_id)
+
+def run_full_sync_once(full_resync=False, trigger=None):
+    """
+    Executa o processo completo de sincronização.
+    `full_resync` ignora os watermarks, o syncToken do Calendar e o historyId do Gmail e relista tudo.
+    As métricas de cada etapa são gravadas em sync_runs/{runId}.
+    """
     from datetime import datetime
+    from sync_runner import RunLogs, LogStore, run_stages
+    from sync_metrics import SyncMetrics
+    from tasks_sync import TasksSyncSession
+    from notification_buffer import NotificationAggregator
     db = get_db()
+    metrics = SyncMetrics('cloud', trigger).activate()
     sync_ref = db.collection('system').document('sync')
-    logs = [f"Iniciando sincronização ({datetime.now().strftime('%Y-%m-%d %H:%M:%S')})..."]
+    notifications = NotificationAggregator(emit_notification_backend)
+    store = LogStore(db, metrics.run_id)
+    run_logs = RunLogs([f"Iniciando sincronização ({datetime.now().strftime('%Y-%m-%d %H:%M:%S')})..."], notifications, store)
+    # system/sync recebe só o status e o cursor dos logs (uma escrita no início e outra no fim);
+    # a interrupção pedida pelo console vale para a execução anterior, não para esta
+    start = {'log_run_id': metrics.run_id, 'interrupted': False}
+    if trigger == 'manual': start['status'] = 'processing'
+    sync_ref.set(start, merge=True)
     try:
         ts, gs, cs = get_tasks_service(), get_gmail_service(), get_calendar_service()
-        sync_google_tasks_push(ts, sync_ref, logs)
-        sync_google_tasks_pull(ts, sync_ref, logs)
-        sync_google_calendar(cs, sync_ref, logs)
-        sync_pix_emails(gs, sync_ref, logs)
+
+        def tasks_stage(logs):
+            # Uma sessão por execução: push e pull compartilham lista, snapshot do Google e índice local
+            tasks_session = TasksSyncSession(db, ts, full_resync)
+            sync_google_tasks_push(ts, sync_ref, logs, full_resync, tasks_session)
+            sync_google_tasks_pull(ts, sync_ref, logs, full_resync, tasks_session)
+
+        # Tasks (push→pull em ordem), Calendar e Pix tocam APIs e coleções disjuntas: rodam em paralelo
+        logs = run_stages([
+            ('TASKS', tasks_stage),
+            ('CAL', lambda logs: sync_google_calendar(cs, sync_ref, logs, full_resync)),
+            ('PIX', lambda logs: sync_pix_emails(gs, sync_ref, logs, full_resync)),
+        ], run_logs)
         sync_ref.update({
             'status': 'completed',
             'last_success': datetime.now().isoformat(),
-            'logs': logs
+            'log_lines': store.lines,
+            'last_run_id': metrics.run_id
         })
+        metrics.save(db)
         print("Sincronização concluída com sucesso.")
     except Exception as e:
         error_msg = f"ERRO na sincronização: {str(e)}"
         print(error_msg)
+        store.append(error_msg)
+        store.flush()
         sync_ref.update({
             'status': 'error',
             'error_message': error_msg,
-            'logs': logs + [error_msg]
+            'log_lines': store.lines
         })
+        metrics.save(db, 'error')
+        notifications.add_error(error_msg)
+    finally:
+        # Uma notificação por tipo para a execução inteira (em vez de uma por linha de log)
+        notifications.flush()
 
 @firestore_fn.on_document_updated(document="system/sync")
 def on_sync_request(event: firestore_fn.Event[firestore_fn.Change[firestore_fn.DocumentSnapshot]]):
@@ -483,164 +338,84 @@ def on_sync_request(event: firestore_fn.Event[firestore_fn.Change[firestore_fn.D
     if not event.data.after.exists: return
     data = event.data.after.to_dict()
     if data.get('status') != 'requested': return
-    db = get_db()
-    db.collection('system').document('sync').update({'status': 'processing'})
-    run_full_sync()
+    # O status 'processing' é gravado pelo run_full_sync junto com o cursor dos logs;
+    # o timestamp identifica o pedido (o mesmo pedido visto pelo hermes_cli.py não gera nova rodada)
+    with notification_window():
+        run_full_sync(full_resync=data.get('mode') == 'full', trigger='manual', request_id=data.get('timestamp'))
 
 @scheduler_fn.on_schedule(schedule="every 30 minutes")
 def scheduled_sync(event: scheduler_fn.ScheduledEvent) -> None:
     """Trigger agendado para rodar a cada 30 minutos"""
-    run_full_sync()
+    with notification_window():
+        run_full_sync(trigger='scheduled')
 @firestore_fn.on_document_created(document="notificacoes/{notification_id}")
 def on_notificacao_created(event: firestore_fn.Event[firestore_fn.DocumentSnapshot | None]):
     """Trigger disparado quando uma nova notificação é criada"""
+    from fcm_registry import load_tokens, send_push, prune_tokens
     if not event.data: return
     notif = event.data.to_dict()
     if not notif or notif.get('sent_to_push'): return
     title = notif.get('title', 'Hermes')
     message = notif.get('message', '')
     db = get_db()
-    tokens_docs = db.collection('fcm_tokens').stream()
-    tokens = list({doc.id for doc in tokens_docs if doc.id})
+    # Uma leitura do registro (system/fcm_registry) em vez de varrer fcm_tokens
+    tokens = load_tokens(db)
     if not tokens:
         print("Nenhum token FCM encontrado para enviar push.")
         return
-    push_message = messaging.MulticastMessage(
-        data={
-            'id': str(notif.get('id', '')),
-            'title': str(title),
-            'message': str(message),
-            'link': str(notif.get('link', '')),
-            'type': str(notif.get('type', 'info'))
-        },
-        tokens=tokens,
-    )
+    data = {
+        'id': str(notif.get('id', '')),
+        'title': str(title),
+        'message': str(message),
+        'link': str(notif.get('link', '')),
+        'type': str(notif.get('type', 'info'))
+    }
     try:
-        response = messaging.send_each_for_multicast(push_message)
-        print(f"Push enviado: {response.success_count} sucesso, {response.failure_count} falha.")
-        if response.failure_count > 0:
-            for idx, resp in enumerate(response.responses):
-                if not resp.success:
-                    if resp.exception and "registration-token-not-registered" in str(resp.exception).lower():
-                        bad_token = tokens[idx]
-                        db.collection('fcm_tokens').document(bad_token).delete()
+        success, failure, dead_tokens = send_push(tokens, data)
+        print(f"Push enviado: {success} sucesso, {failure} falha.")
+        prune_tokens(db, dead_tokens)
         event.data.reference.update({'sent_to_push': True})
     except Exception as e:
         print(f"Erro ao enviar push notification: {str(e)}")
 
+@firestore_fn.on_document_written(document="fcm_tokens/{token}")
+def on_fcm_token_written(event: firestore_fn.Event[firestore_fn.Change[firestore_fn.DocumentSnapshot | None]]):
+    """Mantém system/fcm_registry com os tokens existentes (só criação e exclusão mudam o registro)"""
+    from fcm_registry import register_token, unregister_tokens
+    before_exists = bool(event.data.before and event.data.before.exists)
+    after_exists = bool(event.data.after and event.data.after.exists)
+    if before_exists == after_exists: return
+    db = get_db()
+    if after_exists: register_token(db, event.params['token'], (event.data.after.to_dict() or {}).get('last_updated'))
+    else: unregister_tokens(db, [event.params['token']])
+
 @scheduler_fn.on_schedule(schedule="every 1 minutes")
 def check_and_send_reminders(event: scheduler_fn.ScheduledEvent) -> None:
-    """Verifica e envia lembretes agendados (hábitos, pesagem, customizados e ações)"""
-    from datetime import datetime, timedelta
-    import pytz
-    
+    """
+    Envia os lembretes vencidos (hábitos, pesagem, customizados e ações) a partir da agenda
+    pré-calculada em 'reminder_schedule': uma consulta por tick; sem nada vencido, é só ela.
+    Os vencidos são reivindicados e enviados em transações em lote (reminder_schedule.dispatch_chunk).
+    Na primeira execução sem a flag `reminder_schedule_built` em system/sync_state, reconstrói a agenda.
+    """
+    from reminder_schedule import ensure_reminder_schedule, dispatch_due_reminders
     db = get_db()
-    # Define o fuso horário de Brasília para comparar com as strings de horário do usuário (HH:mm)
-    tz = pytz.timezone('America/Sao_Paulo')
-    now = datetime.now(tz)
-    current_time_str = now.strftime('%H:%M')
-    today_str = now.strftime('%Y-%m-%d')
-    day_of_week = now.weekday() # 0 = Monday, 1 = Tuesday... 6 = Sunday (Note: Python index matches our dayOfWeek if 0=Mon, but let's check)
-    # No helper.tsx: dayOfWeek: 1 // Segunda-feira. Python: 0=Mon, 1=Tue... 
-    # Precisamos ajustar para 0=Dom? Não, vamos seguir o padrão do AppSettings.
-    # AppSettings weighInReminder dayOfWeek: 0-6 (0=Dom no JS Date.getDay())
-    # Python now.strftime('%w') retorna 0 para Domingo.
-    js_day_of_week = int(now.strftime('%w'))
-
-    # 1. Carrega Configurações
-    settings_doc = db.collection('configuracoes').document('geral').get()
-    if settings_doc.exists:
-        settings = settings_doc.to_dict()
-        notifs_config = settings.get('notifications', {})
-        
-        # --- Lembrete de Hábitos ---
-        habits = notifs_config.get('habitsReminder', {})
-        if habits.get('enabled') and habits.get('time') == current_time_str:
-            remind_id = f"habits_{today_str}"
-            # Verifica se já enviou hoje
-            if not db.collection('system_reminders').document(remind_id).get().exists:
-                emit_notification_backend(
-                    "Lembrete de Hábitos",
-                    "Hora de registrar seus hábitos de hoje para manter sua rotina nos trilhos!",
-                    'info',
-                    'saude'
-                )
-                db.collection('system_reminders').document(remind_id).set({'sent_at': now.isoformat()})
-
-        # --- Lembrete de Pesagem ---
-        weigh_in = notifs_config.get('weighInReminder', {})
-        if weigh_in.get('enabled') and weigh_in.get('time') == current_time_str:
-            freq = weigh_in.get('frequency', 'weekly')
-            target_day = weigh_in.get('dayOfWeek', 1)
-            
-            should_remind = False
-            if js_day_of_week == target_day:
-                if freq == 'weekly':
-                    should_remind = True
-                elif freq == 'biweekly':
-                    # Lógica simplificada de biweekly baseada no timestamp da semana
-                    week_num = int(now.strftime('%V'))
-                    if week_num % 2 == 0: should_remind = True
-                elif freq == 'monthly' and now.day == 1:
-                    should_remind = True
-            
-            if should_remind:
-                remind_id = f"weighin_{today_str}"
-                if not db.collection('system_reminders').document(remind_id).get().exists:
-                    emit_notification_backend(
-                        "Lembrete de Pesagem",
-                        "Hora de registrar seu peso para acompanhar sua evolução no módulo Saúde!",
-                        'info',
-                        'saude'
-                    )
-                    db.collection('system_reminders').document(remind_id).set({'sent_at': now.isoformat()})
-
-        # --- Notificações Customizadas ---
-        custom_notifs = notifs_config.get('custom', [])
-        for cn in custom_notifs:
-            if cn.get('enabled') and cn.get('time') == current_time_str:
-                freq = cn.get('frequency', 'daily')
-                should_send = False
-                
-                if freq == 'daily':
-                    should_send = True
-                elif freq == 'weekly' and js_day_of_week in cn.get('daysOfWeek', []):
-                    should_send = True
-                elif freq == 'monthly' and now.day == cn.get('dayOfMonth', 1):
-                    should_send = True
-                
-                if should_send:
-                    remind_id = f"custom_{cn.get('id')}_{today_str}"
-                    if not db.collection('system_reminders').document(remind_id).get().exists:
-                        emit_notification_backend(
-                            "Lembrete Personalizado",
-                            cn.get('message', 'Notificação Hermes'),
-                            'info'
-                        )
-                        db.collection('system_reminders').document(remind_id).set({'sent_at': now.isoformat()})
-
-    # 2. Lembretes de Ações (Specific Task Reminders)
-    from google.cloud.firestore import Query
-    # Busca tarefas com reminder_at definido e que ainda não foram marcadas como lembradas
-    tasks_with_reminders = db.collection('tarefas')\
-        .where('reminder_at', '<=', now.isoformat())\
-        .where('reminder_sent', '==', False)\
-        .stream()
-
-    for task_doc in tasks_with_reminders:
-        t = task_doc.to_dict()
-        title = t.get('titulo', 'Ação Pendente')
-        task_id = task_doc.id
-        
-        emit_notification_backend(
-            f"Lembrete: {title}",
-            "Está na hora de realizar esta ação agendada!",
-            'warning',
-            'acoes'
-        )
-        
-        # Marca como enviado para não repetir
-        task_doc.reference.update({'reminder_sent': True})
+    # Agenda vazia logo após o deploy: monta uma vez (configurações + tarefas existentes)
+    ensure_reminder_schedule(db)
+    claimed, notifications = dispatch_due_reminders(db)
+    if claimed: print(f"Lembretes: {claimed} disparado(s) em {notifications} notificação(ões).")
+
+@firestore_fn.on_document_written(document="configuracoes/geral")
+def on_settings_written(event: firestore_fn.Event[firestore_fn.Change[firestore_fn.DocumentSnapshot | None]]):
+    """Recalcula a agenda de lembretes quando as configurações de notificação mudam"""
+    from firestore_writer import BufferedWriter
+    from reminder_schedule import rebuild_settings_schedule
+    before = event.data.before.to_dict() if event.data.before and event.data.before.exists else {}
+    after = event.data.after.to_dict() if event.data.after and event.data.after.exists else {}
+    if (before or {}).get('notifications') == (after or {}).get('notifications'): return
+    db = get_db()
+    writer = BufferedWriter(db)
+    rebuild_settings_schedule(db, after, writer)
+    writer.flush()
 
 @https_fn.on_call()
 def upload_to_drive(req: https_fn.CallableRequest):
@@ -672,6 +447,51 @@ def upload_to_drive(req: https_fn.CallableRequest):
         print(f"Erro no upload para o Drive: {str(e)}")
         raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.INTERNAL, message=str(e))
 
+@firestore_fn.on_document_written(document="tarefas/{taskId}")
+def on_tarefa_written(event: firestore_fn.Event[firestore_fn.Change[firestore_fn.DocumentSnapshot | None]]):
+    """
+    Marca a tarefa com `needs_push` quando os campos sincronizados divergem da `sync_base`.
+    As escritas da própria sync gravam a base coerente, então não disparam nova marcação.
+    Também mantém o lembrete da tarefa em 'reminder_schedule'.
+    """
+    from task_merge import has_local_changes
+    from reminder_schedule import sync_task_reminder
+    before, after = event.data.before, event.data.after
+    # Agenda de lembretes: só escreve quando reminder_at/reminder_sent/título mudam
+    sync_task_reminder(get_db(), event.params['taskId'],
+                       before.to_dict() if before and before.exists else None,
+                       after.to_dict() if after and after.exists else None)
+    if not after or not after.exists: return
+    data = after.to_dict() or {}
+    # Campos só em conflito não marcam: o merge já decidiu mantê-los até um dos lados mudar
+    if data.get('needs_push') or not has_local_changes(data, data.get('sync_base'), data.get('sync_conflicts')): return
+    after.reference.update({'needs_push': True})
+
+def sync_finance_fingerprints(collection_name, event):
+    """
+    Mantém finance_fingerprints coerente com criações/edições/exclusões feitas fora da sync (frontend).
+    Registros criados pela sync do Pix (com google_message_id) já gravaram as impressões no mesmo lote.
+    """
+    from firestore_writer import BufferedWriter
+    from finance_fingerprints import fingerprint_keys, add_fingerprints, remove_fingerprints
+    before = event.data.before.to_dict() if event.data.before and event.data.before.exists else None
+    after = event.data.after.to_dict() if event.data.after and event.data.after.exists else None
+    if before is None and (after or {}).get('google_message_id'): return
+    if fingerprint_keys(collection_name, before or {}) == fingerprint_keys(collection_name, after or {}): return
+    db = get_db()
+    writer = BufferedWriter(db)
+    if before: remove_fingerprints(writer, db, collection_name, event.params['docId'], before)
+    if after: add_fingerprints(writer, db, collection_name, event.params['docId'], after)
+    writer.flush()
+
+@firestore_fn.on_document_written(document="finance_transactions/{docId}")
+def on_finance_transaction_written(event: firestore_fn.Event[firestore_fn.Change[firestore_fn.DocumentSnapshot | None]]):
+    sync_finance_fingerprints('finance_transactions', event)
+
+@firestore_fn.on_document_written(document="finance_income/{docId}")
+def on_finance_income_written(event: firestore_fn.Event[firestore_fn.Change[firestore_fn.DocumentSnapshot | None]]):
+    sync_finance_fingerprints('finance_income', event)
+
 @firestore_fn.on_document_updated(document="tarefas/{taskId}")
 def on_processo_updated(event: firestore_fn.Event[firestore_fn.Change[firestore_fn.DocumentSnapshot]]):
     """Trigger disparado quando uma tarefa é atualizada, para monitorar processo_sei"""
@@ -733,8 +553,13 @@ def vectorize_process_docs_callable(req: https_fn.CallableRequest):
     return process_vectorization(task_id)
 
 def process_vectorization(task_id):
-    """Lógica central de extração e vetorização"""
+    """
+    Lógica central de extração e vetorização: o texto de cada arquivo é dividido em trechos e os
+    trechos de todos os arquivos novos são vetorizados em lote (knowledge_chunks).
+    """
     import google.generativeai as genai
+    from knowledge_chunks import configure_gemini, is_vectorized, store_chunked
+    from firestore_writer import BufferedWriter
     db = get_db()
     task_doc = db.collection('tarefas').document(task_id).get()
     if not task_doc.exists: return {'success': False, 'error': 'Tarefa não encontrada'}
@@ -742,21 +567,16 @@ def process_vectorization(task_id):
     task_data = task_doc.to_dict()
     pool_dados = task_data.get('pool_dados', [])
 
-    # Buscar chave do Gemini
-    keys_doc = db.collection('system').document('api_keys').get()
-    GEMINI_API_KEY = keys_doc.to_dict().get('gemini_api_key') if keys_doc.exists else None
-    if not GEMINI_API_KEY: return {'success': False, 'error': 'Chave Gemini não configurada'}
-
-    genai.configure(api_key=GEMINI_API_KEY)
+    # Chave do Gemini em system/api_keys
+    if not configure_gemini(db): return {'success': False, 'error': 'Chave Gemini não configurada'}
     model = genai.GenerativeModel("gemini-2.5-flash-lite")
 
-    count = 0
+    files = []
     for item in pool_dados:
         if item.get('tipo') == 'arquivo' and item.get('drive_file_id'):
             file_id = item['drive_file_id']
             # Verifica se já foi vetorizado
-            existing = db.collection('processos_conhecimento').where('file_id', '==', file_id).get()
-            if not existing:
+            if not is_vectorized(db, file_id):
                 try:
                     # Download do Drive
                     service = get_drive_service()
@@ -772,26 +592,50 @@ def process_vectorization(task_id):
                         {"mime_type": mime_type, "data": file_content}
                     ])
                     text_content = response.text if response.text else f"Conteúdo de {item.get('nome')}"
-
-                    embedding = genai.embed_content(
-                        model="models/text-embedding-004",
-                        content=text_content,
-                        task_type="retrieval_document"
-                    )
-
-                    db.collection('processos_conhecimento').add({
-                        'task_id': task_id,
-                        'file_id': file_id,
-                        'nome': item.get('nome'),
-                        'texto': text_content,
-                        'embedding': embedding['embedding'],
-                        'data_vetorizacao': firestore.SERVER_TIMESTAMP
-                    })
-                    count += 1
+                    files.append(({'task_id': task_id, 'file_id': file_id, 'nome': item.get('nome')}, text_content))
                 except Exception as e:
                     print(f"Erro ao vetorizar {file_id}: {e}")
 
-    return {'success': True, 'vectorized_count': count}
+    if not files: return {'success': True, 'vectorized_count': 0, 'chunk_count': 0}
+    writer = BufferedWriter(db)
+    try:
+        chunks = store_chunked(db, writer, files)
+    except Exception as e:
+        print(f"Erro ao vetorizar os documentos da tarefa {task_id}: {e}")
+        return {'success': False, 'error': str(e)}
+    failures = writer.flush()
+    return {'success': not failures, 'vectorized_count': len(files), 'chunk_count': chunks}
+
+_vector_index = None
+
+def get_vector_index():
+    """
+    Índice vetorial da instância: reaberto do /tmp (mmap) enquanto a instância estiver aquecida.
+    Com o /tmp vazio (instância nova), a primeira busca monta o índice lendo a coleção inteira.
+    """
+    global _vector_index
+    if _vector_index is None:
+        from vector_index import VectorIndex
+        _vector_index = VectorIndex()
+    return _vector_index
+
+@https_fn.on_call(memory=options.MemoryOption.GB_1)
+def search_knowledge(req: https_fn.CallableRequest):
+    """Busca semântica nos trechos de processos_conhecimento: {query, k?, taskId?} → {results}"""
+    from knowledge_chunks import configure_gemini
+    from vector_index import search_knowledge as run_search
+    query = (req.data.get('query') or '').strip()
+    if not query:
+        raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.INVALID_ARGUMENT, message="Consulta não fornecida.")
+    db = get_db()
+    if not configure_gemini(db):
+        raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.FAILED_PRECONDITION, message="Chave Gemini não configurada.")
+    try:
+        k = min(int(req.data.get('k') or 5), 50)
+        return {'results': run_search(db, get_vector_index(), query, k, req.data.get('taskId'))}
+    except Exception as e:
+        print(f"Erro na busca semântica: {e}")
+        raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.INTERNAL, message=str(e))
 
 @https_fn.on_call()
 def transcreverAudio(req: https_fn.CallableRequest):
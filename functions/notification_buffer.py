@@ -0,0 +1,121 @@
+"""
+Agregação das notificações geradas pelos logs da sincronização.
+
+Em vez de um documento em 'notificacoes' (e um push) por linha de log com "ERRO" ou "[PIX]",
+os eventos ficam acumulados e cada tipo vira uma única notificação-resumo, por exemplo
+"12 Pix recebidos, total R$ 1.234,56". Quem cria o agregador chama flush() antes de retornar
+(a execução de sync, no fim): nada fica pendente depois que a Cloud Function responde.
+Fora de uma execução, `debounce_seconds` limita a janela: um evento que chega depois desse tempo
+desde o primeiro pendente emite o resumo na hora, sem timer em segundo plano.
+"""
+import re
+import threading
+import time
+
+# Janela (em segundos) dos resumos para quem loga fora de uma execução de sync
+NOTIFICATION_DEBOUNCE_SECONDS = 30
+# Linha de log do pix_sync: "[PIX] Entrada: <assunto> (R$ 123.45)"
+PIX_LOG = re.compile(r'\[PIX\]\s*(Entrada|Saída)?:?.*\(R\$\s*(\d+(?:\.\d+)?)\)')
+
+
+def notification_doc(title, message, n_type='info', link=None):
+    """(id, dados) de um documento de 'notificacoes' no formato lido pelo frontend e pelo on_notificacao_created"""
+    from datetime import datetime
+    import uuid
+    notif_id = str(uuid.uuid4())[:9]
+    return notif_id, {
+        'id': notif_id,
+        'title': title,
+        'message': message,
+        'type': n_type,
+        'timestamp': datetime.now().isoformat(),
+        'isRead': False,
+        'link': link,
+        'sent_to_push': False
+    }
+
+
+def format_brl(value):
+    whole, cents = f"{value:,.2f}".split('.')
+    return f"R$ {whole.replace(',', '.')},{cents}"
+
+
+def _plural(count, singular, plural):
+    return f"{count} {singular if count == 1 else plural}"
+
+
+class NotificationAggregator:
+    """
+    Acumula eventos por tipo ('error', 'pix') e emite um resumo por tipo via
+    emit(title, message, n_type, link) — a assinatura de emit_notification_backend.
+    Thread-safe: as etapas da sync logam em paralelo.
+    """
+
+    def __init__(self, emit, debounce_seconds=0):
+        self.emit = emit
+        self.debounce_seconds = debounce_seconds
+        self.errors = []
+        self.pix = []
+        self.window_start = None
+        self.lock = threading.Lock()
+
+    def add_log(self, message):
+        """Classifica uma linha de log (ERRO / Pix importado); as demais, inclusive outras linhas [PIX], são ignoradas"""
+        match = PIX_LOG.search(message)
+        if "ERRO" in message.upper():
+            self.add_error(message)
+        elif match:
+            self.add_pix(message, float(match.group(2)), match.group(1) != 'Saída')
+
+    def add_error(self, message):
+        with self.lock:
+            self.errors.append(message)
+        self._window()
+
+    def add_pix(self, message, amount=None, is_income=True):
+        with self.lock:
+            self.pix.append((message, amount, is_income))
+        self._window()
+
+    def _window(self):
+        # Janela limitada: conta do primeiro evento pendente; vencida, o resumo sai já (o resto no flush final)
+        if not self.debounce_seconds: return
+        with self.lock:
+            now = time.monotonic()
+            if self.window_start is None: self.window_start = now
+            due = now - self.window_start >= self.debounce_seconds
+        if due: self.flush()
+
+    def summaries(self, errors, pix):
+        """(title, message, type, link) de cada resumo; um evento isolado mantém a mensagem original"""
+        result = []
+        if len(errors) == 1:
+            result.append(("Erro de Sincronização", errors[0], 'error', None))
+        elif errors:
+            extra = _plural(len(errors) - 1, 'outro', 'outros')
+            result.append((f"{len(errors)} Erros de Sincronização", f"{errors[0]} (e mais {extra})", 'error', None))
+
+        if len(pix) == 1:
+            message, _, is_income = pix[0]
+            result.append(("Novo Pix Recebido" if is_income else "Novo Pix Enviado", message, 'success', 'financeiro'))
+        elif pix:
+            parts = []
+            for is_income, singular, plural in ((True, 'Pix recebido', 'Pix recebidos'), (False, 'Pix enviado', 'Pix enviados')):
+                amounts = [amount for _, amount, income in pix if income == is_income]
+                if amounts:
+                    parts.append(f"{_plural(len(amounts), singular, plural)}, total {format_brl(sum(a or 0 for a in amounts))}")
+            result.append((f"{len(pix)} Pix importados", "; ".join(parts), 'success', 'financeiro'))
+        return result
+
+    def flush(self):
+        """Emite os resumos pendentes e esvazia o buffer. Retorna quantas notificações foram criadas."""
+        with self.lock:
+            errors, pix, self.errors, self.pix = self.errors, self.pix, [], []
+            self.window_start = None
+        summaries = self.summaries(errors, pix)
+        for title, message, n_type, link in summaries:
+            try:
+                self.emit(title, message, n_type, link)
+            except Exception as e:
+                print(f"Erro ao emitir notificação: {e}")
+        return len(summaries)
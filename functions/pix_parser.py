@@ -0,0 +1,95 @@
+"""
+Motor de parsing dos e-mails de Pix: um conjunto de regras por banco, escolhido pelo remetente
+ou pelo assunto, com os padrões compilados uma única vez na importação do módulo.
+Cada regra extrai valor, direção (entrada/saída), contraparte e E2E ID; o que a regra do banco
+não define cai nas regras genéricas.
+"""
+import re
+
+# Valor em reais: aceita milhar com ponto e decimal com vírgula (R$ 1.234,56), e também R$ 50 / R$ 50,00 / R$ 50.00
+AMOUNT_PATTERN = r'R\$\s*(\d{1,3}(?:\.\d{3})+(?:,\d{1,2})?|\d+(?:[\.,]\d{1,2})?)'
+E2E_PATTERN = r'\b(E[A-Z0-9]{31})\b'
+INCOME_WORDS = r'recebido|recebeu|recebida|recebimento|creditado|entrada'
+EXPENSE_WORDS = r'enviado|enviada|realizado|realizada|pagamento|pagou|debitado|saída'
+# Nome da contraparte: sequência de palavras iniciadas em maiúscula (exceto "Pix") após "de"/"para"
+NAME = r"(?!Pix\b)([A-ZÀ-Ý][A-Za-zÀ-ÿ']+(?:\s+(?:d[aeo]s?\s+)?[A-ZÀ-Ý][A-Za-zÀ-ÿ']+)*)"
+COUNTERPARTY_PATTERNS = (rf'\b(?:de|por|para)\s+{NAME}', rf'\b(?i:pagador|favorecido|destino|origem):\s+{NAME}')
+
+
+class PixRule:
+    """
+    Regras de um banco; `None` em um campo usa o padrão genérico.
+    `counterparty` acrescenta âncoras às genéricas; vale a ocorrência mais à esquerda.
+    """
+
+    def __init__(self, name, sender=None, subject=None, amount=None, income=None, expense=None, counterparty=None):
+        self.name = name
+        self.sender = re.compile(sender, re.I) if sender else None
+        self.subject = re.compile(subject, re.I) if subject else None
+        self.amount = re.compile(amount or AMOUNT_PATTERN)
+        self.income = re.compile(income or INCOME_WORDS, re.I)
+        self.expense = re.compile(expense or EXPENSE_WORDS, re.I)
+        self.counterparty = [re.compile(p) for p in (*(counterparty or ()), *COUNTERPARTY_PATTERNS)]
+
+    def matches(self, sender, subject):
+        return bool((self.sender and self.sender.search(sender or '')) or (self.subject and self.subject.search(subject or '')))
+
+
+# Ordem importa: a primeira regra cujo remetente/assunto casar é usada
+BANK_RULES = [
+    PixRule('nubank', sender=r'@nubank\.com\.br', counterparty=(rf'(?i:transferência recebida de)\s+{NAME}',)),
+    PixRule('inter', sender=r'@(?:bancointer\.com\.br|inter\.co)'),
+    PixRule('itau', sender=r'@(?:itau\.com\.br|itau-unibanco\.com\.br)',
+            counterparty=(rf'\b(?i:pagador|recebedor)\s+{NAME}',)),
+    PixRule('bb', sender=r'@bb\.com\.br', subject=r'\bBB\b'),
+    PixRule('caixa', sender=r'@caixa\.gov\.br'),
+    PixRule('bradesco', sender=r'@bradesco\.com\.br'),
+    PixRule('santander', sender=r'@santander\.com\.br'),
+    PixRule('mercadopago', sender=r'@mercadopago\.com', income=INCOME_WORDS + r'|você recebeu'),
+    PixRule('picpay', sender=r'@picpay\.com'),
+]
+GENERIC_RULE = PixRule('generic')
+E2E_RE = re.compile(E2E_PATTERN)
+
+
+def parse_br_amount(raw):
+    """'1.234,56' -> 1234.56; '50,00'/'50.00'/'50' -> 50.0; '1.234' (milhar) -> 1234.0"""
+    if ',' in raw:
+        return float(raw.replace('.', '').replace(',', '.'))
+    if re.fullmatch(r'\d{1,3}(?:\.\d{3})+', raw):
+        return float(raw.replace('.', ''))
+    return float(raw)
+
+
+def select_rule(sender, subject):
+    return next((rule for rule in BANK_RULES if rule.matches(sender, subject)), GENERIC_RULE)
+
+
+def parse_pix(subject, snippet, sender=''):
+    """
+    Extrai {'amount', 'is_income', 'counterparty', 'pix_id', 'bank'} do e-mail,
+    ou None se não houver valor em reais.
+    """
+    rule = select_rule(sender, subject)
+    content = f"{subject} {snippet}"
+    value_match = rule.amount.search(content)
+    if not value_match: return None
+
+    # Entrada só quando há palavra de recebimento; no assunto, ela prevalece sobre as de envio
+    subject_income, subject_expense = rule.income.search(subject or ''), rule.expense.search(subject or '')
+    if subject_income or subject_expense:
+        is_income = bool(subject_income)
+    else:
+        is_income = bool(rule.income.search(content))
+
+    matches = [m for m in (pattern.search(content) for pattern in rule.counterparty) if m]
+    counterparty = min(matches, key=lambda m: m.start()).group(1).strip() if matches else None
+
+    pix_id_match = E2E_RE.search(content)
+    return {
+        'amount': parse_br_amount(value_match.group(1)),
+        'is_income': is_income,
+        'counterparty': counterparty,
+        'pix_id': pix_id_match.group(1) if pix_id_match else None,
+        'bank': rule.name
+    }
@@ -0,0 +1,304 @@
+"""
+Ingestão dos e-mails de Pix do Gmail.
+
+A descoberta de mensagens é incremental: guarda o `historyId` da caixa em system/sync_state
+e, nas execuções seguintes, pergunta ao users.history.list só pelas mensagens adicionadas
+desde então. Sem nada novo, a execução custa uma única chamada pequena. Sem historyId salvo,
+com `full_resync` ou com o histórico expirado (404), faz a busca completa paginada.
+As mensagens são lidas em lotes HTTP no formato 'metadata' (só Subject, From, o snippet e a data).
+A deduplicação contra o Financeiro usa PixDedupIndex (hash + bisect) em vez de varrer listas.
+Mensagens já tratadas ficam no livro-razão 'pix_processed_emails' (um documento por mensagem).
+ingest_pix_messages reúne o pipeline inteiro; o benchmarks/pix_replay.py o executa offline.
+"""
+from sync_state import get_sync_state, set_sync_state
+from sync_metrics import record
+from google_batch import execute_batch
+
+PIX_SUBJECTS = 'subject:(Pix recebido OR Pix realizado OR "Pix enviado" OR "transferência Pix")'
+PIX_QUERY = f'after:2026/02/01 {PIX_SUBJECTS}'
+# Gets por BatchHttpRequest (o Gmail recomenda no máximo 50 por lote)
+GMAIL_BATCH_SIZE = 50
+# O Gmail sinaliza limite de taxa com 403 e estes motivos (além do 429)
+GMAIL_RATE_LIMIT_REASONS = ('userRateLimitExceeded', 'rateLimitExceeded')
+# Livro-razão das mensagens já tratadas: um documento por mensagem, expirado pela política de TTL
+# do Firestore no campo `expire_at` (gcloud firestore fields ttls update expire_at --collection-group=pix_processed_emails)
+PROCESSED_EMAILS_COLLECTION = 'pix_processed_emails'
+PROCESSED_EMAIL_RETENTION_DAYS = 400
+# Limite de documentos por get_all
+GET_ALL_CHUNK = 300
+# Folga ao restringir a busca incremental por data (o operador after: do Gmail é sensível a fuso)
+HISTORY_QUERY_MARGIN_SECONDS = 86400
+
+
+def list_pix_messages(service, query=PIX_QUERY):
+    """IDs de todas as páginas de messages.list para a busca"""
+    ids, page_token = [], None
+    while True:
+        res = service.users().messages().list(userId='me', q=query, maxResults=500, pageToken=page_token).execute()
+        record('google_pages')
+        ids.extend(m['id'] for m in res.get('messages', []))
+        page_token = res.get('nextPageToken')
+        if not page_token: return ids
+
+
+def list_added_messages(service, history_id):
+    """Mensagens adicionadas desde `history_id` e o historyId atual da caixa"""
+    added, page_token = [], None
+    while True:
+        res = service.users().history().list(
+            userId='me', startHistoryId=history_id, historyTypes=['messageAdded'],
+            maxResults=500, pageToken=page_token
+        ).execute()
+        record('google_pages')
+        for item in res.get('history', []):
+            added.extend(m['message']['id'] for m in item.get('messagesAdded', []))
+        page_token = res.get('nextPageToken')
+        if not page_token: return list(dict.fromkeys(added)), res.get('historyId', history_id)
+
+
+def discover_pix_messages(db, service, log, full_resync=False):
+    """
+    Retorna (ids de mensagens candidatas, estado do histórico a salvar com save_history).
+    O estado só deve ser salvo depois que as mensagens forem gravadas com sucesso.
+    """
+    import time
+    from googleapiclient.errors import HttpError
+    state = None if full_resync else get_sync_state(db, 'gmail_history')
+    now = int(time.time())
+    if state and state.get('id'):
+        try:
+            added, history_id = list_added_messages(service, state['id'])
+            next_state = {'id': history_id, 'at': now}
+            if not added:
+                return [], next_state
+            # Entre as mensagens novas, só as que casam com a busca de Pix (uma listagem restrita por data)
+            since = int(state.get('at') or now) - HISTORY_QUERY_MARGIN_SECONDS
+            pix_ids = set(list_pix_messages(service, f'after:{since} {PIX_SUBJECTS}'))
+            return [msg_id for msg_id in added if msg_id in pix_ids], next_state
+        except HttpError as e:
+            if e.resp.status != 404: raise
+            log("[PIX] Histórico do Gmail expirado: refazendo a busca completa.")
+
+    # O historyId é lido antes da busca: o que chegar durante ela aparece na próxima execução
+    profile = service.users().getProfile(userId='me').execute()
+    return list_pix_messages(service), {'id': profile.get('historyId'), 'at': now}
+
+
+def save_history(db, history_state):
+    if history_state and history_state.get('id'):
+        set_sync_state(db, 'gmail_history', history_state)
+
+
+def processed_message_ids(db, msg_ids):
+    """Dos `msg_ids`, os que já constam no livro-razão (leitura pontual, sem carregar o histórico)"""
+    collection = db.collection(PROCESSED_EMAILS_COLLECTION)
+    processed = set()
+    for i in range(0, len(msg_ids), GET_ALL_CHUNK):
+        for doc in db.get_all([collection.document(msg_id) for msg_id in msg_ids[i:i + GET_ALL_CHUNK]]):
+            record('firestore_reads')
+            if doc.exists: processed.add(doc.id)
+    return processed
+
+
+def mark_processed(writer, db, msg_ids):
+    """Registra as mensagens no livro-razão (no mesmo lote dos registros) com data de expiração"""
+    from datetime import datetime, timedelta, timezone
+    now = datetime.now(timezone.utc)
+    expire_at = now + timedelta(days=PROCESSED_EMAIL_RETENTION_DAYS)
+    collection = db.collection(PROCESSED_EMAILS_COLLECTION)
+    for msg_id in msg_ids:
+        writer.set(collection.document(msg_id), {'processed_at': now, 'expire_at': expire_at})
+
+
+def parse_message(details):
+    """Registro de um e-mail no formato 'metadata': id, data (UTC), remetente, assunto e snippet"""
+    import time
+    from datetime import datetime, timezone
+    internal_date_ms = int(details.get('internalDate', time.time() * 1000))
+    headers = {h['name']: h['value'] for h in details.get('payload', {}).get('headers', [])}
+    return {
+        'id': details['id'],
+        'date': datetime.fromtimestamp(internal_date_ms / 1000.0, tz=timezone.utc),
+        'sender': headers.get('From', ''),
+        'subject': headers.get('Subject', ''),
+        'snippet': details.get('snippet', '')
+    }
+
+
+def fetch_pix_messages(service, msg_ids, log, batch_size=GMAIL_BATCH_SIZE):
+    """
+    Gera os registros das mensagens, lote a lote: cada lote é um BatchHttpRequest de gets
+    format='metadata' (sem corpo do e-mail). Mensagens com erro são registradas e puladas.
+    """
+    for i in range(0, len(msg_ids), batch_size):
+        records = []
+
+        def on_result(msg_id, response, error):
+            if error: log(f"[PIX] Erro ao ler mensagem {msg_id}: {error}")
+            else: records.append(parse_message(response))
+
+        execute_batch(service, [
+            (msg_id, lambda msg_id=msg_id: service.users().messages().get(
+                userId='me', id=msg_id, format='metadata', metadataHeaders=['Subject', 'From']))
+            for msg_id in msg_ids[i:i + batch_size]
+        ], on_result, batch_size, retry_reasons=GMAIL_RATE_LIMIT_REASONS)
+        yield from records
+
+
+# Janela em que o mesmo valor é considerado o mesmo Pix (notificações de instituições diferentes)
+DUPLICATE_WINDOW_SECONDS = 300
+# Campos lidos das coleções financeiras para montar o índice (projeção, sem o documento inteiro)
+DEDUP_FIELDS = ['description', 'amount', 'date', 'pix_id', 'google_message_id']
+
+
+def to_epoch(value):
+    """Data ISO (ou datetime) em segundos; None se ausente/inválida"""
+    from datetime import datetime
+    if not value: return None
+    try:
+        dt = value if isinstance(value, datetime) else datetime.fromisoformat(value.replace('Z', '+00:00'))
+        return dt.timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+class PixDedupIndex:
+    """
+    Índice de duplicidade de uma coleção financeira, com as mesmas três regras da varredura antiga:
+    1. mesmo pix_id (E2E ID); 2. mesmo valor a menos de 5 minutos; 3. mesma descrição e valor.
+    Hash para as regras 1 e 3 e, por valor, uma lista ordenada de datas consultada com bisect.
+    """
+
+    def __init__(self):
+        self.pix_ids = set()
+        self.description_amounts = set()
+        self.times_by_amount = {}
+
+    def add(self, description, amount, date, pix_id=None):
+        import bisect
+        if pix_id: self.pix_ids.add(pix_id)
+        self.description_amounts.add((description, amount))
+        ts = to_epoch(date)
+        if amount is not None and ts is not None:
+            bisect.insort(self.times_by_amount.setdefault(amount, []), ts)
+
+    def is_duplicate(self, description, amount, date, pix_id=None):
+        import bisect
+        if pix_id and pix_id in self.pix_ids: return True
+        if (description, amount) in self.description_amounts: return True
+        times, ts = self.times_by_amount.get(amount), to_epoch(date)
+        if not times or ts is None: return False
+        # Vizinhos da data na lista ordenada: basta checar o anterior e o seguinte
+        i = bisect.bisect_left(times, ts)
+        return any(abs(times[j] - ts) < DUPLICATE_WINDOW_SECONDS for j in (i - 1, i) if 0 <= j < len(times))
+
+
+def load_dedup_index(db, collection_name, google_ids):
+    """Monta o índice da coleção lendo só DEDUP_FIELDS; acumula em `google_ids` os e-mails já importados"""
+    index = PixDedupIndex()
+    for doc in db.collection(collection_name).select(DEDUP_FIELDS).stream():
+        record('firestore_reads')
+        data = doc.to_dict()
+        index.add(data.get('description'), data.get('amount'), data.get('date'), data.get('pix_id'))
+        if data.get('google_message_id'): google_ids.add(data['google_message_id'])
+    return index
+
+
+def ingest_pix_messages(db, service, writer, log, full_resync=False, on_decision=None):
+    """
+    Pipeline completo do Pix: descoberta, leitura em lote, parsing (pix_parser), deduplicação
+    contra o Financeiro e gravação via `writer`. `on_decision(msg_id, decisão)` é chamado para cada
+    mensagem lida com 'created', 'duplicate' ou 'unparsed' (usado pelo benchmarks/pix_replay.py).
+    Retorna os contadores da execução.
+    """
+    from pix_parser import parse_pix
+    from finance_fingerprints import fingerprints_ready, imported_message_ids, add_fingerprints
+    from finance_fingerprints import is_duplicate as fingerprint_duplicate
+    stats = {'candidates': 0, 'skipped': 0, 'fetched': 0, 'created': 0, 'duplicates': 0, 'unparsed': 0}
+
+    def decide(msg_id, decision, counter):
+        stats[counter] += 1
+        if on_decision: on_decision(msg_id, decision)
+
+    log("Buscando emails de Pix a partir de 01/02/2026...")
+    messages, history_state = discover_pix_messages(db, service, log, full_resync)
+
+    if not messages:
+        log("Nenhum Pix novo desde a última sincronização.")
+        save_history(db, history_state)
+        return stats
+
+    stats['candidates'] = len(messages)
+    log(f"Encontrados {len(messages)} e-mails potenciais de Pix. Analisando...")
+
+    # Índices das transações existentes para evitar duplicatas (Bloqueio de duplicidade financeira)
+    # Com finance_fingerprints pronto (backfill feito), cada e-mail consulta só as chaves com que pode
+    # colidir e os índices em memória guardam apenas o que esta execução criou; antes disso, as
+    # coleções são lidas por projeção e consultadas em O(1)/O(log n) por e-mail
+    use_fingerprints = fingerprints_ready(db)
+    existing_google_ids = set()
+    if use_fingerprints:
+        existing_transactions, existing_income = PixDedupIndex(), PixDedupIndex()
+    else:
+        existing_transactions = load_dedup_index(db, 'finance_transactions', existing_google_ids)
+        existing_income = load_dedup_index(db, 'finance_income', existing_google_ids)
+
+    # Livro-razão: consulta pontual só das mensagens candidatas
+    processed_ids = processed_message_ids(db, messages)
+    new_processed_ids = []
+
+    # Só as mensagens ainda não vistas são lidas, em lotes e apenas com os metadados
+    pending_ids = [msg_id for msg_id in messages if msg_id not in processed_ids and msg_id not in existing_google_ids]
+    if use_fingerprints and pending_ids:
+        imported = imported_message_ids(db, pending_ids)
+        pending_ids = [msg_id for msg_id in pending_ids if msg_id not in imported]
+    stats['skipped'] = len(messages) - len(pending_ids)
+    for message in fetch_pix_messages(service, pending_ids, log):
+        stats['fetched'] += 1
+        msg_id, dt, subject = message['id'], message['date'], message['subject']
+
+        # Valor, direção, contraparte e E2E ID pela regra do banco remetente (pix_parser)
+        parsed = parse_pix(subject, message['snippet'], message['sender'])
+        if not parsed:
+            decide(msg_id, 'unparsed', 'unparsed')
+            continue
+        amount, is_income, pix_id = parsed['amount'], parsed['is_income'], parsed['pix_id']
+        description = f"Pix: {subject}"
+
+        # Verificação de redundância aprimorada para evitar duplicatas de diferentes instituições
+        # (mesmo pix_id, mesmo valor em 5 minutos ou mesma descrição e valor)
+        target_cache = existing_income if is_income else existing_transactions
+        target_collection = 'finance_income' if is_income else 'finance_transactions'
+        if target_cache.is_duplicate(description, amount, dt, pix_id) or (
+                use_fingerprints and fingerprint_duplicate(db, target_collection, description, amount, dt, pix_id)):
+            new_processed_ids.append(msg_id)
+            decide(msg_id, 'duplicate', 'duplicates')
+            continue
+
+        new_record = {
+            'description': description, 'amount': amount, 'date': dt.isoformat(),
+            'google_message_id': msg_id, 'pix_id': pix_id, 'status': 'active'
+        }
+        if parsed['counterparty']: new_record['counterparty'] = parsed['counterparty']
+
+        if is_income:
+            new_record.update({
+                'day': dt.day, 'month': dt.month - 1, 'year': dt.year,
+                'category': 'Renda Extra', 'isReceived': True
+            })
+        else:
+            sprint = 1 if dt.day < 8 else 2 if dt.day < 15 else 3 if dt.day < 22 else 4
+            new_record.update({'sprint': sprint, 'category': 'Alimentação'})
+        ref = writer.create(db.collection(target_collection), new_record)
+        target_cache.add(description, amount, dt, pix_id)
+        # Impressões digitais no mesmo lote do registro
+        add_fingerprints(writer, db, target_collection, ref.id, new_record)
+        new_processed_ids.append(msg_id)
+        record('created')
+        decide(msg_id, 'created', 'created')
+        log(f"[PIX] {'Entrada' if is_income else 'Saída'}: {subject} (R$ {amount:.2f})")
+
+    mark_processed(writer, db, new_processed_ids)
+    # O historyId só avança depois que os registros foram gravados
+    if not writer.flush(): save_history(db, history_state)
+    return stats
@@ -0,0 +1,247 @@
+"""
+Agenda pré-calculada dos lembretes em 'reminder_schedule'.
+
+Cada lembrete (hábitos, pesagem, notificações customizadas e lembretes de ações) é um documento
+com o próximo disparo em UTC (`next_fire_at`). A agenda é recalculada quando configuracoes/geral
+ou uma tarefa com `reminder_at` muda. O check_and_send_reminders faz uma única consulta
+`next_fire_at <= agora`: os itens vencidos são reivindicados em lote, numa transação que também
+reagenda, marca as tarefas e cria as notificações (uma por minuto de disparo) no mesmo commit.
+Um tick atrasado (cold start) ainda encontra o lembrete, que antes só disparava no minuto exato.
+"""
+from sync_metrics import record
+
+REMINDER_SCHEDULE_COLLECTION = 'reminder_schedule'
+# Os horários (HH:mm) das configurações e o reminder_at das tarefas estão no horário de Brasília
+REMINDER_TIMEZONE = 'America/Sao_Paulo'
+# Até quantos dias à frente procurar a próxima ocorrência de uma regra (cobre o mensal)
+MAX_LOOKAHEAD_DAYS = 400
+SETTINGS_KINDS = ['habits', 'weighin', 'custom']
+# Lembretes por transação de disparo (cada um gera até 3 escritas; limite de 500 por commit)
+REMINDER_CLAIM_CHUNK = 100
+# Chave de system/sync_state gravada quando a agenda inteira já foi montada
+REMINDER_SCHEDULE_BUILT = 'reminder_schedule_built'
+# Por instância: depois de ver a flag, o tick não relê system/sync_state
+_schedule_built = False
+
+
+def _tz():
+    import pytz
+    return pytz.timezone(REMINDER_TIMEZONE)
+
+
+def rule_matches(entry, day):
+    """Se o lembrete ocorre no dia local `day` (mesmas regras do check antigo; dias da semana como no JS, 0=Dom)"""
+    rule = entry['rule']
+    js_day_of_week = (day.weekday() + 1) % 7
+    freq = rule.get('frequency', 'daily')
+    if entry['kind'] == 'weighin':
+        if js_day_of_week != rule.get('dayOfWeek', 1): return False
+        if freq == 'weekly': return True
+        # Lógica simplificada de biweekly baseada no número da semana
+        if freq == 'biweekly': return day.isocalendar()[1] % 2 == 0
+        return freq == 'monthly' and day.day == 1
+    if freq == 'daily': return True
+    if freq == 'weekly': return js_day_of_week in rule.get('daysOfWeek', [])
+    return freq == 'monthly' and day.day == rule.get('dayOfMonth', 1)
+
+
+def next_fire_at(entry, after):
+    """Próximo disparo (UTC) estritamente depois de `after` (datetime com fuso); None se não houver"""
+    from datetime import datetime, time, timedelta, timezone
+    tz = _tz()
+    try:
+        hour, minute = map(int, entry['rule']['time'].split(':'))
+    except (KeyError, ValueError, AttributeError):
+        return None
+    day = after.astimezone(tz).date()
+    for _ in range(MAX_LOOKAHEAD_DAYS):
+        if rule_matches(entry, day):
+            fire = tz.localize(datetime.combine(day, time(hour, minute)))
+            if fire > after: return fire.astimezone(timezone.utc)
+        day += timedelta(days=1)
+    return None
+
+
+def settings_entries(settings):
+    """Lembretes definidos em configuracoes/geral, por id de documento na agenda"""
+    notifs_config = (settings or {}).get('notifications', {}) or {}
+    entries = {}
+    habits = notifs_config.get('habitsReminder', {}) or {}
+    if habits.get('enabled') and habits.get('time'):
+        entries['habits'] = {
+            'kind': 'habits', 'rule': {'time': habits['time'], 'frequency': 'daily'},
+            'title': "Lembrete de Hábitos",
+            'message': "Hora de registrar seus hábitos de hoje para manter sua rotina nos trilhos!",
+            'n_type': 'info', 'link': 'saude'
+        }
+    weigh_in = notifs_config.get('weighInReminder', {}) or {}
+    if weigh_in.get('enabled') and weigh_in.get('time'):
+        entries['weighin'] = {
+            'kind': 'weighin',
+            'rule': {'time': weigh_in['time'], 'frequency': weigh_in.get('frequency', 'weekly'), 'dayOfWeek': weigh_in.get('dayOfWeek', 1)},
+            'title': "Lembrete de Pesagem",
+            'message': "Hora de registrar seu peso para acompanhar sua evolução no módulo Saúde!",
+            'n_type': 'info', 'link': 'saude'
+        }
+    for cn in notifs_config.get('custom', []) or []:
+        if cn.get('enabled') and cn.get('time'):
+            entries[f"custom_{cn.get('id')}"] = {
+                'kind': 'custom',
+                'rule': {'time': cn['time'], 'frequency': cn.get('frequency', 'daily'),
+                         'daysOfWeek': cn.get('daysOfWeek', []), 'dayOfMonth': cn.get('dayOfMonth', 1)},
+                'title': "Lembrete Personalizado", 'message': cn.get('message', 'Notificação Hermes'),
+                'n_type': 'info', 'link': None
+            }
+    return entries
+
+
+def rebuild_settings_schedule(db, settings, writer, now=None):
+    """
+    Sincroniza a agenda com as configurações: cria/atualiza os lembretes definidos e remove os
+    que deixaram de existir. Lembretes com a mesma regra mantêm o `next_fire_at` já agendado.
+    """
+    from datetime import datetime, timezone
+    now = now or datetime.now(timezone.utc)
+    collection = db.collection(REMINDER_SCHEDULE_COLLECTION)
+    existing = {}
+    for doc in collection.where('kind', 'in', SETTINGS_KINDS).stream():
+        record('firestore_reads')
+        existing[doc.id] = doc.to_dict()
+    entries = settings_entries(settings)
+    for doc_id, entry in entries.items():
+        current = existing.get(doc_id)
+        if current and all(current.get(k) == v for k, v in entry.items()) and current.get('next_fire_at'): continue
+        fire_at = next_fire_at(entry, now)
+        if fire_at: writer.set(collection.document(doc_id), {**entry, 'next_fire_at': fire_at})
+        elif current: writer.delete(collection.document(doc_id))
+    for doc_id in existing.keys() - entries.keys():
+        writer.delete(collection.document(doc_id))
+    return len(entries)
+
+
+def task_entry(data):
+    """Lembrete de uma tarefa (reminder_at local, sem fuso); None se não houver ou já foi enviado"""
+    from datetime import datetime, timezone
+    if not data or not data.get('reminder_at') or data.get('reminder_sent'): return None
+    try:
+        fire_at = datetime.fromisoformat(data['reminder_at'].replace('Z', '+00:00'))
+    except (TypeError, ValueError):
+        return None
+    if fire_at.tzinfo is None: fire_at = _tz().localize(fire_at)
+    return {
+        'kind': 'task', 'title': f"Lembrete: {data.get('titulo', 'Ação Pendente')}",
+        'message': "Está na hora de realizar esta ação agendada!",
+        'n_type': 'warning', 'link': 'acoes', 'next_fire_at': fire_at.astimezone(timezone.utc)
+    }
+
+
+def sync_task_reminder(db, task_id, before, after):
+    """Atualiza a agenda quando o lembrete da tarefa muda (sem leituras; nada a fazer no caso comum)"""
+    old, new = task_entry(before), task_entry(after)
+    if old == new: return
+    ref = db.collection(REMINDER_SCHEDULE_COLLECTION).document(f"task_{task_id}")
+    if new: ref.set({**new, 'task_id': task_id})
+    else: ref.delete()
+    record('firestore_writes')
+
+
+def merge_reminders(entries):
+    """Um único (título, mensagem, tipo, link) para lembretes do mesmo minuto"""
+    if len(entries) == 1:
+        entry = entries[0]
+        return entry['title'], entry['message'], entry.get('n_type', 'info'), entry.get('link')
+    links = {entry.get('link') for entry in entries}
+    n_type = 'warning' if any(entry.get('n_type') == 'warning' for entry in entries) else 'info'
+    return f"{len(entries)} Lembretes", "\n".join(entry['title'] for entry in entries), n_type, links.pop() if len(links) == 1 else None
+
+
+def dispatch_chunk(db, refs, now):
+    """
+    Uma transação para um bloco de lembretes vencidos: relê e reivindica os que ainda estão vencidos,
+    reagenda (ou remove os únicos), marca as tarefas como enviadas e cria as notificações — uma por
+    minuto de disparo — no mesmo commit. Outro tick concorrente que perca a corrida não envia nada.
+    Retorna (lembretes reivindicados, notificações criadas).
+    """
+    from google.cloud import firestore
+    from notification_buffer import notification_doc
+
+    def attempt(transaction):
+        due = []
+        for snapshot in db.get_all(refs, transaction=transaction):
+            record('firestore_reads')
+            entry = snapshot.to_dict() if snapshot.exists else None
+            if entry and entry.get('next_fire_at') and entry['next_fire_at'] <= now: due.append((snapshot.reference, entry))
+        # Todas as leituras antes das escritas: só marca as tarefas que ainda existem (uma apagada abortaria o lote)
+        task_refs = [db.collection('tarefas').document(entry['task_id']) for _, entry in due if entry.get('kind') == 'task' and entry.get('task_id')]
+        tasks = [snapshot.reference for snapshot in (db.get_all(task_refs, transaction=transaction) if task_refs else []) if snapshot.exists]
+        record('firestore_reads', len(task_refs))
+        by_minute = {}
+        for ref, entry in due:
+            following = next_fire_at(entry, now) if entry.get('kind') != 'task' else None
+            if following: transaction.update(ref, {'next_fire_at': following, 'last_fired_at': now})
+            else: transaction.delete(ref)
+            by_minute.setdefault(entry['next_fire_at'].replace(second=0, microsecond=0), []).append(entry)
+        for task_ref in tasks:
+            # Marca como enviado para não repetir (e o frontend não reexibir)
+            transaction.update(task_ref, {'reminder_sent': True})
+        for entries in by_minute.values():
+            notif_id, data = notification_doc(*merge_reminders(entries))
+            transaction.set(db.collection('notificacoes').document(notif_id), data)
+        return len(due), len(by_minute)
+
+    return firestore.transactional(attempt)(db.transaction())
+
+
+def dispatch_due_reminders(db, now=None, chunk_size=REMINDER_CLAIM_CHUNK):
+    """Uma consulta por intervalo (next_fire_at <= agora) e uma transação por bloco de itens vencidos"""
+    from datetime import datetime, timezone
+    now = now or datetime.now(timezone.utc)
+    refs = []
+    for doc in db.collection(REMINDER_SCHEDULE_COLLECTION).where('next_fire_at', '<=', now).stream():
+        record('firestore_reads')
+        refs.append(doc.reference)
+    claimed = notifications = 0
+    for i in range(0, len(refs), chunk_size):
+        chunk_claimed, chunk_notifications = dispatch_chunk(db, refs[i:i + chunk_size], now)
+        claimed, notifications = claimed + chunk_claimed, notifications + chunk_notifications
+    return claimed, notifications
+
+
+def rebuild_reminder_schedule(db, writer, log=print):
+    """
+    Reconstrói a agenda inteira: configurações + tarefas com lembrete pendente (comando rebuild-reminders
+    e a primeira execução do check_and_send_reminders). Sem falhas, marca a flag REMINDER_SCHEDULE_BUILT.
+    """
+    from sync_state import set_sync_state
+    settings_doc = db.collection('configuracoes').document('geral').get()
+    record('firestore_reads')
+    count = rebuild_settings_schedule(db, settings_doc.to_dict() if settings_doc.exists else {}, writer)
+    collection = db.collection(REMINDER_SCHEDULE_COLLECTION)
+    tasks = 0
+    for doc in db.collection('tarefas').where('reminder_sent', '==', False).stream():
+        record('firestore_reads')
+        entry = task_entry(doc.to_dict())
+        if entry:
+            writer.set(collection.document(f"task_{doc.id}"), {**entry, 'task_id': doc.id})
+            tasks += 1
+    failures = writer.flush()
+    log(f"Agenda de lembretes: {count} das configurações, {tasks} de tarefas. {len(failures)} falha(s).")
+    if not failures: set_sync_state(db, REMINDER_SCHEDULE_BUILT, True)
+    return count + tasks
+
+
+def ensure_reminder_schedule(db, log=print):
+    """
+    Monta a agenda na primeira execução depois do deploy: até lá 'reminder_schedule' está vazia e
+    nenhum lembrete dispararia. Uma leitura de system/sync_state por instância; True se reconstruiu.
+    """
+    global _schedule_built
+    from firestore_writer import BufferedWriter
+    from sync_state import get_sync_state
+    if _schedule_built: return False
+    if get_sync_state(db, REMINDER_SCHEDULE_BUILT):
+        _schedule_built = True
+        return False
+    # A flag só é gravada sem falhas: senão o próximo tick tenta de novo
+    rebuild_reminder_schedule(db, BufferedWriter(db, log), log)
+    return True
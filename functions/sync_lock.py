@@ -0,0 +1,153 @@
+"""
+Trava de execução única (lease) da sincronização completa, em system/sync_lock.
+
+on_sync_request, scheduled_sync e o `hermes_cli.py watch` podem disparar ao mesmo tempo; só quem
+obtém o lease (em transação) executa. O lease expira após SYNC_LEASE_SECONDS sem heartbeat, então
+uma instância que morreu no meio não trava as próximas. Um pedido manual que chega durante uma
+execução só marca `rerun_pending`: quem está com o lease roda de novo ao terminar, em vez de
+duas execuções simultâneas. O mesmo pedido visto pelo trigger e pelo CLI (mesmo `request_id`) não
+gera nova execução.
+"""
+import threading
+import time
+
+SYNC_LOCK_DOC = 'sync_lock'
+SYNC_LEASE_SECONDS = 180
+SYNC_HEARTBEAT_SECONDS = 45
+
+
+def get_lock_ref(db):
+    return db.collection('system').document(SYNC_LOCK_DOC)
+
+
+class SyncLease:
+    """
+    Lease de uma execução: acquire() → heartbeat em segundo plano → finish(), que devolve o
+    pedido pendente a executar em seguida (mantendo o lease) ou libera a trava.
+    """
+
+    def __init__(self, db, source, ttl=SYNC_LEASE_SECONDS, heartbeat=SYNC_HEARTBEAT_SECONDS):
+        import uuid
+        self.db = db
+        self.ref = get_lock_ref(db)
+        self.owner = f"{source}-{uuid.uuid4().hex[:8]}"
+        self.ttl = ttl
+        self.heartbeat = heartbeat
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _transaction(self, fn):
+        from google.cloud import firestore
+        return firestore.transactional(fn)(self.db.transaction())
+
+    def acquire(self, full_resync=False, trigger=None, request_id=None):
+        """Obtém o lease; se já houver execução em andamento, registra o pedido e retorna False"""
+        def attempt(transaction):
+            snapshot = self.ref.get(transaction=transaction)
+            lock = (snapshot.to_dict() or {}) if snapshot.exists else {}
+            now = time.time()
+            if lock.get('owner') and lock.get('expires_at', 0) > now:
+                # Pedido novo (manual) durante a execução: coalescido em uma nova rodada ao final
+                if request_id and request_id != lock.get('request_id'):
+                    transaction.update(self.ref, {
+                        'rerun_pending': True,
+                        'rerun_full': bool(lock.get('rerun_full')) or full_resync,
+                        'rerun_trigger': trigger,
+                        'rerun_request_id': request_id
+                    })
+                return False
+            transaction.set(self.ref, {
+                'owner': self.owner, 'acquired_at': now, 'expires_at': now + self.ttl,
+                'trigger': trigger, 'request_id': request_id,
+                'rerun_pending': False, 'rerun_full': False, 'rerun_trigger': None, 'rerun_request_id': None
+            })
+            return True
+
+        acquired = self._transaction(attempt)
+        if acquired: self._start_heartbeat()
+        return acquired
+
+    def _start_heartbeat(self):
+        def beat():
+            while not self._stop.wait(self.heartbeat):
+                try:
+                    if not self.renew(): self.lost = True; return
+                except Exception as e:
+                    print(f"Erro no heartbeat da trava de sincronização: {e}")
+
+        self._thread = threading.Thread(target=beat, daemon=True)
+        self._thread.start()
+
+    def renew(self):
+        """Estende o lease se ele ainda for nosso"""
+        def attempt(transaction):
+            snapshot = self.ref.get(transaction=transaction)
+            if (snapshot.to_dict() or {}).get('owner') != self.owner: return False
+            transaction.update(self.ref, {'expires_at': time.time() + self.ttl})
+            return True
+        return self._transaction(attempt)
+
+    def finish(self):
+        """
+        Ao fim de uma rodada: se houver pedido pendente, consome-o e mantém o lease, retornando
+        {'full_resync', 'trigger', 'request_id'}; senão libera a trava e retorna None.
+        """
+        def attempt(transaction):
+            snapshot = self.ref.get(transaction=transaction)
+            lock = snapshot.to_dict() or {}
+            if lock.get('owner') != self.owner: return None
+            if lock.get('rerun_pending'):
+                transaction.update(self.ref, {
+                    'expires_at': time.time() + self.ttl, 'trigger': lock.get('rerun_trigger'),
+                    'request_id': lock.get('rerun_request_id'),
+                    'rerun_pending': False, 'rerun_full': False, 'rerun_trigger': None, 'rerun_request_id': None
+                })
+                return {'full_resync': bool(lock.get('rerun_full')), 'trigger': lock.get('rerun_trigger'),
+                        'request_id': lock.get('rerun_request_id')}
+            transaction.update(self.ref, {'owner': None, 'expires_at': 0})
+            return None
+
+        rerun = self._transaction(attempt)
+        if rerun is None: self.stop()
+        return rerun
+
+    def stop(self):
+        self._stop.set()
+
+    def release(self):
+        """Libera a trava sem consumir pedidos pendentes (erro inesperado); o pedido fica para a próxima execução"""
+        self.stop()
+        def attempt(transaction):
+            snapshot = self.ref.get(transaction=transaction)
+            if (snapshot.to_dict() or {}).get('owner') == self.owner:
+                transaction.update(self.ref, {'owner': None, 'expires_at': 0})
+        try:
+            self._transaction(attempt)
+        except Exception as e:
+            print(f"Erro ao liberar a trava de sincronização: {e}")
+
+
+def run_single_flight(db, source, run, full_resync=False, trigger=None, request_id=None, log=print):
+    """
+    Executa run(full_resync, trigger) sob o lease, repetindo enquanto houver pedidos coalescidos.
+    Retorna False se outra execução estava em andamento (o pedido ficou registrado nela).
+    """
+    lease = SyncLease(db, source)
+    if not lease.acquire(full_resync, trigger, request_id):
+        log("Sincronização já em andamento: pedido coalescido com a execução atual.")
+        return False
+    try:
+        while True:
+            run(full_resync, trigger)
+            if lease.lost:
+                lease.stop()
+                log("Trava de sincronização perdida (lease expirado): encerrando sem nova rodada.")
+                return True
+            rerun = lease.finish()
+            if not rerun: return True
+            log("Pedido recebido durante a execução: iniciando nova rodada.")
+            full_resync, trigger = rerun['full_resync'], rerun['trigger']
+    except BaseException:
+        lease.release()
+        raise
@@ -0,0 +1,164 @@
+"""
+Telemetria das execuções de sincronização: tempo, chamadas à API do Google,
+leituras/escritas no Firestore e itens criados/atualizados/removidos por etapa.
+Cada execução vira um documento em sync_runs/{runId} e alimenta o resumo em system/sync_metrics.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+# Quantas execuções recentes entram no resumo móvel
+SUMMARY_WINDOW = 20
+
+_current = threading.local()
+
+
+class StageMetrics:
+    def __init__(self, name):
+        self.name = name
+        self.counters = {}
+        self.wall_ms = 0
+        self.lock = threading.Lock()
+
+    def incr(self, key, n=1):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def to_dict(self):
+        return {'wall_ms': self.wall_ms, **self.counters}
+
+
+class SyncMetrics:
+    """Métricas de uma execução; ative-a na thread (activate) e as etapas decoradas com @tracked registram nela"""
+
+    def __init__(self, source, trigger=None):
+        import uuid
+        from datetime import datetime
+        self.started_at = datetime.now()
+        self.run_id = f"{self.started_at.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+        self.source = source
+        self.trigger = trigger
+        self.stages = {}
+        self.status = 'running'
+        self._t0 = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def activate(self):
+        _current.run = self
+        return self
+
+    @contextmanager
+    def stage(self, name):
+        stage = StageMetrics(name)
+        with self.lock:
+            self.stages[name] = stage
+        previous = getattr(_current, 'stage', None)
+        _current.stage = stage
+        t0 = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            stage.wall_ms = int((time.perf_counter() - t0) * 1000)
+            _current.stage = previous
+
+    def to_dict(self):
+        from datetime import datetime
+        return {
+            'run_id': self.run_id, 'source': self.source, 'trigger': self.trigger, 'status': self.status,
+            'started_at': self.started_at.isoformat(), 'finished_at': datetime.now().isoformat(),
+            'wall_ms': int((time.perf_counter() - self._t0) * 1000),
+            'stages': {name: stage.to_dict() for name, stage in self.stages.items()}
+        }
+
+    def save(self, db, status='completed'):
+        """
+        Encerra a execução, grava sync_runs/{runId} e atualiza o resumo móvel das últimas execuções.
+        Falhas aqui são só registradas: telemetria nunca derruba a sincronização.
+        """
+        self.status = status
+        if current_run() is self: _current.run = None
+        run = self.to_dict()
+        try:
+            self._persist(db, run)
+        except Exception as e:
+            print(f"Erro ao gravar métricas da sincronização: {e}")
+        return run
+
+    def _persist(self, db, run):
+        db.collection('sync_runs').document(self.run_id).set(run)
+
+        summary_ref = db.collection('system').document('sync_metrics')
+        summary_doc = summary_ref.get()
+        recent = (summary_doc.to_dict() or {}).get('recent', []) if summary_doc.exists else []
+        recent = ([{
+            'run_id': run['run_id'], 'started_at': run['started_at'], 'status': run['status'], 'wall_ms': run['wall_ms'],
+            'stages': {name: stage.get('wall_ms', 0) for name, stage in run['stages'].items()}
+        }] + recent)[:SUMMARY_WINDOW]
+
+        # Médias de tempo por etapa na janela (para ver qual etapa cresce com os dados)
+        totals, counts = {}, {}
+        for item in recent:
+            for name, wall_ms in item.get('stages', {}).items():
+                totals[name] = totals.get(name, 0) + wall_ms
+                counts[name] = counts.get(name, 0) + 1
+        summary_ref.set({
+            'last_run_id': run['run_id'],
+            'recent': recent,
+            'avg_wall_ms': {name: int(totals[name] / counts[name]) for name in totals},
+            'avg_run_wall_ms': int(sum(item['wall_ms'] for item in recent) / len(recent))
+        })
+
+
+def current_run():
+    return getattr(_current, 'run', None)
+
+
+def record(key, n=1):
+    """Incrementa um contador da etapa corrente desta thread (no-op fora de uma execução medida)"""
+    stage = getattr(_current, 'stage', None)
+    if stage is not None and n:
+        stage.incr(key, n)
+
+
+def tracked(stage_name):
+    """Decorador: mede a função como a etapa `stage_name` da execução ativa na thread"""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            run = current_run()
+            if run is None:
+                return fn(*args, **kwargs)
+            with run.stage(stage_name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def bind_current_run(fn):
+    """Propaga a execução ativa para a thread do pool que vai rodar `fn`"""
+    run = current_run()
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        previous = current_run()
+        _current.run = run
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current.run = previous
+    return wrapper
+
+
+def counting_request_builder(*args, **kwargs):
+    """`requestBuilder` para googleapiclient build(): conta cada chamada executada na etapa corrente"""
+    from googleapiclient.http import HttpRequest
+    request = HttpRequest(*args, **kwargs)
+    execute = request.execute
+
+    def counted_execute(*a, **kw):
+        record('google_api_calls')
+        return execute(*a, **kw)
+
+    request.execute = counted_execute
+    return request
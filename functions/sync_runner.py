@@ -0,0 +1,118 @@
+"""Orquestração das etapas de sincronização em paralelo, com logs por acréscimo em sync_runs/{runId}/logs."""
+import threading
+import time
+
+# Tasks (push→pull), Calendar e Pix: uma thread por cadeia independente
+SYNC_MAX_WORKERS = 3
+# Uma página de log é gravada quando acumula LOG_PAGE_LINES linhas ou LOG_FLUSH_SECONDS desde a última
+LOG_PAGE_LINES = 50
+LOG_FLUSH_SECONDS = 1.2
+
+
+class LogStore:
+    """
+    Páginas append-only de log em sync_runs/{runId}/logs: {'seq', 'lines', 'at'}.
+    Cada página é um documento novo (nunca reescrito); o frontend as lê ordenadas por `seq`.
+    system/sync guarda só o cursor `log_run_id`, então gravar log não dispara o on_sync_request.
+    Thread-safe: as etapas logam em paralelo.
+    """
+
+    def __init__(self, db, run_id, page_lines=LOG_PAGE_LINES, flush_seconds=LOG_FLUSH_SECONDS):
+        self.collection = db.collection('sync_runs').document(run_id).collection('logs')
+        self.page_lines = page_lines
+        self.flush_seconds = flush_seconds
+        self.pending = []
+        self.seq = 0
+        self.lines = 0
+        self.last_flush = time.time()
+        self.lock = threading.Lock()
+
+    def append(self, line):
+        with self.lock:
+            self.pending.append(line)
+            due = len(self.pending) >= self.page_lines or time.time() - self.last_flush > self.flush_seconds
+        if due: self.flush()
+
+    def flush(self):
+        """Grava as linhas pendentes como uma nova página. Falhas só são impressas: log nunca derruba a sync."""
+        from datetime import datetime
+        from sync_metrics import record
+        with self.lock:
+            if not self.pending: return
+            lines, self.pending = self.pending, []
+            seq, self.seq = self.seq, self.seq + 1
+            self.lines += len(lines)
+            self.last_flush = time.time()
+            try:
+                self.collection.document(f"{seq:06d}").set({'seq': seq, 'lines': lines, 'at': datetime.now().isoformat()})
+                record('firestore_writes')
+            except Exception as e:
+                print(f"Erro ao gravar página de log: {e}")
+
+
+class StageLog(list):
+    """Buffer de log de uma etapa; cada linha também vai para o LogStore da execução, se houver"""
+
+    def __init__(self, run_logs):
+        super().__init__()
+        self.run_logs = run_logs
+
+    def append(self, line):
+        super().append(line)
+        if self.run_logs.store: self.run_logs.store.append(line)
+
+    def run_view(self):
+        return self.run_logs.merged()
+
+
+class RunLogs:
+    """
+    Logs de uma execução: cabeçalho + um StageLog por etapa, mesclados na ordem das etapas.
+    `notifications` (NotificationAggregator) recebe as linhas que geram notificação até o fim da execução;
+    `store` (LogStore) recebe todas as linhas, na ordem em que são produzidas.
+    """
+
+    def __init__(self, header=None, notifications=None, store=None):
+        self.header = list(header or [])
+        self.stages = []
+        self.notifications = notifications
+        self.store = store
+        if store:
+            for line in self.header: store.append(line)
+
+    def stage(self):
+        stage_log = StageLog(self)
+        self.stages.append(stage_log)
+        return stage_log
+
+    def merged(self):
+        return self.header + [line for stage_log in self.stages for line in stage_log]
+
+
+def flush_logs(logs):
+    """Grava já as linhas pendentes da execução (mensagens importantes, fim de etapa)"""
+    store = logs.run_logs.store if isinstance(logs, StageLog) else None
+    if store: store.flush()
+
+
+def run_stages(stages, run_logs, max_workers=SYNC_MAX_WORKERS):
+    """
+    Executa etapas independentes em um pool limitado de threads.
+    `stages` é uma lista de (nome, função) e cada função recebe seu próprio StageLog.
+    Retorna os logs mesclados quando todas terminam; uma exceção não tratada vira
+    linha de erro da própria etapa sem interromper as demais.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from datetime import datetime
+    from sync_metrics import bind_current_run
+    buffers = [(name, fn, run_logs.stage()) for name, fn in stages]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        # As métricas da execução acompanham cada etapa na thread do pool
+        futures = [(name, stage_log, pool.submit(bind_current_run(fn), stage_log)) for name, fn, stage_log in buffers]
+        for name, stage_log, future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                stage_log.append(f"[{datetime.now().strftime('%H:%M:%S')}] ERRO {name}: {e}")
+    if run_logs.store: run_logs.store.flush()
+    return run_logs.merged()
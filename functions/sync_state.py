@@ -0,0 +1,39 @@
+"""
+Estado persistente da sincronização (watermarks, tokens e cursores).
+
+Fica em system/sync_state e não em system/sync: o frontend sobrescreve
+system/sync inteiro a cada pedido manual e esse documento dispara on_sync_request.
+"""
+from sync_metrics import record
+
+SYNC_STATE_DOC = 'sync_state'
+
+
+def get_sync_state_ref(db):
+    return db.collection('system').document(SYNC_STATE_DOC)
+
+
+def get_sync_state(db, key, default=None):
+    """Lê uma chave de system/sync_state"""
+    doc = get_sync_state_ref(db).get()
+    record('firestore_reads')
+    if not doc.exists:
+        return default
+    return (doc.to_dict() or {}).get(key, default)
+
+
+def set_sync_state(db, key, value):
+    """Grava (merge) uma chave de system/sync_state"""
+    get_sync_state_ref(db).set({key: value}, merge=True)
+    record('firestore_writes')
+
+
+def get_tasks_watermark(db, tasklist_id):
+    """Retorna o maior `updated` já processado para a lista (ou None)"""
+    return (get_sync_state(db, 'tasks_watermark', {}) or {}).get(tasklist_id)
+
+
+def set_tasks_watermark(db, tasklist_id, updated):
+    # Merge em mapa aninhado: preserva os watermarks das outras listas
+    get_sync_state_ref(db).set({'tasks_watermark': {tasklist_id: updated}}, merge=True)
+    record('firestore_writes')
@@ -0,0 +1,195 @@
+"""
+Merge de três vias entre as tarefas locais ('tarefas') e o Google Tasks.
+
+Cada tarefa sincronizada guarda em `sync_base` a última versão acordada dos campos
+sincronizados (no formato do Google). Comparando local e Google com essa base, campo a
+campo, só o lado que mudou é propagado; campos alterados dos dois lados viram conflito
+em `sync_conflicts` e não são regravados em nenhum dos lados.
+"""
+import re
+from datetime import datetime
+
+# Campos sincronizados, na representação do Google Tasks
+MERGE_FIELDS = ('title', 'notes', 'status', 'due')
+
+TIME_BLOCK_PATTERN = r'\[Horário:\s*\d{2}:\d{2}\s*-\s*\d{2}:\d{2}\]'
+
+
+def extract_time_from_notes(notes):
+    if not notes: return None, None
+    match = re.search(r'\[Horário:\s*(\d{2}:\d{2})\s*-\s*(\d{2}:\d{2})\]', notes)
+    if match:
+        return match.group(1), match.group(2)
+    return None, None
+
+
+def update_notes_with_time(notes, start, end):
+    if not notes: notes = ""
+    new_block = f"[Horário: {start} - {end}]" if start and end else ""
+
+    if re.search(TIME_BLOCK_PATTERN, notes):
+        if new_block:
+            return re.sub(TIME_BLOCK_PATTERN, new_block, notes)
+        else:
+            return re.sub(TIME_BLOCK_PATTERN, '', notes).strip()
+    else:
+        if new_block:
+            return f"{notes}\n\n{new_block}".strip()
+        else:
+            return notes
+
+
+def default_end(start, end):
+    """Duração padrão de 1h se houver início mas não fim"""
+    if start and not end:
+        try:
+            h, m = map(int, start.split(':'))
+            return f"{(h+1)%24:02d}:{m:02d}"
+        except: pass
+    return end
+
+
+def local_view(task):
+    """Campos sincronizados da tarefa local, no formato do Google (notas já com o bloco de horário)"""
+    h_inicio = task.get('horario_inicio')
+    due = task.get('data_limite')
+    return {
+        'title': task.get('titulo'),
+        'notes': update_notes_with_time(task.get('notas') or '', h_inicio, default_end(h_inicio, task.get('horario_fim'))),
+        'status': 'completed' if task.get('status') == 'concluído' else 'needsAction',
+        'due': due if due and due != '-' else None
+    }
+
+
+def google_view(g_task):
+    """Campos sincronizados de uma tarefa do Google Tasks"""
+    due = g_task.get('due')
+    return {
+        'title': g_task.get('title', '(Sem Título)'),
+        'notes': g_task.get('notes', ''),
+        'status': 'completed' if g_task.get('status') == 'completed' else 'needsAction',
+        'due': due.split('T')[0] if due else None
+    }
+
+
+def local_wins(task, g_task):
+    """
+    Desempate por timestamp, usado só para tarefas ainda sem `sync_base`.
+    Uma tarefa suja com o mesmo `updated` do Google foi editada sem mudar data_atualizacao: vence o local.
+    """
+    local_updated, g_updated = task.get('data_atualizacao', '') or '', g_task.get('updated', '')
+    return local_updated > g_updated or bool(task.get('needs_push') and local_updated == g_updated)
+
+
+def three_way(base, local, remote, previous_conflicts=None):
+    """
+    Compara local e remoto com a base, campo a campo.
+    Retorna (push, pull, conflitos, nova base): push são os campos a enviar ao Google, pull
+    os a gravar localmente. Um conflito já registrado se resolve quando um dos lados muda de novo
+    (o lado que mudou vence); enquanto nada mudar, o mesmo registro é devolvido sem alteração.
+    """
+    previous = previous_conflicts or {}
+    push, pull, conflicts, new_base = {}, {}, {}, dict(base)
+    for field in MERGE_FIELDS:
+        b, l, r = base.get(field), local.get(field), remote.get(field)
+        if l == r:
+            new_base[field] = l
+        elif l == b:
+            pull[field] = new_base[field] = r
+        elif r == b:
+            push[field] = new_base[field] = l
+        else:
+            c = previous.get(field) or {}
+            if c and c.get('google') == r and c.get('local') != l:
+                push[field] = new_base[field] = l
+            elif c and c.get('local') == l and c.get('google') != r:
+                pull[field] = new_base[field] = r
+            elif c and (c.get('local'), c.get('google')) == (l, r):
+                conflicts[field] = c
+            else:
+                conflicts[field] = {'local': l, 'google': r, 'base': b, 'detectado_em': datetime.now().isoformat()}
+    return push, pull, conflicts, new_base
+
+
+def has_local_changes(task, base, conflicts=None):
+    """
+    Se a tarefa tem algo a enviar: campos diferentes da base, exceto os em conflito cujo valor local
+    ainda é o registrado no conflito (esses esperam um dos lados mudar; reenviar não resolve nada).
+    """
+    if base is None: return True
+    for field, value in local_view(task).items():
+        if value == base.get(field): continue
+        conflict = (conflicts or {}).get(field)
+        if not conflict or conflict.get('local') != value: return True
+    return False
+
+
+def synced_marks(task, base, conflicts=None):
+    """Campos gravados junto de toda escrita da sincronização; `needs_push` fica ligado só se ainda há diferença local"""
+    return {'sync_base': base, 'sync_conflicts': conflicts or {}, 'needs_push': has_local_changes(task, base, conflicts)}
+
+
+def google_body(fields, task):
+    """Corpo do patch no Google com apenas os campos alterados localmente"""
+    body = {}
+    for field, value in fields.items():
+        if field == 'due':
+            # Se houver horário de início, tentamos enviar no due
+            body['due'] = f"{value}T{task.get('horario_inicio') or '00:00'}:00Z" if value else None
+        else:
+            body[field] = value
+    return body
+
+
+def local_fields(fields, g_task):
+    """Converte os campos vindos do Google para o formato da coleção 'tarefas'"""
+    update = {}
+    if 'title' in fields: update['titulo'] = fields['title']
+    if 'notes' in fields:
+        h_inicio, h_fim = extract_time_from_notes(fields['notes'])
+        update.update({'notas': fields['notes'], 'horario_inicio': h_inicio, 'horario_fim': default_end(h_inicio, h_fim)})
+    if 'status' in fields:
+        update['status'] = 'concluído' if fields['status'] == 'completed' else 'em andamento'
+        update['data_conclusao'] = g_task.get('completed')
+    if 'due' in fields: update['data_limite'] = fields['due'] or '-'
+    return update
+
+
+class TaskMerge:
+    """
+    Resultado do merge de uma tarefa local com sua versão no Google.
+    Sem `g_task` (fora do snapshot incremental), o Google é considerado inalterado desde a
+    última sincronização: base + valores do Google já registrados em conflito.
+    """
+
+    def __init__(self, task, g_task=None):
+        self.task = task
+        self.g_task = g_task
+        stored_base = task.get('sync_base')
+        previous = task.get('sync_conflicts') or {}
+        local = local_view(task)
+        if g_task is not None:
+            remote = google_view(g_task)
+        else:
+            remote = {**(stored_base or {}), **{f: c.get('google') for f, c in previous.items()}}
+        if stored_base is None:
+            # Tarefa anterior ao merge: o lado com `updated` mais recente vence os campos divergentes
+            stored_base = remote if g_task is None or local_wins(task, g_task) else local
+        self.stored_base = stored_base
+        self.push, self.pull, self.conflicts, self.base = three_way(stored_base, local, remote, previous)
+        self.new_conflicts = [f for f, c in self.conflicts.items() if previous.get(f) != c]
+
+    def local_changes(self, extra=None, pushed=False):
+        """
+        Campos a gravar no documento local: os que vieram do Google, `extra` e as marcas de sync.
+        Sem `pushed`, os campos de `push` ainda não foram enviados: mantêm a base antiga (e needs_push).
+        Retorna {} quando nada mudou (nenhuma escrita).
+        """
+        update = local_fields(self.pull, self.g_task or {})
+        if self.pull and self.g_task: update['data_atualizacao'] = self.g_task.get('updated')
+        update.update(extra or {})
+        base = self.base if pushed else {**self.base, **{f: self.stored_base.get(f) for f in self.push}}
+        marks = synced_marks({**self.task, **update}, base, self.conflicts)
+        if not update and all(self.task.get(k) == v for k, v in marks.items()):
+            return {}
+        return {**update, **marks}
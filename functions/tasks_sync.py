@@ -0,0 +1,262 @@
+"""Rotinas compartilhadas da sincronização com o Google Tasks."""
+from sync_state import get_tasks_watermark
+from sync_metrics import record
+from task_merge import TaskMerge
+
+# Limite de valores do operador 'in' do Firestore
+FIRESTORE_IN_LIMIT = 30
+# Margem para diferença de relógio entre esta máquina e o Google ao fixar o watermark
+WATERMARK_SKEW_SECONDS = 60
+
+
+def list_google_tasks(service, tasklist_id, updated_min=None):
+    """
+    Percorre todas as páginas de tasks().list sem limite de itens.
+    Com `updated_min`, o Google devolve apenas as tarefas alteradas desde o watermark.
+    """
+    page_token = None
+    while True:
+        params = {
+            'tasklist': tasklist_id, 'showCompleted': True, 'showHidden': True,
+            'maxResults': 100, 'pageToken': page_token
+        }
+        if updated_min: params['updatedMin'] = updated_min
+        res = service.tasks().list(**params).execute()
+        record('google_pages')
+        for item in res.get('items', []):
+            yield item
+        page_token = res.get('nextPageToken')
+        if not page_token: break
+
+
+def listing_watermark(started_at, current=None):
+    """
+    Novo watermark da lista: o início da listagem menos WATERMARK_SKEW_SECONDS (RFC 3339, UTC).
+    Uma tarefa editada no Google durante a paginação tem `updated` posterior a esse instante e volta
+    na próxima execução, mesmo que seja anterior a tarefas já vistas em outra página.
+    """
+    from datetime import timedelta, timezone
+    watermark = (started_at - timedelta(seconds=WATERMARK_SKEW_SECONDS)).astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+    return max(watermark, current) if current else watermark
+
+
+def fetch_local_tasks_by_field(db, field, values):
+    """Busca em 'tarefas' apenas os documentos cujo `field` está em `values` (consultas 'in' em blocos)"""
+    values = [v for v in dict.fromkeys(values) if v]
+    docs = []
+    for i in range(0, len(values), FIRESTORE_IN_LIMIT):
+        chunk = values[i:i + FIRESTORE_IN_LIMIT]
+        docs.extend(db.collection('tarefas').where(field, 'in', chunk).stream())
+    record('firestore_reads', len(docs))
+    return docs
+
+
+def fetch_dirty_tasks(db):
+    """Tarefas com alterações locais pendentes de envio (marcadas por on_tarefa_written)"""
+    docs = list(db.collection('tarefas').where('needs_push', '==', True).stream())
+    record('firestore_reads', len(docs))
+    return docs
+
+
+# Mutações por BatchHttpRequest (o Google aceita até 1000, mas lotes menores evitam 429 na API Tasks)
+TASKS_BATCH_SIZE = 50
+
+
+def execute_tasks_batch(service, mutations, on_result, batch_size=TASKS_BATCH_SIZE):
+    """Mutações do Google Tasks em lotes HTTP (google_batch.execute_batch); a API Tasks sinaliza limite com 429"""
+    from google_batch import execute_batch
+    execute_batch(service, mutations, on_result, batch_size)
+
+
+def is_system_task(task):
+    """Tarefas geradas pelo próprio sistema (categoria SISTEMA), que não vão para o Google"""
+    cat = task.get('categoria', '')
+    return cat.startswith('SISTEMA:') or cat == 'SISTEMAS'
+
+
+def push_local_tasks(session, docs, writer, log, skip=None):
+    """
+    Envia ao Google as tarefas locais `docs` (lista já resolvida na `session`, snapshot carregado).
+    Exclusões viram delete; tarefas sem google_id, insert; as vinculadas passam pelo merge de três vias
+    (task_merge) e o patch leva só os campos alterados localmente, com os do Google no mesmo update.
+    As mutações vão em lotes HTTP (execute_tasks_batch) e os resultados atualizam a `session`, que o
+    pull reaproveita. `skip(tarefa)` pula a tarefa e só limpa a marca. Retorna quantas o Google confirmou.
+    """
+    from googleapiclient.errors import HttpError
+    from task_merge import local_view, synced_marks, google_body, default_end
+    service, tasklist_id = session.service, session.tasklist_id
+    mutations = []
+    pending = {} # doc.id -> (tipo, doc, tarefa local, visão inserida ou TaskMerge do patch)
+    for doc in docs:
+        t = doc.to_dict()
+        if skip and skip(t):
+            if t.get('needs_push'): writer.update(doc.reference, synced_marks(t, local_view(t)))
+            continue
+
+        g_id = t.get('google_id')
+        if t.get('status') == 'excluído':
+            if g_id:
+                mutations.append((doc.id, lambda g_id=g_id: service.tasks().delete(tasklist=tasklist_id, task=g_id)))
+                pending[doc.id] = ('delete', doc, t, None)
+            else:
+                writer.delete(doc.reference)
+            continue
+
+        if not g_id:
+            view = local_view(t)
+            body = google_body(view, t)
+            mutations.append((doc.id, lambda body=body: service.tasks().insert(tasklist=tasklist_id, body=body)))
+            pending[doc.id] = ('insert', doc, t, view)
+            continue
+
+        merge = session.merge(t)
+        if merge is None:
+            # Não existe mais no Google (listagem completa): só limpa a marca / grava a base local
+            if t.get('needs_push'): writer.update(doc.reference, synced_marks(t, local_view(t)))
+        elif merge.push:
+            # Patch apenas com os campos alterados localmente desde a base
+            body = google_body(merge.push, t)
+            mutations.append((doc.id, lambda g_id=g_id, body=body: service.tasks().patch(tasklist=tasklist_id, task=g_id, body=body)))
+            pending[doc.id] = ('update', doc, t, merge)
+        else:
+            # Nada a enviar: aplica o que mudou no Google e registra conflitos sem regravar
+            # (synced_marks desliga needs_push quando só restam campos em conflito)
+            update_data = merge.local_changes()
+            if update_data:
+                writer.update(doc.reference, update_data)
+                session.apply_local(doc.id, {**t, **update_data})
+            if merge.new_conflicts:
+                record('conflicts')
+                log(f"[!] CONFLITO: {t.get('titulo')} ({', '.join(merge.new_conflicts)}) - mantido sem sobrescrever.")
+
+    pushed = [0]
+
+    def on_result(key, response, error):
+        kind, doc, t, result = pending[key]
+        g_id, title = t.get('google_id'), t.get('titulo')
+        not_found = isinstance(error, HttpError) and error.resp.status == 404
+        if kind == 'delete':
+            if not error:
+                record('deleted')
+                log(f"[X] REMOVIDA DO GOOGLE: {title}")
+            elif not_found:
+                log(f"[!] Task {g_id} já não existia no Google.")
+            else:
+                log(f"[!] Erro ao deletar no Google: {error}")
+            writer.delete(doc.reference)
+            session.forget(g_id)
+        elif error and not_found:
+            # Mantém needs_push para ser reenviada como nova na próxima execução
+            log(f"[!] Task {g_id} não encontrada no Google - Limpando ID para re-envio.")
+            writer.update(doc.reference, {'google_id': None})
+            session.forget(g_id)
+        elif error:
+            log(f"ERRO PUSH ({title}): {error}")
+        else:
+            # Grava de volta o id/updated devolvidos pelo Google e a nova base
+            extra = {'google_id': response['id'], 'data_atualizacao': response.get('updated')}
+            if kind == 'insert':
+                extra.update({'notas': result['notes'], 'horario_fim': default_end(t.get('horario_inicio'), t.get('horario_fim'))})
+                update_data = {**extra, **synced_marks({**t, **extra}, result)}
+            else:
+                if 'notes' in result.push: extra['notas'] = result.push['notes']
+                update_data = result.local_changes(extra, pushed=True)
+            writer.update(doc.reference, update_data)
+            session.apply_push(doc.id, {**t, **update_data}, response)
+            record('created' if kind == 'insert' else 'updated')
+            log(f"[+] ENVIADA: {title}" if kind == 'insert' else f"[^] ATUALIZADA NO GOOGLE: {title} ({', '.join(result.push)})")
+            pushed[0] += 1
+
+    if mutations:
+        log(f"Enviando {len(mutations)} alteração(ões) em lotes...")
+        execute_tasks_batch(service, mutations, on_result)
+    return pushed[0]
+
+
+class TasksSyncSession:
+    """
+    Estado de uma execução de sync compartilhado entre push e pull: lista resolvida,
+    snapshot das tarefas do Google e índice local por google_id. O push atualiza o
+    snapshot no lugar, então o pull reaproveita tudo sem listar nem ler de novo.
+    """
+
+    def __init__(self, db, service, full_resync=False):
+        self.db = db
+        self.service = service
+        self.full_resync = full_resync
+        self.tasklist_id = None
+        self.tasklist_title = None
+        self.watermark = None
+        self.next_watermark = None
+        self.google_tasks = None # id -> tarefa do Google (alteradas desde o watermark, ou todas)
+        self.local_by_google_id = {} # google_id -> (doc_id, dados)
+        self.all_local_docs = None # preenchido só quando a coleção inteira é lida (full_resync)
+
+    def resolve_tasklist(self, matches):
+        """Resolve (uma única vez por execução) a primeira lista cujo título satisfaz `matches`"""
+        if self.tasklist_id is None:
+            results = self.service.tasklists().list().execute()
+            item = next((item for item in results.get('items', []) if matches(item['title'])), None)
+            if item: self.tasklist_id, self.tasklist_title = item['id'], item['title']
+        return self.tasklist_id
+
+    def load_google_tasks(self):
+        """Lista as tarefas do Google uma única vez (incremental a partir do watermark, salvo full_resync)"""
+        if self.google_tasks is None:
+            from datetime import datetime, timezone
+            self.watermark = None if self.full_resync else get_tasks_watermark(self.db, self.tasklist_id)
+            started_at = datetime.now(timezone.utc)
+            g_tasks = list(list_google_tasks(self.service, self.tasklist_id, updated_min=self.watermark))
+            self.google_tasks = {gt['id']: gt for gt in g_tasks}
+            # Fixado no início da listagem: o que mudar depois (inclusive pelo push) volta na próxima execução
+            self.next_watermark = listing_watermark(started_at, self.watermark)
+        return self.google_tasks
+
+    def _index(self, docs):
+        for doc in docs:
+            data = doc.to_dict()
+            if data.get('google_id'): self.local_by_google_id[data['google_id']] = (doc.id, data)
+        return docs
+
+    def load_all_local(self):
+        """Lê a coleção 'tarefas' inteira uma única vez e indexa por google_id"""
+        if self.all_local_docs is None:
+            self.all_local_docs = self._index(list(self.db.collection('tarefas').stream()))
+            record('firestore_reads', len(self.all_local_docs))
+        return self.all_local_docs
+
+    def load_dirty_local(self):
+        return self._index(fetch_dirty_tasks(self.db))
+
+    def local_tasks_for(self, google_ids):
+        """Tarefas locais vinculadas a `google_ids`, lendo do Firestore só as que ainda não estão no índice"""
+        if self.all_local_docs is None:
+            missing = [g_id for g_id in google_ids if g_id not in self.local_by_google_id]
+            self._index(fetch_local_tasks_by_field(self.db, 'google_id', missing))
+        return {g_id: self.local_by_google_id[g_id] for g_id in google_ids if g_id in self.local_by_google_id}
+
+    def merge(self, task):
+        """
+        Merge de três vias da tarefa local com sua versão no snapshot do Google.
+        Retorna None quando a listagem foi completa e a tarefa não existe mais no Google.
+        """
+        g_task = self.google_tasks.get(task.get('google_id'))
+        if g_task is None and self.watermark is None:
+            return None
+        # Incremental: fora do snapshot significa que o Google não mudou desde o watermark
+        return TaskMerge(task, g_task)
+
+    def apply_local(self, doc_id, local_data):
+        """Atualiza o índice local com o que a sync acabou de gravar (o pull não regrava a tarefa)"""
+        if local_data.get('google_id'): self.local_by_google_id[local_data['google_id']] = (doc_id, local_data)
+
+    def apply_push(self, doc_id, local_data, g_task):
+        """Registra no snapshot o resultado de um insert/patch bem-sucedido no Google"""
+        self.local_by_google_id.pop(local_data.get('google_id'), None)
+        self.google_tasks[g_task['id']] = g_task
+        self.apply_local(doc_id, {**local_data, 'google_id': g_task['id']})
+
+    def forget(self, google_id):
+        """Remove a tarefa do snapshot (excluída no Google ou desvinculada após 404)"""
+        self.google_tasks.pop(google_id, None)
+        self.local_by_google_id.pop(google_id, None)
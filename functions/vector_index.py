@@ -0,0 +1,195 @@
+"""Índice vetorial local (NumPy, em disco com mmap) dos trechos de 'processos_conhecimento' para busca semântica."""
+import json
+import os
+import tempfile
+import threading
+import time
+
+from sync_metrics import record
+from knowledge_chunks import KNOWLEDGE_COLLECTION
+
+DEFAULT_INDEX_PATH = os.path.join(tempfile.gettempdir(), 'hermes_vector_index')
+# Intervalo mínimo entre consultas de documentos novos ao Firestore
+REFRESH_INTERVAL_SECONDS = 60
+META_FIELDS = ('task_id', 'file_id', 'nome', 'chunk_index', 'start', 'end')
+
+
+def normalize(vectors):
+    import numpy as np
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return (vectors / np.maximum(norms, 1e-12)).astype(np.float32)
+
+
+class IndexState:
+    """Matriz e linhas de uma versão do índice; nunca alterado depois de publicado"""
+
+    def __init__(self, matrix=None, rows=None):
+        import numpy as np
+        self.matrix = matrix
+        self.rows = rows or []
+        self.positions = {row['id']: i for i, row in enumerate(self.rows)}
+        self.task_ids = np.array([row.get('task_id') or '' for row in self.rows], dtype=object)
+
+
+class VectorIndex:
+    """
+    Matriz normalizada (n x d) + metadados por linha, persistida em disco com mmap. Cada alteração
+    monta um IndexState novo e o publica numa única atribuição: a busca lê sempre uma versão inteira.
+    """
+
+    def __init__(self, path=DEFAULT_INDEX_PATH, refresh_interval=REFRESH_INTERVAL_SECONDS):
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self.state = IndexState()
+        self.synced_at = None
+        self.refreshed_at = 0
+        # Requisições simultâneas na mesma instância: uma atualização por vez (refresh chama upsert)
+        self.lock = threading.RLock()
+        self.load()
+
+    def load(self):
+        """Abre o índice salvo (matriz via mmap); sem arquivos, começa vazio"""
+        import numpy as np
+        try:
+            with open(f"{self.path}.json", encoding='utf-8') as f:
+                table = json.load(f)
+            matrix = np.load(f"{self.path}.npy", mmap_mode='r')
+        except (OSError, ValueError):
+            return False
+        if len(matrix) != len(table.get('rows', [])): return False
+        self.state, self.synced_at = IndexState(matrix, table['rows']), table.get('synced_at')
+        return True
+
+    def save(self):
+        """Grava matriz e tabela em arquivos temporários e os troca atomicamente"""
+        import numpy as np
+        state = self.state
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(f"{self.path}.tmp.npy", 'wb') as f:
+            np.save(f, state.matrix)
+        with open(f"{self.path}.tmp.json", 'w', encoding='utf-8') as f:
+            json.dump({'synced_at': self.synced_at, 'rows': state.rows}, f)
+        for suffix in ('npy', 'json'):
+            os.replace(f"{self.path}.tmp.{suffix}", f"{self.path}.{suffix}")
+
+    def __len__(self):
+        return len(self.state.rows)
+
+    def upsert(self, docs):
+        """
+        Inclui/atualiza [(id, dados)] com 'embedding': substitui linhas existentes, acrescenta as
+        novas e remove o vetor antigo (sem chunk_index) dos arquivos que ganharam trechos.
+        """
+        with self.lock:
+            return self._upsert(docs)
+
+    def _upsert(self, docs):
+        import numpy as np
+        docs = [(doc_id, data) for doc_id, data in docs if data.get('embedding')]
+        if not docs: return 0
+        vectors = normalize(np.asarray([data['embedding'] for _, data in docs], dtype=np.float32))
+        state = self.state
+        matrix = np.array(state.matrix, dtype=np.float32) if state.matrix is not None else np.empty((0, vectors.shape[1]), np.float32)
+        rows = list(state.rows)
+        positions = dict(state.positions)
+
+        chunked_files = {data.get('file_id') for _, data in docs if data.get('chunk_index') is not None}
+        stale = [i for i, row in enumerate(rows) if row.get('chunk_index') is None and row.get('file_id') in chunked_files]
+        if stale:
+            keep = np.ones(len(rows), dtype=bool)
+            keep[stale] = False
+            matrix, rows = matrix[keep], [row for row, kept in zip(rows, keep) if kept]
+            positions = {row['id']: i for i, row in enumerate(rows)}
+
+        appended = []
+        for (doc_id, data), vector in zip(docs, vectors):
+            row = {'id': doc_id, **{field: data.get(field) for field in META_FIELDS}}
+            if doc_id in positions:
+                matrix[positions[doc_id]] = vector
+                rows[positions[doc_id]] = row
+            else:
+                positions[doc_id] = len(rows) + len(appended)
+                appended.append((row, vector))
+        if appended:
+            added = np.stack([vector for _, vector in appended])
+            matrix = np.concatenate([matrix, added])
+            rows.extend(row for row, _ in appended)
+        # Publicação única: buscas em andamento seguem com a versão anterior
+        self.state = IndexState(np.ascontiguousarray(matrix), rows)
+        return len(docs)
+
+    def refresh(self, db, force=False, log=None):
+        """Busca os documentos vetorizados depois do watermark e salva o índice se algo mudou"""
+        if not force and time.time() - self.refreshed_at < self.refresh_interval: return 0
+        with self.lock:
+            if not force and time.time() - self.refreshed_at < self.refresh_interval: return 0
+            return self._refresh(db, log)
+
+    def _refresh(self, db, log):
+        from datetime import datetime
+        self.refreshed_at = time.time()
+        query = db.collection(KNOWLEDGE_COLLECTION)
+        if self.synced_at:
+            # >=: documentos do mesmo commit têm o mesmo timestamp; os já indexados no watermark são ignorados
+            query = query.where('data_vetorizacao', '>=', datetime.fromisoformat(self.synced_at))
+        docs, latest, positions = [], self.synced_at, self.state.positions
+        for doc in query.stream():
+            record('firestore_reads')
+            data = doc.to_dict() or {}
+            stamp = data.get('data_vetorizacao')
+            if stamp and stamp.isoformat() == self.synced_at and doc.id in positions: continue
+            docs.append((doc.id, data))
+            if stamp and (latest is None or stamp.isoformat() > latest): latest = stamp.isoformat()
+        changed = self.upsert(docs)
+        if changed or latest != self.synced_at:
+            self.synced_at = latest
+            self.save()
+            if log: log(f"Índice vetorial: {changed} documento(s) atualizado(s), {len(self)} no total.")
+        return changed
+
+    def rebuild(self, db, log=None):
+        """Descarta o índice e relê a coleção inteira (documentos apagados saem do índice)"""
+        with self.lock:
+            self.state, self.synced_at = IndexState(), None
+            return self.refresh(db, force=True, log=log)
+
+    def search(self, query_vector, k=5, task_id=None):
+        """
+        Top-k por cosseno exato: [(score, linha)] em ordem decrescente; `task_id` restringe a um processo.
+        Um produto matriz-vetor sobre a matriz inteira (~13 ms para 50 mil trechos de 768 dimensões).
+        """
+        import numpy as np
+        state = self.state
+        if state.matrix is None or not len(state.rows): return []
+        scores = state.matrix @ normalize(np.asarray(query_vector, dtype=np.float32))
+        if task_id: scores = np.where(state.task_ids == task_id, scores, -np.inf)
+        k = max(int(k), 1)
+        best = np.argpartition(-scores, k - 1)[:k] if len(scores) > k else np.arange(len(scores))
+        best = best[np.argsort(-scores[best])]
+        return [(float(scores[i]), state.rows[i]) for i in best if np.isfinite(scores[i])]
+
+
+def embed_query(text):
+    """Vetor da consulta (retrieval_query); o google.generativeai já deve estar configurado"""
+    import google.generativeai as genai
+    from knowledge_chunks import EMBED_MODEL
+    record('gemini_embed_calls')
+    return genai.embed_content(model=EMBED_MODEL, content=text, task_type="retrieval_query")['embedding']
+
+
+def search_knowledge(db, index, query, k=5, task_id=None):
+    """
+    Busca semântica: atualiza o índice (no máximo a cada intervalo), vetoriza a consulta e devolve os
+    k trechos mais próximos com o texto (um get_all só dos resultados).
+    Numa instância fria sem o índice em disco, o primeiro refresh lê a coleção inteira (uma leitura por
+    trecho, alguns segundos para dezenas de milhares); as buscas seguintes só trazem os documentos novos.
+    """
+    index.refresh(db)
+    hits = index.search(embed_query(query), k, task_id)
+    if not hits: return []
+    collection = db.collection(KNOWLEDGE_COLLECTION)
+    texts = {}
+    for doc in db.get_all([collection.document(row['id']) for _, row in hits]):
+        record('firestore_reads')
+        if doc.exists: texts[doc.id] = (doc.to_dict() or {}).get('texto')
+    return [{**row, 'score': score, 'texto': texts.get(row['id'])} for score, row in hits if row['id'] in texts]
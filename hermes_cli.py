@@ -5,7 +5,8 @@ import re
 import os
 import sys
 import base64
-from datetime import datetime, timezone, timedelta
+from datetime import datetime, timedelta
+from functools import partial
 import firebase_admin
 from firebase_admin import credentials, firestore
 import time
@@ -16,9 +17,26 @@ from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
 from google.auth.exceptions import RefreshError
 
+# Módulos de sincronização compartilhados com as Cloud Functions (functions/)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'functions'))
+from sync_state import set_tasks_watermark
+from firestore_writer import BufferedWriter
+from sync_runner import RunLogs, LogStore, run_stages, flush_logs
+from sync_lock import run_single_flight
+from sync_metrics import SyncMetrics, tracked, record, counting_request_builder
+from tasks_sync import TasksSyncSession, fetch_local_tasks_by_field, push_local_tasks
+from calendar_sync import sync_calendar_events
+from pix_sync import ingest_pix_messages
+from finance_fingerprints import backfill_fingerprints
+from reminder_schedule import rebuild_reminder_schedule
+from knowledge_chunks import configure_gemini, reembed_knowledge
+from vector_index import VectorIndex, search_knowledge
+from task_merge import (
+    TaskMerge, extract_time_from_notes, default_end, google_view, synced_marks
+)
+
 # Escopos para Google APIs (Tasks e Gmail Readonly)
 SCOPES = [
     'https://www.googleapis.com/auth/tasks',
@@ -94,13 +112,13 @@ def get_google_creds():
     return creds
 
 def get_tasks_service():
-    return build('tasks', 'v1', credentials=get_google_creds())
+    return build('tasks', 'v1', credentials=get_google_creds(), requestBuilder=counting_request_builder)
 
 def get_gmail_service():
-    return build('gmail', 'v1', credentials=get_google_creds())
+    return build('gmail', 'v1', credentials=get_google_creds(), requestBuilder=counting_request_builder)
 
 def get_calendar_service():
-    return build('calendar', 'v3', credentials=get_google_creds())
+    return build('calendar', 'v3', credentials=get_google_creds(), requestBuilder=counting_request_builder)
 
 def cleanup_old_sync_badges(db, log_func=None):
     def log(msg):
@@ -115,425 +133,189 @@ def cleanup_old_sync_badges(db, log_func=None):
         query = db.collection('tarefas').where(filter=FieldFilter('last_sync_date', '<', limite)).where(filter=FieldFilter('sync_status', 'in', ['new', 'updated']))
         tarefas_antigas = query.stream()
         
+        writer = BufferedWriter(db, log)
         count = 0
         for tarefa in tarefas_antigas:
-            db.collection('tarefas').document(tarefa.id).update({'sync_status': 'synced'})
+            writer.update(db.collection('tarefas').document(tarefa.id), {'sync_status': 'synced'})
             count += 1
+        record('firestore_reads', count)
+        writer.flush()
         if count > 0: log(f"🧹 Limpeza: {count} badge(s) antigo(s) removido(s).")
     except Exception as e:
         log(f"Aviso: Erro na limpeza de badges: {e}")
 
-def extract_time_from_notes(notes):
-    if not notes: return None, None
-    match = re.search(r'\[Horário:\s*(\d{2}:\d{2})\s*-\s*(\d{2}:\d{2})\]', notes)
-    if match:
-        return match.group(1), match.group(2)
-    return None, None
-
-def update_notes_with_time(notes, start, end):
-    if not notes: notes = ""
-    pattern = r'\[Horário:\s*\d{2}:\d{2}\s*-\s*\d{2}:\d{2}\]'
-    new_block = f"[Horário: {start} - {end}]" if start and end else ""
-    
-    if re.search(pattern, notes):
-        if new_block:
-            return re.sub(pattern, new_block, notes)
-        else:
-            return re.sub(pattern, '', notes).strip()
-    else:
-        if new_block:
-            return f"{notes}\n\n{new_block}".strip()
-        else:
-            return notes
-
-def sync_google_tasks(db, log_list=None, sync_ref=None):
-    last_ui_update = [0]
-    def log(msg, force_ui=False):
-        print(msg)
-        if log_list is not None: 
-            log_list.append(f"[{datetime.now().strftime('%H:%M:%S')}] {msg}")
-            now_ts = time.time()
-            if sync_ref and (force_ui or now_ts - last_ui_update[0] > 1.2):
-                try: sync_ref.update({'logs': log_list}); last_ui_update[0] = now_ts
-                except: pass
+def is_target_tasklist(title):
+    """Identifica a lista 'tarefa-gerais' (tolerando espaços e plurais no título)"""
+    target_name = 'tarefa-gerais'
+    clean_title = title.lower().replace(' ', '-').replace('s', '') if 'tarefa' in title.lower() else title.lower()
+    return title.lower() == target_name or clean_title == target_name.replace('s', '')
+
+def stage_log(log_list, msg, force_ui=False):
+    """Imprime e acrescenta a linha ao StageLog da etapa (sync_runs/{runId}/logs); force_ui grava a página já"""
+    print(msg)
+    if log_list is not None:
+        log_list.append(f"[{datetime.now().strftime('%H:%M:%S')}] {msg}")
+        if force_ui: flush_logs(log_list)
+
+@tracked('tasks_pull')
+def sync_google_tasks(db, log_list=None, sync_ref=None, full_resync=False, session=None):
+    log = partial(stage_log, log_list)
 
+    writer = BufferedWriter(db, log)
     try:
-        service = get_tasks_service()
-        results = service.tasklists().list().execute()
-        tasklists = results.get('items', [])
-        tasklist_id = None
-        target_name = 'tarefa-gerais'
-        for item in tasklists:
-            clean_title = item['title'].lower().replace(' ', '-').replace('s', '') if 'tarefa' in item['title'].lower() else item['title'].lower()
-            if item['title'].lower() == target_name or clean_title == target_name.replace('s', ''):
-                tasklist_id = item['id']
-                log(f"Iniciando PULL de: {item['title']}")
-                break
+        # Reaproveita a sessão do push (lista, snapshot do Google e índice local) quando houver
+        session = session or TasksSyncSession(db, get_tasks_service(), full_resync)
+        tasklist_id = session.resolve_tasklist(is_target_tasklist)
         if not tasklist_id:
             log("ERRO: Lista não encontrada.")
             return
+        log(f"Iniciando PULL de: {session.tasklist_title}")
 
-        g_tasks = []
-        next_page_token = None
-        while True:
-            g_results = service.tasks().list(tasklist=tasklist_id, showCompleted=True, showHidden=True, maxResults=100, pageToken=next_page_token).execute()
-            items = g_results.get('items', [])
-            g_tasks.extend(items)
-            if len(g_tasks) >= 200 or not g_results.get('nextPageToken'): break
-            next_page_token = g_results.get('nextPageToken')
+        # Incremental: só o que mudou desde o último watermark (full_resync relista tudo)
+        g_tasks = list(session.load_google_tasks().values())
+        watermark = session.watermark
 
-        log(f"Total de {len(g_tasks)} tarefas identificadas no Google. Analisando...", force_ui=True)
+        if watermark:
+            log(f"PULL incremental desde {watermark}: {len(g_tasks)} tarefa(s) alterada(s) no Google.", force_ui=True)
+        else:
+            log(f"Total de {len(g_tasks)} tarefas identificadas no Google. Analisando...", force_ui=True)
         dynamic_mapping = get_units_mapping(db)
-        local_docs = db.collection('tarefas').get()
+        if watermark:
+            # Lê apenas as tarefas locais vinculadas às alteradas (ou homônimas, para vincular)
+            linked = session.local_tasks_for([gt['id'] for gt in g_tasks])
+            unlinked_titles = [gt.get('title', '(Sem Título)') for gt in g_tasks if gt['id'] not in linked]
+            local_docs = fetch_local_tasks_by_field(db, 'titulo', unlinked_titles)
+        else:
+            local_docs = session.load_all_local()
+            linked = session.local_by_google_id
+        # Vinculadas vêm do índice da sessão (já refletem o push); as demais só entram pelo título
         local_tasks = {}
+        linked_doc_ids = {doc_id for doc_id, _ in session.local_by_google_id.values()}
         for t in local_docs:
             d = t.to_dict()
-            gid = d.get('google_id')
-            if gid: local_tasks[gid] = (t.id, d)
-            else: local_tasks[f"title_{d.get('titulo')}"] = (t.id, d)
+            if d.get('google_id') or t.id in linked_doc_ids or d.get('status') == 'excluído': continue
+            local_tasks[f"title_{d.get('titulo')}"] = (t.id, d)
+        local_tasks.update(linked)
 
         for gt in g_tasks:
             g_id = gt['id']
             title = gt.get('title', '(Sem Título)')
-            g_updated = gt.get('updated', '')
-            due = gt.get('due', None)
-            deadline = due.split('T')[0] if due else '-'
-            h_status = 'concluído' if gt.get('status') == 'completed' else 'em andamento'
-            
-            # Extração de horários das notas
-            g_notes = gt.get('notes', '')
-            h_inicio, h_fim = extract_time_from_notes(g_notes)
-            
-            # Duração padrão de 1h se houver início mas não fim
-            if h_inicio and not h_fim:
-                try:
-                    h, m = map(int, h_inicio.split(':'))
-                    h_fim = f"{(h+1)%24:02d}:{m:02d}"
-                except: pass
-
-            categoria, sistema, contabilizar_meta = classify_task(title, g_notes, dynamic_mapping)
             existing_data = local_tasks.get(g_id) or local_tasks.get(f"title_{title}")
             
             if existing_data:
                 doc_id, t_old = existing_data
-                if not t_old.get('google_id'):
-                    db.collection('tarefas').document(doc_id).update({
-                        'google_id': g_id, 
-                        'data_atualizacao': g_updated, 
-                        'notas': g_notes,
-                        'horario_inicio': h_inicio,
-                        'horario_fim': h_fim
-                    })
+                linking = not t_old.get('google_id')
+                if linking:
+                    # Vincula pelo título; sem base ainda, o `updated` mais recente decide os campos divergentes
+                    t_old = {**t_old, 'google_id': g_id}
+
+                # Merge campo a campo com a base: só grava o que mudou no Google (ou nada)
+                merge = TaskMerge(t_old, gt)
+                extra = {'google_id': g_id} if linking else {}
+                if merge.pull: extra.update({'sync_status': 'updated', 'last_sync_date': datetime.now().isoformat()})
+                update_data = merge.local_changes(extra)
+                if update_data:
+                    writer.update(db.collection('tarefas').document(doc_id), update_data)
+                    session.apply_local(doc_id, {**t_old, **update_data})
+
+                if linking:
+                    record('updated')
                     log(f"[*] VINCULADA: {title}")
-                    continue
-                
-                h_updated = t_old.get('data_atualizacao', '')
-                
-                # O prazo final deve sempre refletir o do Google (Fonte da Verdade)
-                deadline_changed = t_old.get('data_limite') != deadline
-                
-                # Se o prazo mudou, ignoramos o shortcut do timestamp para garantir a sincronia
-                if h_updated and g_updated and h_updated >= g_updated and not deadline_changed: continue
-                
-                has_changed = (t_old.get('status') != h_status or 
-                               t_old.get('titulo') != title or 
-                               deadline_changed or 
-                               t_old.get('horario_inicio') != h_inicio or
-                               t_old.get('horario_fim') != h_fim)
-                
-                if has_changed:
-                    db.collection('tarefas').document(doc_id).update({
-                        'titulo': title, 'data_limite': deadline, 'status': h_status,
-                        'data_conclusao': gt.get('completed'), 'data_atualizacao': g_updated,
-                        'notas': g_notes, 'sync_status': 'updated', 
-                        'last_sync_date': datetime.now().isoformat(),
-                        'horario_inicio': h_inicio,
-                        'horario_fim': h_fim
-                    })
-                    if deadline_changed:
-                        log(f"[#] PRAZO SINCRONIZADO: {title} ({deadline})")
-                    else:
-                        log(f"[-] ATUALIZADA: {title}")
+                elif 'due' in merge.pull:
+                    record('updated')
+                    log(f"[#] PRAZO SINCRONIZADO: {title} ({merge.pull['due'] or '-'})")
+                elif merge.pull:
+                    record('updated')
+                    log(f"[-] ATUALIZADA: {title} ({', '.join(merge.pull)})")
+                if merge.new_conflicts:
+                    record('conflicts')
+                    log(f"[!] CONFLITO: {title} ({', '.join(merge.new_conflicts)}) - mantido sem sobrescrever.")
             else:
-                db.collection('tarefas').add({
+                due = gt.get('due', None)
+                deadline = due.split('T')[0] if due else '-'
+                h_status = 'concluído' if gt.get('status') == 'completed' else 'em andamento'
+                
+                # Extração de horários das notas
+                g_notes = gt.get('notes', '')
+                h_inicio, h_fim = extract_time_from_notes(g_notes)
+                categoria, sistema, contabilizar_meta = classify_task(title, g_notes, dynamic_mapping)
+                new_task = {
                     'titulo': title, 'projeto': 'GOOGLE', 'data_limite': deadline,
                     'google_id': g_id, 'status': h_status, 'data_criacao': datetime.now().isoformat(),
-                    'data_conclusao': gt.get('completed'), 'data_atualizacao': g_updated,
+                    'data_conclusao': gt.get('completed'), 'data_atualizacao': gt.get('updated', ''),
                     'categoria': categoria, 'contabilizar_meta': contabilizar_meta,
                     'notas': g_notes, 'sync_status': 'new', 'last_sync_date': datetime.now().isoformat(),
-                    'horario_inicio': h_inicio, 'horario_fim': h_fim
-                })
+                    'horario_inicio': h_inicio, 'horario_fim': default_end(h_inicio, h_fim)
+                }
+                new_task.update(synced_marks(new_task, google_view(gt)))
+                writer.create(db.collection('tarefas'), new_task)
+                record('created')
                 log(f"[+] IMPORTADA: {title}")
+
+        # Só avança o watermark depois de gravar todas as alterações com sucesso
+        failures = writer.flush()
+        if not failures and session.next_watermark and session.next_watermark != watermark:
+            set_tasks_watermark(db, tasklist_id, session.next_watermark)
         cleanup_old_sync_badges(db, log)
         log("PULL CONCLUÍDO.", force_ui=True)
     except Exception as e:
+        writer.flush()
         log(f"ERRO PULL: {e}", force_ui=True)
 
-def sync_google_calendar(db, log_list=None, sync_ref=None):
-    last_ui_update = [0]
-    def log(msg, force_ui=False):
-        print(msg)
-        if log_list is not None:
-            log_list.append(f"[{datetime.now().strftime('%H:%M:%S')}] {msg}")
-            now_ts = time.time()
-            if sync_ref and (force_ui or now_ts - last_ui_update[0] > 1.2):
-                try: sync_ref.update({'logs': log_list}); last_ui_update[0] = now_ts
-                except: pass
+@tracked('calendar')
+def sync_google_calendar(db, log_list=None, sync_ref=None, full_resync=False):
+    log = partial(stage_log, log_list)
+    writer = BufferedWriter(db, log)
     try:
         service = get_calendar_service()
         log("Sincronizando Google Calendar...")
 
-        time_min = (datetime.now(timezone.utc) - timedelta(days=7)).isoformat().replace('+00:00', 'Z')
-        time_max = (datetime.now(timezone.utc) + timedelta(days=30)).isoformat().replace('+00:00', 'Z')
-
-        events_result = service.events().list(
-            calendarId='primary', timeMin=time_min, timeMax=time_max,
-            singleEvents=True, orderBy='startTime'
-        ).execute()
-        events = events_result.get('items', [])
-
-        log(f"Encontrados {len(events)} eventos no Calendar. Sincronizando...")
-
-        count = 0
-        for event in events:
-            event_id = event['id']
-            summary = event.get('summary', '(Sem título)')
-            start = event['start'].get('dateTime', event['start'].get('date'))
-            end = event['end'].get('dateTime', event['end'].get('date'))
-
-            db.collection('google_calendar_events').document(event_id).set({
-                'google_id': event_id,
-                'titulo': summary,
-                'data_inicio': start,
-                'data_fim': end,
-                'last_sync': datetime.now().isoformat()
-            }, merge=True)
-            count += 1
-
-        # Cleanup: Remove eventos que não vieram na resposta (excluídos do Google)
-        # Mas apenas dentro da janela de tempo consultada
-        fetched_ids = {e['id'] for e in events}
-        try:
-            existing_docs = db.collection('google_calendar_events').stream()
-            deleted_count = 0
-            for doc in existing_docs:
-                d = doc.to_dict()
-                e_start = d.get('data_inicio')
-                if not e_start: continue
-                
-                # Verifica se o evento está dentro da janela de sincronização
-                if time_min <= e_start <= time_max:
-                    if doc.id not in fetched_ids:
-                        doc.reference.delete()
-                        deleted_count += 1
-                        
-            if deleted_count > 0:
-                log(f"[CAL] {deleted_count} eventos excluídos localmente.", force_ui=True)
-        except Exception as cleanup_err:
-            log(f"Erro na limpeza do calendário: {cleanup_err}")
-
+        # Incremental via syncToken; listagem completa (com limpeza na janela) na 1ª vez, a cada 24h ou com --full
+        count, deleted_count = sync_calendar_events(db, service, writer, log, full_resync)
+        if deleted_count > 0:
+            log(f"[CAL] {deleted_count} eventos excluídos localmente.", force_ui=True)
         log(f"[CAL] {count} eventos sincronizados.", force_ui=True)
     except Exception as e:
+        writer.flush()
         log(f"ERRO CALENDAR: {e}", force_ui=True)
 
-def push_google_tasks(db, log_list=None, sync_ref=None):
-    last_ui_update = [0]
-    def log(msg, force_ui=False):
-        print(msg)
-        if log_list is not None: 
-            log_list.append(f"[{datetime.now().strftime('%H:%M:%S')}] {msg}")
-            now_ts = time.time()
-            if sync_ref and (force_ui or now_ts - last_ui_update[0] > 1.2):
-                try: sync_ref.update({'logs': log_list}); last_ui_update[0] = now_ts
-                except: pass
+@tracked('tasks_push')
+def push_google_tasks(db, log_list=None, sync_ref=None, full_resync=False, session=None):
+    log = partial(stage_log, log_list)
+    writer = BufferedWriter(db, log)
     try:
-        service = get_tasks_service()
-        results = service.tasklists().list().execute()
-        tasklists = results.get('items', [])
-        tasklist_id = None
-        target_name = 'tarefa-gerais'
-        for item in tasklists:
-            clean_title = item['title'].lower().replace(' ', '-').replace('s', '') if 'tarefa' in item['title'].lower() else item['title'].lower()
-            if item['title'].lower() == target_name or clean_title == target_name.replace('s', ''):
-                tasklist_id = item['id']
-                log(f"Iniciando PUSH para: {item['title']}")
-                break
+        session = session or TasksSyncSession(db, get_tasks_service(), full_resync)
+        # Apenas as tarefas marcadas com needs_push (full_resync percorre a coleção inteira)
+        tasks = session.load_all_local() if full_resync else session.load_dirty_local()
+        if not full_resync and not tasks:
+            log("PUSH: nenhuma alteração local pendente.", force_ui=True)
+            return
+
+        tasklist_id = session.resolve_tasklist(is_target_tasklist)
         if not tasklist_id:
             log("ERRO: Lista destino não encontrada.")
             return
-        # Pega todas as tarefas do Google (com paginação) para o mapa
-        g_tasks_map = {}
-        next_page_token = None
-        while True:
-            g_results = service.tasks().list(tasklist=tasklist_id, showCompleted=True, showHidden=True, maxResults=100, pageToken=next_page_token).execute()
-            for item in g_results.get('items', []):
-                g_tasks_map[item['id']] = item
-            next_page_token = g_results.get('nextPageToken')
-            if not next_page_token or len(g_tasks_map) >= 500: break
-
-        tasks = db.collection('tarefas').stream()
-        count = 0
-        for doc in tasks:
-            t = doc.to_dict()
-            g_id = t.get('google_id')
-            h_status = t.get('status')
-            
-            if h_status == 'excluído':
-                if g_id:
-                    try: 
-                        service.tasks().delete(tasklist=tasklist_id, task=g_id).execute()
-                        log(f"[X] REMOVIDA DO GOOGLE: {t['titulo']}")
-                    except HttpError as e:
-                        if e.resp.status == 404:
-                            log(f"[!] Task {g_id} já não existia no Google.")
-                        else:
-                            log(f"[!] Erro ao deletar no Google: {e}")
-                doc.reference.delete()
-                continue
-
-            due_date = f"{t['data_limite']}T00:00:00Z" if t.get('data_limite') and t.get('data_limite') != '-' else None
-            
-            # Se houver horário de início, tentamos enviar no due
-            if t.get('horario_inicio') and due_date:
-                due_date = f"{t['data_limite']}T{t['horario_inicio']}:00Z"
-
-            g_status = 'completed' if t.get('status') == 'concluído' else 'needsAction'
-            
-            # Atualiza as notas com o horário para garantir a sincronia de volta
-            h_inicio, h_fim = t.get('horario_inicio'), t.get('horario_fim')
-            if h_inicio and not h_fim:
-                try:
-                    h, m = map(int, h_inicio.split(':'))
-                    h_fim = f"{(h+1)%24:02d}:{m:02d}"
-                except: pass
-            
-            updated_notes = update_notes_with_time(t.get('notas', ''), h_inicio, h_fim)
-
-            if not g_id:
-                body = {'title': t['titulo'], 'notes': updated_notes, 'status': g_status, 'due': due_date}
-                new_task = service.tasks().insert(tasklist=tasklist_id, body=body).execute()
-                doc.reference.update({
-                    'google_id': new_task['id'], 
-                    'data_atualizacao': new_task.get('updated'), 
-                    'notas': updated_notes, 
-                    'horario_fim': h_fim if not t.get('horario_fim') else t.get('horario_fim')
-                })
-                log(f"[+] ENVIADA: {t['titulo']}"); count += 1
-                continue
-
-            g_task = g_tasks_map.get(g_id)
-            if g_task and t.get('data_atualizacao', '') > g_task.get('updated', ''):
-                body = {'id': g_id, 'title': t['titulo'], 'notes': updated_notes, 'status': g_status, 'due': due_date}
-                try:
-                    service.tasks().update(tasklist=tasklist_id, task=g_id, body=body).execute()
-                    log(f"[^] ATUALIZADA NO GOOGLE: {t['titulo']}"); count += 1
-                    if updated_notes != t.get('notas', ''):
-                        doc.reference.update({'notas': updated_notes})
-                except HttpError as e:
-                    if e.resp.status == 404:
-                        log(f"[!] Task {g_id} não encontrada no Google - Limpando ID para re-envio.")
-                        doc.reference.update({'google_id': None})
-                    else:
-                        raise e
+        log(f"Iniciando PUSH para: {session.tasklist_title} ({len(tasks)} tarefa(s))")
+        session.load_google_tasks()
+        count = push_local_tasks(session, tasks, writer, log)
+        writer.flush()
         log(f"PUSH FINALIZADO: {count} atualizações.", force_ui=True)
     except Exception as e:
+        # Grava o que já foi confirmado pelo Google antes da falha (ex.: google_id de inserções)
+        writer.flush()
         log(f"ERRO PUSH: {e}", force_ui=True)
 
-def sync_pix_emails(db, log_list=None, sync_ref=None):
+@tracked('pix')
+def sync_pix_emails(db, log_list=None, sync_ref=None, full_resync=False):
     """
-    Busca emails de Pix e registra no Financeiro (Versão CLI)
+    Busca emails de Pix e registra no Financeiro (Versão CLI, via pix_sync.ingest_pix_messages)
+    Só as mensagens novas desde o último historyId do Gmail; `full_resync` refaz a busca completa.
     """
-    def log(msg, force_ui=False):
-        print(msg)
-        if log_list is not None: 
-            log_list.append(f"[{datetime.now().strftime('%H:%M:%S')}] {msg}")
-            if sync_ref:
-                try: sync_ref.update({'logs': log_list})
-                except: pass
+    log = partial(stage_log, log_list)
 
     try:
-        service = get_gmail_service()
-        log("Buscando emails de Pix a partir de 01/02/2026...")
-        # Query: Assuntos de Pix + Data limite
-        query = 'after:2026/02/01 subject:(Pix recebido OR Pix realizado OR "Pix enviado" OR "transferência Pix" OR "Pix enviado")'
-        
-        results = service.users().messages().list(userId='me', q=query, maxResults=50).execute()
-        messages = results.get('messages', [])
-        
-        if not messages:
-            log("Nenhum Pix encontrado para os critérios de busca.")
-            return
-        
-        log(f"Encontrados {len(messages)} e-mails potenciais de Pix. Analisando...")
-
-        # Cache de transações existentes para evitar duplicatas
-        existing_transactions = []
-        existing_income = []
-        existing_google_ids = set()
-
-        for t in db.collection('finance_transactions').stream():
-            data = t.to_dict()
-            existing_transactions.append((data.get('description'), data.get('amount'), data.get('date')))
-            if data.get('google_message_id'): existing_google_ids.add(data['google_message_id'])
-
-        for t in db.collection('finance_income').stream():
-            data = t.to_dict()
-            existing_income.append((data.get('description'), data.get('amount'), data.get('date')))
-            if data.get('google_message_id'): existing_google_ids.add(data['google_message_id'])
-
-        processed_emails_doc = db.collection('system').document('processed_emails').get()
-        processed_ids = processed_emails_doc.to_dict().get('ids', []) if processed_emails_doc.exists else []
-        new_processed_ids = []
-
-        for msg in messages:
-            msg_id = msg['id']
-            if msg_id in processed_ids or msg_id in existing_google_ids: continue
-            
-            details = service.users().messages().get(userId='me', id=msg_id).execute()
-            internal_date_ms = int(details.get('internalDate', time.time() * 1000))
-            dt = datetime.fromtimestamp(internal_date_ms / 1000.0, tz=timezone.utc)
-            
-            snippet = details.get('snippet', '')
-            subject = ''
-            for header in details.get('payload', {}).get('headers', []):
-                if header['name'] == 'Subject': subject = header['value']; break
-            
-            value_match = re.search(r'R\$\s*(\d+(?:[\.,]\d+)?)', f"{subject} {snippet}")
-            if value_match:
-                val_str = value_match.group(1).replace('.', '').replace(',', '.')
-                amount = float(val_str)
-                is_income = any(word in subject.lower() or word in snippet.lower() for word in ['recebido', 'recebeu', 'recebida'])
-                description = f"Pix: {subject}"
-                iso_date = dt.isoformat()
-                
-                # Verificação de redundância adicional (mesmo que não esteja no processed_ids)
-                record = (description, amount, iso_date)
-                if is_income:
-                    if record in existing_income:
-                        new_processed_ids.append(msg_id)
-                        continue
-                    db.collection('finance_income').add({
-                        'description': description, 'amount': amount, 'day': dt.day,
-                        'month': dt.month - 1, 'year': dt.year,
-                        'category': 'Renda Extra', 'isReceived': True, 'date': iso_date,
-                        'google_message_id': msg_id, 'status': 'active'
-                    })
-                else:
-                    if record in existing_transactions:
-                        new_processed_ids.append(msg_id)
-                        continue
-                    sprint = 1 if dt.day < 8 else 2 if dt.day < 15 else 3 if dt.day < 22 else 4
-                    db.collection('finance_transactions').add({
-                        'description': description, 'amount': amount, 'date': iso_date,
-                        'sprint': sprint, 'category': 'Alimentação',
-                        'google_message_id': msg_id, 'status': 'active'
-                    })
-                new_processed_ids.append(msg_id)
-                log(f"[PIX] Processado: {description} (R$ {amount:.2f}) - Data: {dt.strftime('%d/%m/%y')}")
-
-        if new_processed_ids:
-            updated_ids = list(set(processed_ids + new_processed_ids))[-200:]
-            db.collection('system').document('processed_emails').set({'ids': updated_ids}, merge=True)
+        # Mesmo pipeline das Cloud Functions: deduplicação por finance_fingerprints, sem ler as coleções
+        ingest_pix_messages(db, get_gmail_service(), BufferedWriter(db, log), log, full_resync)
     except Exception as e:
         log(f"ERRO PIX: {e}")
 
@@ -564,34 +346,92 @@ def watch_commands(db):
             data = doc.to_dict()
             if not data or data.get('status') != 'requested': continue
             print(f"\n[{datetime.now().strftime('%H:%M:%S')}] COMANDO RECEBIDO")
-            log_entries = ["Iniciando processamento..."]
-            sync_doc_ref.update({'status': 'processing', 'logs': log_entries})
-            try:
-                push_google_tasks(db, log_entries, sync_doc_ref)
-                sync_google_tasks(db, log_entries, sync_doc_ref)
-                sync_google_calendar(db, log_entries, sync_doc_ref)
-                sync_pix_emails(db, log_entries, sync_doc_ref)
-                sync_doc_ref.update({'status': 'completed', 'last_success': datetime.now().isoformat(), 'logs': log_entries})
-                print("Sincronização concluída.")
-            except Exception as e:
-                print(f"ERRO: {e}"); log_entries.append(f"ERRO FATAL: {str(e)}")
-                sync_doc_ref.update({'status': 'error', 'error_message': str(e), 'logs': log_entries})
+            # Trava de execução única compartilhada com as Cloud Functions (system/sync_lock)
+            run_single_flight(db, 'cli', run_requested_sync, data.get('mode') == 'full', 'manual', data.get('timestamp'))
+
+    def run_requested_sync(full_resync, trigger):
+        metrics = SyncMetrics('cli', trigger).activate()
+        store = LogStore(db, metrics.run_id)
+        run_logs = RunLogs(["Iniciando processamento..."], store=store)
+        store.flush()
+        # system/sync guarda só o status e o cursor; as linhas ficam em sync_runs/{runId}/logs
+        # (limpa o `interrupted` gravado pelo botão de parar numa execução anterior)
+        sync_doc_ref.update({'status': 'processing', 'log_run_id': metrics.run_id, 'interrupted': False})
+        try:
+            # Renova o token antes das threads para que elas não disputem o token.json
+            get_google_creds()
+
+            def tasks_stage(log_entries):
+                # Push e pull compartilham a mesma sessão (uma listagem e uma leitura por execução)
+                tasks_session = TasksSyncSession(db, get_tasks_service(), full_resync)
+                push_google_tasks(db, log_entries, sync_doc_ref, full_resync, tasks_session)
+                sync_google_tasks(db, log_entries, sync_doc_ref, full_resync, tasks_session)
+
+            # Tasks (push→pull em ordem), Calendar e Pix rodam em paralelo, cada um com seu buffer de log
+            run_stages([
+                ('TASKS', tasks_stage),
+                ('CAL', lambda log_entries: sync_google_calendar(db, log_entries, sync_doc_ref, full_resync)),
+                ('PIX', lambda log_entries: sync_pix_emails(db, log_entries, sync_doc_ref, full_resync)),
+            ], run_logs)
+            sync_doc_ref.update({'status': 'completed', 'last_success': datetime.now().isoformat(), 'log_lines': store.lines, 'last_run_id': metrics.run_id})
+            metrics.save(db)
+            print("Sincronização concluída.")
+        except Exception as e:
+            print(f"ERRO: {e}"); store.append(f"ERRO FATAL: {str(e)}"); store.flush()
+            sync_doc_ref.update({'status': 'error', 'error_message': str(e), 'log_lines': store.lines})
+            metrics.save(db, 'error')
     doc_watch = sync_doc_ref.on_snapshot(on_snapshot)
     while True: time.sleep(1)
 
+def search_command(db, args):
+    """Busca semântica com o índice local (mmap no diretório temporário), atualizado só com os documentos novos"""
+    index = VectorIndex(refresh_interval=0)
+    if args.rebuild: index.rebuild(db, log=print)
+    if not args.query: return
+    if not configure_gemini(db): print("Chave Gemini não configurada em system/api_keys."); return
+    started = time.perf_counter()
+    results = search_knowledge(db, index, args.query, args.k, args.task)
+    print(f"{len(results)} trecho(s) em {(time.perf_counter() - started) * 1000:.0f}ms ({len(index)} no índice):")
+    for hit in results:
+        text = ' '.join((hit.get('texto') or '').split())
+        print(f"\n[{hit['score']:.3f}] {hit.get('nome')} (tarefa {hit.get('task_id')}, trecho {hit.get('chunk_index')}, {hit.get('start')}-{hit.get('end')})")
+        print(f"  {text[:300]}{'...' if len(text) > 300 else ''}")
+
 def main():
     parser = argparse.ArgumentParser(description='Hermes CLI')
     subparsers = parser.add_subparsers(dest='command')
-    subparsers.add_parser('sync-tasks')
+    sync_tasks_parser = subparsers.add_parser('sync-tasks')
+    sync_tasks_parser.add_argument('--full', action='store_true', help='Ignora o watermark e relista todas as tarefas do Google')
     subparsers.add_parser('watch')
-    subparsers.add_parser('sync-pix')
-    subparsers.add_parser('sync-cal')
+    sync_pix_parser = subparsers.add_parser('sync-pix')
+    sync_pix_parser.add_argument('--full', action='store_true', help='Ignora o historyId do Gmail e refaz a busca completa')
+    subparsers.add_parser('backfill-fingerprints', help='Gera finance_fingerprints a partir dos registros do Financeiro')
+    subparsers.add_parser('rebuild-reminders', help='Recalcula a agenda de lembretes (reminder_schedule)')
+    subparsers.add_parser('reembed-knowledge', help='Converte processos_conhecimento para vetores por trecho')
+    search_parser = subparsers.add_parser('search', help='Busca semântica nos documentos dos processos')
+    search_parser.add_argument('query', nargs='?', help='Texto da consulta')
+    search_parser.add_argument('-k', type=int, default=5, help='Número de trechos retornados')
+    search_parser.add_argument('--task', help='Restringe a busca aos documentos de uma tarefa (taskId)')
+    search_parser.add_argument('--rebuild', action='store_true', help='Relê a coleção inteira e recria o índice local')
+    sync_cal_parser = subparsers.add_parser('sync-cal')
+    sync_cal_parser.add_argument('--full', action='store_true', help='Ignora o syncToken e relista a janela inteira do Calendar')
     args = parser.parse_args()
     if not args.command: parser.print_help(); return
     db = init_db()
-    if args.command == 'sync-tasks': sync_google_tasks(db)
-    elif args.command == 'watch': watch_commands(db)
-    elif args.command == 'sync-pix': sync_pix_emails(db)
-    elif args.command == 'sync-cal': sync_google_calendar(db)
+    if args.command == 'watch': watch_commands(db); return
+    if args.command == 'backfill-fingerprints': backfill_fingerprints(db, BufferedWriter(db)); return
+    if args.command == 'rebuild-reminders': rebuild_reminder_schedule(db, BufferedWriter(db)); return
+    if args.command == 'reembed-knowledge':
+        if not configure_gemini(db): print("Chave Gemini não configurada em system/api_keys."); return
+        reembed_knowledge(db, BufferedWriter(db)); return
+    if args.command == 'search': search_command(db, args); return
+
+    # Comandos avulsos também geram um registro em sync_runs
+    metrics = SyncMetrics('cli', args.command).activate()
+    if args.command == 'sync-tasks': sync_google_tasks(db, full_resync=args.full)
+    elif args.command == 'sync-pix': sync_pix_emails(db, full_resync=args.full)
+    elif args.command == 'sync-cal': sync_google_calendar(db, full_resync=args.full)
+    run = metrics.save(db)
+    print(f"Métricas ({run['run_id']}): " + ", ".join(f"{name} {stage['wall_ms']} ms" for name, stage in run['stages'].items()))
 
 if __name__ == '__main__': main()
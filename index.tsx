@@ -1546,6 +1546,7 @@ const App: React.FC = () => {
   const [isNotificationCenterOpen, setIsNotificationCenterOpen] = useState(false);
   const [isMobileMenuOpen, setIsMobileMenuOpen] = useState(false);
   const [syncData, setSyncData] = useState<any>(null);
+  const [syncLogs, setSyncLogs] = useState<string[]>([]);
   const [activePopup, setActivePopup] = useState<HermesNotification | null>(null);
   const [isSettingsModalOpen, setIsSettingsModalOpen] = useState(false);
   const [exams, setExams] = useState<HealthExam[]>([]);
@@ -2060,6 +2061,20 @@ const App: React.FC = () => {
     return () => unsub();
   }, []);
 
+  // Logs da execução: páginas append-only em sync_runs/{runId}/logs (system/sync guarda só o cursor)
+  const logRunId = syncData?.log_run_id;
+  useEffect(() => {
+    if (!logRunId) {
+      setSyncLogs([]);
+      return;
+    }
+    const q = query(collection(db, 'sync_runs', logRunId, 'logs'), orderBy('seq'));
+    const unsub = onSnapshot(q, (snap) => {
+      setSyncLogs(snap.docs.flatMap(d => (d.data().lines || []) as string[]));
+    });
+    return () => unsub();
+  }, [logRunId]);
+
   const handleSync = async () => {
     if (isSyncing) {
       setIsTerminalOpen(true);
@@ -2073,8 +2088,7 @@ const App: React.FC = () => {
     try {
       await setDoc(doc(db, 'system', 'sync'), {
         status: 'requested',
-        timestamp: new Date().toISOString(),
-        logs: ["Aguardando resposta do Bot..."]
+        timestamp: new Date().toISOString()
       });
     } catch (e) {
       console.error(e);
@@ -6190,7 +6204,7 @@ const App: React.FC = () => {
                     {isSyncing && (
                       <button
                         onClick={async () => {
-                          await setDoc(doc(db, 'system', 'sync'), { status: 'idle', logs: [...(syncData?.logs || []), "--- INTERROMPIDO PELO USUÁRIO ---"] });
+                          await setDoc(doc(db, 'system', 'sync'), { status: 'idle', log_run_id: syncData?.log_run_id || null, interrupted: true });
                           setIsSyncing(false);
                         }}
                         className="text-[9px] font-bold text-rose-500/60 hover:text-rose-400 bg-rose-500/10 border border-rose-500/20 px-3 py-1 rounded-full transition-all"
@@ -6206,7 +6220,10 @@ const App: React.FC = () => {
 
                 <div className="flex-1 overflow-y-auto p-6 font-mono text-[11px] space-y-2 selection:bg-blue-500/30">
                   <div className="text-blue-400 opacity-60"># hermes_cli.py --sync-mode automatic</div>
-                  {syncData?.logs?.map((log: string, i: number) => (
+                  {[
+                    ...(syncData?.status === 'requested' ? ["Aguardando resposta do Bot..."] : syncLogs),
+                    ...(syncData?.interrupted ? ["--- INTERROMPIDO PELO USUÁRIO ---"] : [])
+                  ].map((log: string, i: number) => (
                     <div key={i} className={`flex gap-3 ${log.includes('ERRO') ? 'text-rose-400' : log.includes('PUSH') ? 'text-blue-400' : log.includes('PULL') ? 'text-emerald-400' : 'text-slate-400'}`}>
                       <span className="opacity-30 shrink-0">[{i}]</span>
                       <span className="leading-relaxed">{log}</span>